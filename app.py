@@ -1,24 +1,94 @@
 ################## Imports ##################
 # Remember to properly add the packages to requirements.txt or conda-requirements.txt. 
+# Bokeh and scipy.stats take most of the import time and are imported by the functions that use them, so workers
+# that only serve other routes never load them; set WARMUP to load them and run every kernel at startup instead.
 from __future__ import division
 
-from flask import Flask, render_template, request, redirect, send_file
-import requests
-import os
-import sys
+import timeit
+IMPORT_START = timeit.default_timer()
 
-from bokeh.plotting import figure
-from bokeh.embed import components
-from bokeh.layouts import row
-from bokeh.models import Legend
+import flask
+from flask import Flask, Response, request, redirect
+import os
+import json
+import multiprocessing
+import threading
+import re
+import hashlib
+import traceback
+from collections import OrderedDict
 
-import pandas_datareader.data as web
-import scipy.stats as stat
+import scipy.special
 import pandas as pd
 import numpy as np
 import datetime
 import dateutil.relativedelta
 
+from price_store import PriceStore, provider_from_env
+from jobs import JobQueue
+from result_cache import ResultCache
+from incremental import StateStore
+from panel import UniversePanel
+from decimate import lttb, series_arrays, encode_array
+from downloads import FORMATS, download_entry, bundled_entry, arrow_available, stream_download
+import metrics
+from metrics import stage, observe_size, cache_lookup
+
+metrics.startup['import_start'] = IMPORT_START
+
+# Local price store shared by all requests; set PRICE_PROVIDER=csv to serve the csv files in tests/ and outputs/ offline
+price_store = PriceStore(os.environ.get('PRICE_STORE_DIR', 'data/prices'), provider_from_env())
+
+# Number of processes used by the Monte Carlo risk plot
+MC_WORKERS = int(os.environ.get('MC_WORKERS', 1))
+
+# Seed of the Monte Carlo runs behind the html form, so a cached result is the one a recomputation would give
+MC_SEED = int(os.environ.get('MC_SEED', 2016))
+
+# Quasi-Monte Carlo VaR/ES: QMC_REPLICATES independent randomizations of QMC_PATHS 'sobol' (scrambled Sobol) or 'lhs'
+# (Latin hypercube) points per date; the spread of the randomizations gives the standard error
+QMC_SAMPLING = os.environ.get('QMC_SAMPLING', 'sobol')
+QMC_PATHS = int(os.environ.get('QMC_PATHS', 256))
+QMC_REPLICATES = int(os.environ.get('QMC_REPLICATES', 4))
+
+# Warm-up steps run once the app is imported (in the gunicorn master with --preload, so before the workers fork):
+# a comma-separated list of 'kernels', 'plots' and 'templates', 'all' or nothing, run on the prices in WARMUP_PRICES
+WARMUP_STEPS = ['kernels', 'plots', 'templates']
+WARMUP = os.environ.get('WARMUP', '').replace(' ', '')
+WARMUP = WARMUP_STEPS if WARMUP == 'all' else [step for step in WARMUP.split(',') if step and step != 'none']
+WARMUP_PRICES = os.environ.get('WARMUP_PRICES', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tests',
+                                                             'price_AAPL_2000-12-01_2016-12-01.csv'))
+
+# Plot and options results, download entries and plotted series shared by all workers, each in its own namespace
+result_cache = ResultCache(os.environ.get('RESULT_CACHE_DIR', 'data/results'),
+                           int(os.environ.get('RESULT_CACHE_BYTES', 512*1024*1024)))
+
+# Background jobs shared by all workers through one SQLite file; JOB_WORKERS processes per web worker run them
+job_queue = JobQueue(os.environ.get('JOBS_DB', 'data/jobs.sqlite'), int(os.environ.get('JOB_WORKERS', 0)) or None,
+                     timeout=float(os.environ.get('JOB_TIMEOUT', 900)))
+
+# Longest ?wait of GET /jobs/<id>, below the 30 second timeout of the gunicorn workers
+JOB_WAIT_MAX = float(os.environ.get('JOB_WAIT_MAX', 25))
+
+# Monte Carlo risk plots and options calculations of the html form run as background jobs (FORM_JOBS=0 runs them in
+# the request); the request waits FORM_JOB_WAIT seconds for the job, enough for a quick one, before answering with a
+# page that polls it, so a slow job does not hold the web worker
+FORM_JOBS = os.environ.get('FORM_JOBS', '1') != '0'
+FORM_JOB_WAIT = float(os.environ.get('FORM_JOB_WAIT', 2))
+
+# Rolling state of the latest VaR/ES point of each series for incremental requests, see incremental.py
+incremental_store = StateStore(os.environ.get('INCREMENTAL_DIR', 'data/incremental'))
+
+# Calendar-aligned prices of the ticker universe, memory-mapped once per process before gunicorn forks so that all
+# workers share its pages; rebuilt with `python panel.py` (see panel.py) and picked up on the next restart. Requests
+# outside the dates it covers fall back to price_store.
+universe = UniversePanel.load(os.environ.get('UNIVERSE_DIR', 'data/universe'))
+
+# Rolling mu/sigma estimates kept per (series, date range, window) so repeated plots on a ticker reuse them
+ROLLING_CACHE_SIZE = int(os.environ.get('ROLLING_CACHE_SIZE', 128))
+rolling_cache = OrderedDict()
+rolling_cache_lock = threading.Lock()
+
 
 ##################  Function definitions ##################
 
@@ -26,52 +96,149 @@ import dateutil.relativedelta
 def create_df_from_tickers(tickers_string, position_date, end_date):
     tickers_list = tickers_string.replace(" ", "").split(",")
     start_date = position_date - dateutil.relativedelta.relativedelta(years = 10)
-    d={}
-    for ticker in tickers_list:
-        d["{0}".format(ticker)] = web.DataReader(ticker, 'yahoo', start_date, end_date)['Adj Close'].rename(ticker)
-    df = pd.DataFrame(d).sort_index(ascending = False)
+    with stage('fetch'):
+        df = get_prices(tickers_list, start_date, end_date)
+    observe_size('prices', df.size)
     plot_length = len(df[df.index >= position_date])
     return df, plot_length
 
 # Create dataframe from input for portfolio
 def create_df_from_tickers_port(tickers_string, weights_string, v0, position_date, end_date):
     tickers_list = tickers_string.replace(" ", "").split(",")
-    weights_list = map(float, weights_string.split(","))
+    weights_list = [float(weight) for weight in weights_string.split(",")]
     start_date = position_date - dateutil.relativedelta.relativedelta(years = 10)
-    d={}
-    for ticker in tickers_list:
-        d["{0}".format(ticker)] = web.DataReader(ticker, 'yahoo', start_date, end_date)['Adj Close'].rename(ticker)
-    df = pd.DataFrame(d).sort_index(ascending = False)
+    if universe is not None and universe.covers(tickers_list, start_date, end_date):
+        with stage('fetch'):
+            portfolio = universe.portfolio(tickers_list, weights_list, v0, position_date, start_date, end_date,
+                                           'Portfolio_%s' % (tickers_string.replace(",", "_")))
+        observe_size('prices', portfolio.size * len(tickers_list))
+        return portfolio, len(portfolio[portfolio.index >= position_date])
+    with stage('fetch'):
+        df = get_prices(tickers_list, start_date, end_date)
+    observe_size('prices', df.size)
     plot_length = len(df[df.index >= position_date])
-    shares = np.round(np.divide(v0 * np.array(weights_list), np.array(df.ix[position_date])))
-    portfolio = pd.DataFrame({'Portfolio_%s' % (tickers_string.replace(",", "_")): np.matmul(df, shares)}, index = df.index)
+    portfolio = portfolio_from_prices(df, weights_list, v0, position_date, tickers_string)
     return portfolio, plot_length
 
+# Prices of the tickers between the two dates, most recent first: slices of the universe panel when it covers them,
+# otherwise from price_store
+def get_prices(tickers_list, start_date, end_date):
+    if universe is not None and universe.covers(tickers_list, start_date, end_date):
+        return universe.frame(tickers_list, start_date, end_date)
+    return price_store.get_prices(tickers_list, start_date, end_date).sort_index(ascending = False)
+
+# Value of a portfolio buying v0 * weight worth of each ticker at position_date and holding the shares
+def portfolio_from_prices(df, weights_list, v0, position_date, tickers_string):
+    shares = np.round(np.divide(v0 * np.array(weights_list), np.array(df.loc[position_date])))
+    return pd.DataFrame({'Portfolio_%s' % (tickers_string.replace(",", "_")): np.matmul(df, shares)}, index = df.index)
+
+# Browser side of plot_line: once zooming or panning settles, fetch the visible range of the series from /plot_data
+# and swap it into the line's data source
+ZOOM_RELOAD_JS = """
+clearTimeout(source.reload_timer);
+source.reload_timer = setTimeout(function() {
+    var url = '/plot_data/' + key + '?start=' + x_range.start + '&end=' + x_range.end + '&points=' + points;
+    fetch(url).then(function(response) { return response.ok ? response.json() : null; }).then(function(series) {
+        if (series === null) { return; }
+        var decode = function(text) {
+            var raw = atob(text), bytes = new Uint8Array(raw.length);
+            for (var i = 0; i < raw.length; i++) { bytes[i] = raw.charCodeAt(i); }
+            return new Float64Array(bytes.buffer);
+        };
+        source.data = {x: decode(series.x), y: decode(series.y)};
+    });
+}, 250);
+"""
+
+# Line of values against dates, decimated with LTTB to about one point per pixel of the plot's width. Arrays go into
+# the page as binary float64 instead of lists of numbers; the full series is kept in result_cache under its content
+# hash, and the browser asks /plot_data for the visible range at full resolution when the plot is zoomed.
+def plot_line(plot, dates, values, **kwargs):
+    from bokeh.models import ColumnDataSource, CustomJS
+    x, y = series_arrays(dates, values)
+    key = hashlib.sha256(x.tobytes() + y.tobytes()).hexdigest()
+    if not result_cache.contains(key, 'series'):
+        result_cache.put(key, (x, y), 'series')
+    index = lttb(x, y, plot.width)
+    observe_size('plot_points', len(index))
+    source = ColumnDataSource(data={'x': x[index], 'y': y[index]})
+    plot.x_range.js_on_change('start', CustomJS(args={'source': source, 'x_range': plot.x_range, 'key': key,
+                                                      'points': plot.width}, code=ZOOM_RELOAD_JS))
+    return plot.line('x', 'y', source=source, **kwargs)
+
 # Price plot
 def plot_price(price, length):
+    from bokeh.plotting import figure
     data = price[:length]
-    output_file = 'outputs/price_%s_%s_%s.csv' % (data.columns.values[0], data.index[-1].date(), data.index[0].date())
-    data.to_csv(output_file)
-    plot = figure(width=600, height=400, title = "%s Historical Prices" % data.columns.values[0], 
-                  x_axis_label='Date', y_axis_label='Price', x_axis_type="datetime")
-    plot.line(data.index, data)
-    plot.title.text_font_size = '12pt'
-    return plot, output_file
+    download = download_entry('price_%s_%s_%s' % (data.columns.values[0], data.index[-1].date(), data.index[0].date()),
+                              data)
+    with stage('figure'):
+        plot = figure(width=600, height=400, title = "%s Historical Prices" % data.columns.values[0], 
+                      x_axis_label='Date', y_axis_label='Price', x_axis_type="datetime")
+        plot_line(plot, data.index, data.iloc[:,0])
+        plot.title.text_font_size = '12pt'
+    return plot, download, data
+
+# Rolling mean and standard deviation of daily log returns for several windows (in days), from one cumulative-sum
+# pass over the returns; windows already computed for the same series, date range and values are served from
+# rolling_cache. Like prices, element 0 of each result is the window ending on the most recent date.
+def rolling_estimates(prices, windows):
+    values = np.ascontiguousarray(prices, dtype=np.float64)
+    index = getattr(prices, 'index', None)
+    series_key = (getattr(prices, 'name', None), (index[0], index[-1]) if index is not None and len(index) else None,
+                  len(values), hashlib.sha1(values.tobytes()).hexdigest())
+    windows = [int(window_days) for window_days in windows]
+    with rolling_cache_lock:
+        cached = dict((w, rolling_cache[series_key + (w,)]) for w in windows if series_key + (w,) in rolling_cache)
+        for w in cached:
+            rolling_cache[series_key + (w,)] = rolling_cache.pop(series_key + (w,))
+    for w in windows:
+        cache_lookup('rolling', w in cached)
+    with stage('estimate'):
+        rtn = -np.diff(np.log(values))
+        rtn.flags.writeable = False
+        missing = [w for w in windows if w not in cached]
+        if missing:
+            # Centre the returns first so the running sums stay small and the variance keeps its precision
+            shift = rtn.mean() if len(rtn) else 0.0
+            centred = rtn - shift
+            csum = np.concatenate([[0.0], np.cumsum(centred)])
+            csumsq = np.concatenate([[0.0], np.cumsum(centred * centred)])
+            for w in missing:
+                mean = (csum[w:] - csum[:-w]) / w
+                var = (csumsq[w:] - csumsq[:-w]) / w - np.square(mean)
+                mubar = mean + shift
+                sigmabar = np.sqrt(np.maximum(var, 0))
+                mubar.flags.writeable = False
+                sigmabar.flags.writeable = False
+                cached[w] = (mubar, sigmabar)
+            with rolling_cache_lock:
+                for w in missing:
+                    rolling_cache[series_key + (w,)] = cached[w]
+                while len(rolling_cache) > ROLLING_CACHE_SIZE:
+                    rolling_cache.popitem(last=False)
+    return rtn, cached
 
 # Calculate estimated parameters for GBM based on x year (in days) rolling windows
 def gbm_est(prices, window_days):
-    rtn = -np.diff(np.log(prices))
-    rtnsq = rtn * rtn
-    mubar = list(reversed(np.convolve(rtn, np.ones((window_days,))/window_days, mode='valid')))
-    x2bar = list(reversed(np.convolve(rtnsq, np.ones((window_days,))/window_days, mode='valid')))
-    var = x2bar - np.square(mubar)
-    sigmabar = np.sqrt(np.maximum(var, np.zeros(len(var))))
+    rtn, estimates = rolling_estimates(prices, [window_days])
+    mubar, sigmabar = estimates[int(window_days)]
     sigma = sigmabar / np.sqrt(1/252)
-    mu = np.array(mubar)*252 + np.square(sigma)/2
-    return rtn, mu, sigma, np.array(mubar), sigmabar
+    mu = mubar*252 + np.square(sigma)/2
+    return rtn, mu, sigma, mubar, sigmabar
+
+# GBM mu and sigma of the most recent window of prices (most recent first) only, as the options calculations use
+def latest_gbm_est(prices, window_days):
+    rtn, mu, sigma, mubar, sigmabar = gbm_est(prices[:int(window_days) + 1], window_days)
+    if not len(mu):
+        raise ValueError('Need %d prices of %s, got %d' % (int(window_days) + 1, prices.name, len(prices)))
+    return mu[0], sigma[0]
 
 # Parameter plot
 def plot_parameters(price):
+    from bokeh.plotting import figure
+    from bokeh.layouts import row
+    rolling_estimates(price, [2*252, 5*252, 10*252])
     rtn_2, mu_2, sigma_2, mubar_2, sigmabar_2 = gbm_est(price, 2*252)
     rtn_5, mu_5, sigma_5, mubar_5, sigmabar_5 = gbm_est(price, 5*252)
     rtn_10, mu_10, sigma_10, mubar_10, sigmabar_10 = gbm_est(price, 10*252)
@@ -80,105 +247,498 @@ def plot_parameters(price):
                       index = price.index[:length])
     sigma = pd.DataFrame({'Sigma_2': sigma_2[:length], 'Sigma_5': sigma_5[:length], 'Sigma_10': sigma_10[:length]}, 
                          index = price.index[:length])
-    output_file = 'outputs/mu_sigma_%s_%s_%s.csv' % (price.name, mu.index[-1].date(), mu.index[0].date())
-    pd.merge(mu, sigma, left_index=True, right_index=True).to_csv(output_file)
-    pmu = figure(width=600, height=400, title = "%s Mu" % price.name, 
-                 x_axis_label='Date', y_axis_label='Mu', x_axis_type="datetime")
-    pmu.line(mu.index, mu['Mu_2'], legend = '2-year rolling window')
-    pmu.line(mu.index, mu['Mu_5'], color = 'green', legend = '5-year rolling window')
-    pmu.line(mu.index, mu['Mu_10'], color = 'orange', legend = '10-year rolling window')
-    pmu.title.text_font_size = '12pt'
-    pmu.legend.location = 'top_left'
-    pmu.legend.background_fill_alpha = 0.5
-    psigma = figure(width=600, height=400, title = "%s Sigma" % price.name, 
-                    x_axis_label='Date', y_axis_label='Sigma', x_axis_type="datetime")
-    psigma.line(mu.index, sigma['Sigma_2'], legend = '2-year rolling window')
-    psigma.line(mu.index, sigma['Sigma_5'], color = 'green', legend = '5-year rolling window')
-    psigma.line(mu.index, sigma['Sigma_10'], color = 'orange', legend = '10-year rolling window')
-    psigma.title.text_font_size = '12pt'
-    psigma.legend.location = 'top_left'
-    psigma.legend.background_fill_alpha = 0.5
-    plot = row(pmu, psigma)
-    return plot, output_file
+    mu_sigma = pd.merge(mu, sigma, left_index=True, right_index=True)
+    download = download_entry('mu_sigma_%s_%s_%s' % (price.name, mu.index[-1].date(), mu.index[0].date()), mu_sigma)
+    with stage('figure'):
+        pmu = figure(width=600, height=400, title = "%s Mu" % price.name, 
+                     x_axis_label='Date', y_axis_label='Mu', x_axis_type="datetime")
+        plot_line(pmu, mu.index, mu['Mu_2'], legend = '2-year rolling window')
+        plot_line(pmu, mu.index, mu['Mu_5'], color = 'green', legend = '5-year rolling window')
+        plot_line(pmu, mu.index, mu['Mu_10'], color = 'orange', legend = '10-year rolling window')
+        pmu.title.text_font_size = '12pt'
+        pmu.legend.location = 'top_left'
+        pmu.legend.background_fill_alpha = 0.5
+        psigma = figure(width=600, height=400, title = "%s Sigma" % price.name, 
+                        x_axis_label='Date', y_axis_label='Sigma', x_axis_type="datetime")
+        plot_line(psigma, mu.index, sigma['Sigma_2'], legend = '2-year rolling window')
+        plot_line(psigma, mu.index, sigma['Sigma_5'], color = 'green', legend = '5-year rolling window')
+        plot_line(psigma, mu.index, sigma['Sigma_10'], color = 'orange', legend = '10-year rolling window')
+        psigma.title.text_font_size = '12pt'
+        psigma.legend.location = 'top_left'
+        psigma.legend.background_fill_alpha = 0.5
+        plot = row(pmu, psigma)
+    return plot, download, mu_sigma
 
 # Calculate VaR and ES using parametric method
 def parametric(v0, mu, sigma, VaR_prob, ES_prob, t):
-    VaR = v0 - v0 * np.exp(sigma * np.sqrt(t) * stat.norm.ppf(1-VaR_prob) + (mu - np.square(sigma)/2) * t)
-    ES = v0 * (1 - np.array(stat.norm.cdf(stat.norm.ppf(1-ES_prob) - np.sqrt(t)*sigma)) * np.array(np.exp(mu*t)/(1-ES_prob)))
+    VaR = v0 - v0 * np.exp(sigma * np.sqrt(t) * scipy.special.ndtri(1-VaR_prob) + (mu - np.square(sigma)/2) * t)
+    ES = v0 * (1 - np.array(scipy.special.ndtr(scipy.special.ndtri(1-ES_prob) - np.sqrt(t)*sigma)) * np.array(np.exp(mu*t)/(1-ES_prob)))
     return VaR, ES
 
-# Calculate VaR and ES using historical method
-def historical(v0, price, VaR_prob, ES_prob, window_days, horizon_days):
+# Historical scenarios of every trial date as a (npaths, ntrials) array: the scenarios of trial i are price_res[i:i+npaths],
+# read through a strided view of price_res (no copy)
+def historical_scenarios(v0, price, window_days, horizon_days):
     npaths = window_days - horizon_days
-    ntrials = len(price) - window_days
-    price_log = np.log(price)
-    return_xdays = np.array(price_log[:(len(price_log)-horizon_days)]) - np.array(price_log[5:])
+    ntrials = max(len(price) - window_days, 0)
+    price_log = np.log(np.asarray(price, dtype=np.float64))
+    return_xdays = price_log[:(len(price_log)-horizon_days)] - price_log[horizon_days:]
     price_res = v0 * np.exp(return_xdays)
-    scenarios = np.zeros(shape=(npaths,ntrials))
-    for i in range(ntrials):
-        scenarios[0:npaths,i] = price_res[i:i+npaths]
-    scenarios_sorted = np.sort(scenarios, axis=0)
-    VaR = v0 - scenarios_sorted[np.ceil((1-VaR_prob)*npaths).astype(int) - 1]
-    ES = v0 - np.mean(scenarios_sorted[0:(np.ceil((1-ES_prob)*npaths).astype(int))], axis=0)
+    step = price_res.strides[0]
+    return np.lib.stride_tricks.as_strided(price_res, shape=(npaths, ntrials), strides=(step, step))
+
+# Calculate VaR and ES using historical method
+# The scenarios are only partially sorted, block_size trials at a time, so memory stays bounded whatever the history length.
+def historical(v0, price, VaR_prob, ES_prob, window_days, horizon_days, block_size=256):
+    scenarios = historical_scenarios(v0, price, window_days, horizon_days)
+    npaths, ntrials = scenarios.shape
+    var_index = int(np.ceil((1-VaR_prob)*npaths)) - 1
+    es_count = int(np.ceil((1-ES_prob)*npaths))
+    VaR = np.empty(ntrials)
+    ES = np.empty(ntrials)
+    for start in range(0, ntrials, block_size):
+        stop = min(start + block_size, ntrials)
+        block = np.partition(scenarios[:, start:stop], sorted(set([var_index, es_count - 1])), axis=0)
+        VaR[start:stop] = v0 - block[var_index]
+        ES[start:stop] = v0 - np.mean(block[:es_count], axis=0)
     return VaR, ES
 
+# Standard normal samples, shape (n,) or (dims, n) with one row per dimension: pseudo-random, scrambled Sobol points
+# or Latin hypercube points mapped through the inverse normal CDF. Sobol points are only balanced in blocks of a
+# power of two, so n should be one. Scrambling costs grow with the square of the bits of the points, and 12 bits
+# below the stratum width of a point are plenty.
+def normal_samples(rng, n, sampling='pseudo', dims=None):
+    if sampling == 'pseudo':
+        return rng.standard_normal(n if dims is None else (dims, n))
+    from scipy.stats import qmc
+    if sampling == 'sobol':
+        m = int(np.ceil(np.log2(n)))
+        u = qmc.Sobol(1 if dims is None else dims, scramble=True, bits=min(m + 12, 30),
+                           seed=rng).random_base2(m)[:n]
+    elif sampling == 'lhs':
+        u = qmc.LatinHypercube(1 if dims is None else dims, seed=rng).random(n)
+    else:
+        raise ValueError('Unknown sampling: %s' % sampling)
+    z = scipy.special.ndtri(u).T
+    return z[0] if dims is None else z
+
+# Lower VaR_prob quantile and ES_prob tail mean of every row of y. With stratified samples (Sobol, Latin hypercube)
+# the order statistic used for pseudo-random paths is off by up to one stratum, so the quantile is interpolated
+# (Hazen's rule) and the tail mean gives the boundary point its fractional weight instead.
+def sample_quantile_tail(y, VaR_prob, ES_prob, interpolate=False):
+    npaths = y.shape[1]
+    if not interpolate:
+        var_index = int(np.ceil((1-VaR_prob)*npaths)) - 1
+        es_count = int(np.ceil((1-ES_prob)*npaths))
+        y = np.partition(y, sorted(set([var_index, es_count - 1])), axis=1)
+        return y[:, var_index], np.mean(y[:, :es_count], axis=1)
+    y = np.sort(y, axis=1)
+    position = min(max((1-VaR_prob)*npaths - 0.5, 0), npaths - 1)
+    lo = int(position)
+    quantile = y[:, lo] + (position - lo) * (y[:, min(lo + 1, npaths - 1)] - y[:, lo])
+    es_count = (1-ES_prob)*npaths
+    weights = np.clip(es_count - np.arange(int(np.ceil(es_count))), 0, 1)
+    return quantile, np.dot(y[:, :len(weights)], weights) / es_count
+
+# Monte Carlo VaR and ES for one block of trial dates, drawn from its own random stream. Every date takes
+# replicates independent sets of npaths samples; the estimates are their means and the standard errors their
+# spread (NaN for a single replicate), which for Sobol or Latin hypercube sampling is randomized quasi-Monte Carlo.
+def monte_carlo_block(args):
+    v0, mu, sigma, VaR_prob, ES_prob, horizon, npaths, seed_seq, sampling, replicates = args
+    rng = np.random.Generator(np.random.PCG64(seed_seq))
+    VaR, ES = np.empty((replicates, len(mu))), np.empty((replicates, len(mu)))
+    for r in range(replicates):
+        bm = np.sqrt(horizon) * normal_samples(rng, npaths, sampling, len(mu))
+        y = v0 * np.exp(sigma[:, None] * bm - ((mu + sigma*sigma/2) * horizon)[:, None])
+        quantile, tail = sample_quantile_tail(y, VaR_prob, ES_prob, interpolate=sampling != 'pseudo')
+        VaR[r], ES[r] = v0 - quantile, v0 - tail
+    if replicates > 1:
+        stderr = lambda x: x.std(axis=0, ddof=1) / np.sqrt(replicates)
+        return VaR.mean(axis=0), ES.mean(axis=0), stderr(VaR), stderr(ES)
+    return VaR[0], ES[0], np.full(len(mu), np.nan), np.full(len(mu), np.nan)
+
 # Calculate VaR and ES using Monte Carlo method
-def monte_carlo(v0, price, mu, sigma, VaR_prob, ES_prob, window_days, horizon):
-    npaths = 5000
+# Dates are simulated block_size at a time, each block from a stream spawned from seed, so the result only
+# depends on seed and block_size and not on how many worker processes ran the blocks.
+# With common_shocks the same npaths shocks are reused for every date; the terminal value is increasing in the
+# shock, so the sorted shocks give the VaR and ES tail of every date directly.
+# sampling and replicates select the samples of monte_carlo_block; with stderr the standard errors of VaR and ES
+# are returned as well.
+def monte_carlo(v0, price, mu, sigma, VaR_prob, ES_prob, window_days, horizon, npaths=5000, seed=None,
+                common_shocks=False, block_size=64, n_workers=1, sampling='pseudo', replicates=1, stderr=False):
     ntrials = len(price) - window_days
-    p1 = np.zeros(shape=(npaths,ntrials))
-    for i in range(ntrials):
-        tv = np.ones(shape =(npaths,1))*horizon
-        bm = np.sqrt(horizon) * np.random.randn(npaths,1)
-        y = v0 * np.exp(sigma[i] * bm - (mu[i] + sigma[i]*sigma[i]/2) * tv)
-        p1[:,i] = y[:,0]
-    p2 = np.sort(p1,axis = 0)
-    VaR = v0 - p2[np.ceil((1-VaR_prob)*npaths).astype(int) - 1]
-    ES = v0 - np.mean(p2[0:(np.ceil((1-ES_prob)*npaths).astype(int))], axis=0)
-    return VaR, ES 
+    mu = np.asarray(mu, dtype=np.float64)[:ntrials]
+    sigma = np.asarray(sigma, dtype=np.float64)[:ntrials]
+    seed_seq = np.random.SeedSequence(seed)
+    if common_shocks:
+        bm = np.sort(np.sqrt(horizon) * np.random.Generator(np.random.PCG64(seed_seq)).standard_normal(npaths))
+        var_index = int(np.ceil((1-VaR_prob)*npaths)) - 1
+        es_count = int(np.ceil((1-ES_prob)*npaths))
+        drift = np.exp(-(mu + sigma*sigma/2) * horizon)
+        VaR = v0 - v0 * drift * np.exp(sigma * bm[var_index])
+        ES = v0 - v0 * drift * np.mean(np.exp(np.outer(bm[:es_count], sigma)), axis=0)
+        return (VaR, ES, np.full(ntrials, np.nan), np.full(ntrials, np.nan)) if stderr else (VaR, ES)
+    starts = range(0, ntrials, block_size)
+    tasks = [(v0, mu[start:start+block_size], sigma[start:start+block_size], VaR_prob, ES_prob, horizon, npaths, child,
+              sampling, replicates) for start, child in zip(starts, seed_seq.spawn(len(starts)))]
+    if n_workers > 1 and len(tasks) > 1:
+        pool = multiprocessing.Pool(min(n_workers, len(tasks)))
+        try:
+            results = pool.map(monte_carlo_block, tasks)
+        finally:
+            pool.close()
+    else:
+        results = [monte_carlo_block(task) for task in tasks]
+    if not results:
+        results = [(np.empty(0),) * 4]
+    VaR, ES, VaR_stderr, ES_stderr = [np.concatenate([result[i] for result in results]) for i in range(4)]
+    return (VaR, ES, VaR_stderr, ES_stderr) if stderr else (VaR, ES)
 
-# VaR/ES plot
-def plot_risk(v0, price, VaR_prob, ES_prob, method, window, horizon, plot_length):
+# Mean and covariance of the daily log returns of every column of prices (most recent date first) over the most
+# recent window only, as the candidate portfolios are screened on that date
+def multi_asset_est(prices, window_days):
+    window_days = int(window_days)
+    with stage('estimate'):
+        price_log = np.log(np.asarray(prices, dtype=np.float64))
+        rtn = price_log[:-1] - price_log[1:]
+        if len(rtn) < window_days:
+            raise ValueError('Need %d prices, got %d' % (window_days + 1, len(price_log)))
+        mean = rtn[:window_days].mean(axis=0)
+        centred = rtn[:window_days] - mean
+        cov = np.dot(centred.T, centred) / window_days
+    return rtn, mean, cov
+
+# Rolling means of the daily log returns of every column of prices (most recent date first) and, for the portfolio
+# holding the fraction weight of its value in each column, the rolling covariances of the columns with the portfolio
+# (cov w) and the portfolio variance (w' cov w) for the ndates most recent windows (all by default); row 0 is the most
+# recent window, as in gbm_est. These come from running sums of the returns and of their products with the portfolio
+# return, so memory stays at (dates x assets) and no (assets x assets) matrix is formed for any date.
+def portfolio_rolling_est(prices, weight, window_days, ndates=None):
+    window_days = int(window_days)
+    weight = np.asarray(weight, dtype=np.float64)
+    with stage('estimate'):
+        price_log = np.log(np.asarray(prices, dtype=np.float64))
+        rtn = price_log[:-1] - price_log[1:]
+        # Centre the returns first so the running sums stay small and the covariances keep their precision
+        shift = rtn.mean(axis=0)
+        centred = rtn - shift
+        nwindows = max(len(centred) - window_days + 1, 0)
+        ndates = nwindows if ndates is None else max(min(int(ndates), nwindows), 0)
+        # Window j holds the returns j .. j+window_days-1
+        zeros = np.zeros((1, centred.shape[1]))
+        csum = np.concatenate([zeros, np.cumsum(centred, axis=0)])
+        cross = np.concatenate([zeros, np.cumsum(centred * np.dot(centred, weight)[:, None], axis=0)])
+        mean = (csum[window_days:window_days + ndates] - csum[:ndates]) / window_days
+        mean_p = np.dot(mean, weight)
+        cov_w = (cross[window_days:window_days + ndates] - cross[:ndates]) / window_days - mean * mean_p[:, None]
+        var_p = np.dot(cov_w, weight)
+    return rtn, mean + shift, cov_w, var_p
+
+# Daily mean and standard deviation of the log return of each candidate portfolio. weights is (m, k): the fraction
+# of v0 held in each of the k assets, kept constant; mubar (k,) and cov (k, k) come from multi_asset_est.
+def portfolio_moments(weights, mubar, cov):
+    weights = np.atleast_2d(np.asarray(weights, dtype=np.float64))
+    mubar_p = np.dot(weights, mubar)
+    var_p = np.sum(np.dot(weights, cov) * weights, axis=1)
+    return weights, mubar_p, np.sqrt(np.maximum(var_p, 0))
+
+# Calculate VaR and ES using parametric method from the daily mean and standard deviation of the log return
+def daily_parametric(v0, mubar, sigmabar, VaR_prob, ES_prob, horizon):
+    sigma = sigmabar / np.sqrt(1/252)
+    mu = mubar*252 + np.square(sigma)/2
+    return parametric(v0, mu, sigma, VaR_prob, ES_prob, horizon)
+
+# Calculate VaR and ES of many candidate portfolios at once using the parametric method; results are (m,)
+def portfolio_parametric(v0, weights, mubar, cov, VaR_prob, ES_prob, horizon):
+    weights, mubar_p, sigmabar_p = portfolio_moments(weights, mubar, cov)
+    return daily_parametric(v0, mubar_p, sigmabar_p, VaR_prob, ES_prob, horizon)
+
+# Matrix L with L L' = cov; falls back to clipped eigenvalues when cov is only positive semi-definite
+def covariance_factor(cov):
+    try:
+        return np.linalg.cholesky(cov)
+    except np.linalg.LinAlgError:
+        eigval, eigvec = np.linalg.eigh(cov)
+        return eigvec * np.sqrt(np.maximum(eigval, 0))
+
+# Calculate VaR and ES of many candidate portfolios on one date using Monte Carlo with correlated GBM assets.
+# mubar (k,) and cov (k, k) come from multi_asset_est; the same npaths draws are shared by all candidates and
+# the candidate values come from one matrix product per block of block_size candidates.
+def portfolio_monte_carlo(v0, weights, mubar, cov, VaR_prob, ES_prob, horizon, npaths=5000, seed=None, block_size=256):
+    weights = np.atleast_2d(np.asarray(weights, dtype=np.float64))
+    rng = np.random.Generator(np.random.PCG64(np.random.SeedSequence(seed)))
+    z = rng.standard_normal((npaths, len(mubar)))
+    asset_log = np.asarray(mubar) * 252 * horizon + np.sqrt(252 * horizon) * np.dot(z, covariance_factor(cov).T)
+    gross = np.exp(asset_log)
+    var_index = int(np.ceil((1-VaR_prob)*npaths)) - 1
+    es_count = int(np.ceil((1-ES_prob)*npaths))
+    VaR = np.empty(len(weights))
+    ES = np.empty(len(weights))
+    for start in range(0, len(weights), block_size):
+        stop = min(start + block_size, len(weights))
+        values = np.partition(v0 * np.dot(weights[start:stop], gross.T), sorted(set([var_index, es_count - 1])), axis=1)
+        VaR[start:stop] = v0 - values[:, var_index]
+        ES[start:stop] = v0 - np.mean(values[:, :es_count], axis=1)
+    return VaR, ES
+
+# Parametric VaR of one portfolio split by asset on every date of portfolio_rolling_est, from its mubar, cov_w and
+# var_p. marginal is the derivative of VaR with respect to each weight and component shares VaR out in proportion to
+# w_i * d(log return quantile)/dw_i, which sums to the whole quantile because the quantile is homogeneous of degree
+# one in the weights; the components therefore add up to VaR.
+def component_var(v0, weight, mubar, cov_w, var_p, VaR_prob, horizon):
+    weight = np.asarray(weight, dtype=np.float64)
+    mubar_p = np.dot(mubar, weight)
+    sigmabar_p = np.sqrt(np.maximum(var_p, 0))
+    z = scipy.special.ndtri(1-VaR_prob)
+    quantile = z * np.sqrt(horizon*252) * sigmabar_p + mubar_p * 252 * horizon
+    dsigma = cov_w / sigmabar_p[..., None]
+    dquantile = z * np.sqrt(horizon*252) * dsigma + np.asarray(mubar) * 252 * horizon
+    VaR = v0 - v0 * np.exp(quantile)
+    marginal = -v0 * np.exp(quantile)[..., None] * dquantile
+    component = VaR[..., None] * weight * dquantile / quantile[..., None]
+    return VaR, marginal, component
+
+# Calculate VaR and ES of one price series with the named method. sampling overrides the samples of the simulation
+# methods ('pseudo', 'sobol' or 'lhs'); with stderr their standard errors are returned too (NaN for other methods).
+def compute_risk(v0, price, VaR_prob, ES_prob, method, window, horizon, seed=None, sampling=None, stderr=False):
+    VaR_stderr = ES_stderr = None
     if method == 'Parametric VaR/ES':
         rtn, mu, sigma, mubar, sigmabar = gbm_est(price, window*252)
-        VaR, ES = parametric(v0, mu, sigma, VaR_prob, ES_prob, horizon)
+        with stage('kernel'):
+            VaR, ES = parametric(v0, mu, sigma, VaR_prob, ES_prob, horizon)
     elif method == 'Historical VaR/ES':
-        VaR, ES = historical(v0, price, VaR_prob, ES_prob, int(window*252), int(horizon*252))
+        with stage('kernel'):
+            VaR, ES = historical(v0, price, VaR_prob, ES_prob, int(window*252), int(horizon*252))
     elif method == 'Monte Carlo VaR/ES':
         rtn, mu, sigma, mubar, sigmabar = gbm_est(price, window*252)
-        VaR, ES = monte_carlo(v0, price, mu, sigma, VaR_prob, ES_prob, window*252, horizon)
+        with stage('kernel'):
+            VaR, ES, VaR_stderr, ES_stderr = monte_carlo(v0, price, mu, sigma, VaR_prob, ES_prob, window*252, horizon,
+                                                         seed=seed, n_workers=MC_WORKERS, sampling=sampling or 'pseudo',
+                                                         stderr=True)
+    elif method == 'Quasi-Monte Carlo VaR/ES':
+        rtn, mu, sigma, mubar, sigmabar = gbm_est(price, window*252)
+        with stage('kernel'):
+            VaR, ES, VaR_stderr, ES_stderr = monte_carlo(v0, price, mu, sigma, VaR_prob, ES_prob, window*252, horizon,
+                                                         npaths=QMC_PATHS, seed=seed, n_workers=MC_WORKERS,
+                                                         sampling=sampling or QMC_SAMPLING, replicates=QMC_REPLICATES,
+                                                         stderr=True)
     else:
-        sys.exit('Error!')        
+        raise ValueError('Unknown risk method: %s' % method)
+    observe_size('scenarios', len(VaR))
+    if stderr:
+        if VaR_stderr is None:
+            VaR_stderr = ES_stderr = np.full(len(VaR), np.nan)
+        return VaR, ES, VaR_stderr, ES_stderr
+    return VaR, ES
+
+# VaR/ES plot
+def plot_risk(v0, price, VaR_prob, ES_prob, method, window, horizon, plot_length, seed=None):
+    from bokeh.plotting import figure
+    from bokeh.layouts import row
+    VaR, ES = compute_risk(v0, price, VaR_prob, ES_prob, method, window, horizon, seed)
     length = min(len(VaR), len(ES), plot_length)
     VaR_ES = pd.DataFrame({'VaR': VaR[:length], 'ES': ES[:length]}, index = price.index[:plot_length])
-    output_file = 'outputs/%s_%s_%s_%s.csv' % (method.replace(" VaR/ES", "").replace(" ", "_"), price.name, 
-                                               VaR_ES.index[-1].date(), VaR_ES.index[0].date())
-    VaR_ES.to_csv(output_file)
-    plot = figure(width=600, height=400,
-                  title = "%s_%s VaR/ES" % (method.replace(" VaR/ES", "").replace(" ", "_"), price.name),
-                  x_axis_type="datetime")
-    plot.line(VaR_ES.index, VaR_ES['VaR'], color = 'orange', legend = 'VaR')
-    plot.line(VaR_ES.index, VaR_ES['ES'], color = 'green', legend = 'ES')
-    plot.legend.location = 'top_left'
-    plot.legend.background_fill_alpha = 0.5
-    plot.title.text_font_size = '12pt'    
-    share_change = np.divide(price[:(len(price)-int(horizon*252))], price[int(horizon*252):])
-    loss = v0 - share_change * v0
-    length_loss = min(len(loss), len(VaR), plot_length)
-    test = pd.DataFrame({'VaR': VaR[int(horizon*252):length_loss], 'Loss': loss[:(length_loss-int(horizon*252))]},
-                   index = price.index[int(horizon*252):length_loss])  
-    plot_test = figure(width=600, height=400,
-                       title = "%s_%s VaR/ActualLoss" % (method.replace(" VaR/ES", "").replace(" ", "_"), price.name),
-                       x_axis_type="datetime")
-    plot_test.line(test.index, test['VaR'], color = 'orange', legend = 'VaR')
-    plot_test.line(test.index, test['Loss'], color = 'green', legend = 'Actual Loss')
-    plot_test.legend.location = 'top_left'
-    plot_test.legend.background_fill_alpha = 0.5
-    plot_test.title.text_font_size = '12pt'
-    plots = row(plot,plot_test)
-    return plots, output_file
+    download = download_entry('%s_%s_%s_%s' % (method.replace(" VaR/ES", "").replace(" ", "_"), price.name,
+                                               VaR_ES.index[-1].date(), VaR_ES.index[0].date()), VaR_ES)
+    with stage('figure'):
+        plot = figure(width=600, height=400,
+                      title = "%s_%s VaR/ES" % (method.replace(" VaR/ES", "").replace(" ", "_"), price.name),
+                      x_axis_type="datetime")
+        plot_line(plot, VaR_ES.index, VaR_ES['VaR'], color = 'orange', legend = 'VaR')
+        plot_line(plot, VaR_ES.index, VaR_ES['ES'], color = 'green', legend = 'ES')
+        plot.legend.location = 'top_left'
+        plot.legend.background_fill_alpha = 0.5
+        plot.title.text_font_size = '12pt'    
+        share_change = np.divide(price[:(len(price)-int(horizon*252))], price[int(horizon*252):])
+        loss = v0 - share_change * v0
+        length_loss = min(len(loss), len(VaR), plot_length)
+        test = pd.DataFrame({'VaR': VaR[int(horizon*252):length_loss], 'Loss': loss[:(length_loss-int(horizon*252))]},
+                       index = price.index[int(horizon*252):length_loss])  
+        plot_test = figure(width=600, height=400,
+                           title = "%s_%s VaR/ActualLoss" % (method.replace(" VaR/ES", "").replace(" ", "_"), price.name),
+                           x_axis_type="datetime")
+        plot_line(plot_test, test.index, test['VaR'], color = 'orange', legend = 'VaR')
+        plot_line(plot_test, test.index, test['Loss'], color = 'green', legend = 'Actual Loss')
+        plot_test.legend.location = 'top_left'
+        plot_test.legend.background_fill_alpha = 0.5
+        plot_test.title.text_font_size = '12pt'
+        plots = row(plot,plot_test)
+    return plots, download, VaR_ES
+
+# VaR/ES plot for a portfolio from per-asset covariances, with the component VaR of each ticker
+def plot_risk_covariance(v0, prices, weights, VaR_prob, ES_prob, window, horizon, plot_length):
+    from bokeh.plotting import figure
+    from bokeh.layouts import row
+    name = 'Portfolio_%s' % '_'.join(prices.columns)
+    rtn, mubar, cov_w, var_p = portfolio_rolling_est(prices, weights, window*252, plot_length)
+    with stage('kernel'):
+        VaR, ES = daily_parametric(v0, np.dot(mubar, weights), np.sqrt(np.maximum(var_p, 0)), VaR_prob, ES_prob, horizon)
+        VaR_c, marginal, component = component_var(v0, weights, mubar, cov_w, var_p, VaR_prob, horizon)
+    length = min(len(VaR), plot_length)
+    data = {'VaR': VaR[:length], 'ES': ES[:length]}
+    for i, ticker in enumerate(prices.columns):
+        data['Component_%s' % ticker] = component[:length, i]
+        data['Marginal_%s' % ticker] = marginal[:length, i]
+    VaR_ES = pd.DataFrame(data, index = prices.index[:length])
+    download = download_entry('Covariance_%s_%s_%s' % (name, VaR_ES.index[-1].date(), VaR_ES.index[0].date()), VaR_ES)
+    with stage('figure'):
+        plot = figure(width=600, height=400, title = "Covariance_%s VaR/ES" % name, x_axis_type="datetime")
+        plot_line(plot, VaR_ES.index, VaR_ES['VaR'], color = 'orange', legend = 'VaR')
+        plot_line(plot, VaR_ES.index, VaR_ES['ES'], color = 'green', legend = 'ES')
+        plot.legend.location = 'top_left'
+        plot.legend.background_fill_alpha = 0.5
+        plot.title.text_font_size = '12pt'
+        tickers = list(prices.columns)
+        plot_component = figure(width=600, height=400, x_range = tickers,
+                                title = "Covariance_%s Component VaR on %s" % (name, VaR_ES.index[0].date()))
+        plot_component.vbar(x = tickers, top = component[0], width = 0.5, color = 'orange')
+        plot_component.title.text_font_size = '12pt'
+        plots = row(plot, plot_component)
+    return plots, download, VaR_ES
+
+##################  Incremental risk ##################
+
+# Key of the rolling state of the series called name in incremental_store
+def incremental_key(name, window, horizon, VaR_prob, ES_prob):
+    return result_cache.key('incremental', [name, int(window*252), int(horizon*252), VaR_prob, ES_prob])
+
+# VaR and ES of the most recent date of price (most recent first) from the rolling state stored under name, which
+# only appends the dates after the stored state. Monte Carlo uses the sorted common shocks of monte_carlo
+# (common_shocks=True) drawn from seed, or MC_SEED, so the result can be checked against a full recomputation.
+# Also returns the number of dates appended (None when the state was rebuilt).
+def latest_risk(v0, price, VaR_prob, ES_prob, method, window, horizon, name, seed=None):
+    window_days, horizon_days = int(window*252), int(horizon*252)
+    with stage('estimate'):
+        state, appended = incremental_store.update(incremental_key(name, window, horizon, VaR_prob, ES_prob),
+                                                   price.sort_index(), window_days, horizon_days, VaR_prob, ES_prob)
+    with stage('kernel'):
+        if method == 'Historical VaR/ES':
+            VaR, ES = state.historical(v0)
+        elif method in ('Parametric VaR/ES', 'Monte Carlo VaR/ES'):
+            mubar, sigmabar = state.estimates()
+            sigma = sigmabar / np.sqrt(1/252)
+            mu = mubar*252 + np.square(sigma)/2
+            if method == 'Parametric VaR/ES':
+                VaR, ES = parametric(v0, mu, sigma, VaR_prob, ES_prob, horizon)
+            else:
+                VaR, ES = monte_carlo(v0, price[:window_days+1], [mu], [sigma], VaR_prob, ES_prob, window_days, horizon,
+                                      seed=MC_SEED if seed is None else seed, common_shocks=True)
+                VaR, ES = VaR[0], ES[0]
+        else:
+            raise ValueError('Incremental risk is not available for %s' % method)
+    return float(VaR), float(ES), appended
+
+# VaR and ES of the most recent date of price recomputed from the full history, to check latest_risk against
+def full_latest_risk(v0, price, VaR_prob, ES_prob, method, window, horizon, seed=None):
+    if method == 'Monte Carlo VaR/ES':
+        rtn, mu, sigma, mubar, sigmabar = gbm_est(price, window*252)
+        VaR, ES = monte_carlo(v0, price, mu, sigma, VaR_prob, ES_prob, window*252, horizon,
+                              seed=MC_SEED if seed is None else seed, common_shocks=True)
+    else:
+        VaR, ES = compute_risk(v0, price, VaR_prob, ES_prob, method, window, horizon)
+    return float(VaR[0]), float(ES[0])
+
+##################  Backtesting ##################
+
+# Historical VaR at every level of VaR_probs, shape (len(VaR_probs), ntrials); each block of scenarios is partitioned
+# once at all the quantile positions
+def historical_var_levels(v0, price, VaR_probs, window_days, horizon_days, block_size=256):
+    scenarios = historical_scenarios(v0, price, window_days, horizon_days)
+    npaths, ntrials = scenarios.shape
+    var_indices = np.ceil((1-np.asarray(VaR_probs))*npaths).astype(int) - 1
+    VaR = np.empty((len(var_indices), ntrials))
+    for start in range(0, ntrials, block_size):
+        stop = min(start + block_size, ntrials)
+        block = np.partition(scenarios[:, start:stop], sorted(set(var_indices)), axis=0)
+        VaR[:, start:stop] = v0 - block[var_indices]
+    return VaR
+
+# VaR of one method and window (years) at every level of VaR_probs for a horizon in days, shape (len(VaR_probs), dates),
+# most recent date first for every method. Rolling estimates come from rolling_cache, so every horizon and level of a window shares them. Monte Carlo uses
+# the sorted common shocks of monte_carlo (common_shocks=True), shared by all dates, windows, horizons and levels.
+def backtest_var(v0, price, method, window, horizon_days, VaR_probs, shocks):
+    VaR_probs = np.asarray(VaR_probs, dtype=np.float64)
+    if method == 'Historical VaR/ES':
+        return historical_var_levels(v0, price, VaR_probs, int(window*252), horizon_days)
+    rtn, mu, sigma, mubar, sigmabar = gbm_est(price, window*252)
+    horizon = horizon_days/252
+    if method == 'Parametric VaR/ES':
+        return parametric(v0, mu, sigma, VaR_probs[:, None], 0.975, horizon)[0]
+    if method == 'Monte Carlo VaR/ES':
+        ntrials = max(len(price) - int(window*252), 0)
+        mu, sigma = mu[:ntrials], sigma[:ntrials]
+        bm = np.sqrt(horizon) * shocks[np.ceil((1-VaR_probs)*len(shocks)).astype(int) - 1]
+        return v0 - v0 * np.exp(-(mu + sigma*sigma/2) * horizon) * np.exp(np.outer(bm, sigma))
+    raise ValueError('Unknown risk method: %s' % method)
+
+# Kupiec proportion-of-failures, Christoffersen independence and conditional coverage likelihood ratios with their
+# p-values, for every row of hits (grid points x dates, in date order) where valid marks the dates a row covers and
+# p is the expected exceedance rate of each row
+def coverage_tests(hits, valid, p):
+    xlogy = scipy.special.xlogy
+    hits = hits & valid
+    T = valid.sum(axis=1)
+    x = hits.sum(axis=1)
+    rate = x / np.maximum(T, 1)
+    lr_pof = -2 * (xlogy(T-x, 1-p) + xlogy(x, p) - xlogy(T-x, 1-rate) - xlogy(x, rate))
+    pairs = valid[:, :-1] & valid[:, 1:]
+    before, after = hits[:, :-1], hits[:, 1:]
+    n00 = np.sum(pairs & ~before & ~after, axis=1)
+    n01 = np.sum(pairs & ~before & after, axis=1)
+    n10 = np.sum(pairs & before & ~after, axis=1)
+    n11 = np.sum(pairs & before & after, axis=1)
+    pi01 = n01 / np.maximum(n00 + n01, 1)
+    pi11 = n11 / np.maximum(n10 + n11, 1)
+    pi = (n01 + n11) / np.maximum(n00 + n01 + n10 + n11, 1)
+    lr_ind = -2 * (xlogy(n00 + n10, 1-pi) + xlogy(n01 + n11, pi)
+                   - xlogy(n00, 1-pi01) - xlogy(n01, pi01) - xlogy(n10, 1-pi11) - xlogy(n11, pi11))
+    return {'Observations': T, 'Exceedances': x, 'Expected': p * T, 'Exceedance rate': np.where(T > 0, rate, np.nan),
+            'Kupiec LR': lr_pof, 'Kupiec p-value': scipy.special.chdtrc(1, lr_pof),
+            'Christoffersen LR': lr_ind, 'Christoffersen p-value': scipy.special.chdtrc(1, lr_ind),
+            'Conditional coverage LR': lr_pof + lr_ind, 'Conditional coverage p-value': scipy.special.chdtrc(2, lr_pof + lr_ind)}
+
+# Backtest every combination of methods, windows (years), horizons (days) and VaR_probs on one price series (most
+# recent first) in one call. As in plot_risk, the VaR of date i is compared with the loss over the horizon that starts
+# there, over the plot_length most recent dates. Returns one row per grid point with exceedance counts and coverage
+# tests. Losses over overlapping multi-day horizons are autocorrelated, which the independence test will pick up.
+def backtest_grid(v0, price, methods, windows, horizons, VaR_probs, plot_length=None, npaths=5000, seed=None):
+    VaR_probs = np.asarray(VaR_probs, dtype=np.float64)
+    values = np.asarray(price, dtype=np.float64)
+    plot_length = len(values) if plot_length is None else plot_length
+    shocks = np.sort(np.random.Generator(np.random.PCG64(np.random.SeedSequence(seed))).standard_normal(npaths))
+    rows, hits, valid = [], [], []
+    for horizon_days in horizons:
+        horizon_days = int(horizon_days)
+        loss = v0 - v0 * values[:len(values)-horizon_days] / values[horizon_days:]
+        for method in methods:
+            for window in windows:
+                with stage('kernel'):
+                    VaR = backtest_var(v0, price, method, window, horizon_days, VaR_probs, shocks)
+                # Every method has one VaR per date from the most recent back to the first full window
+                length = max(min(len(loss), VaR.shape[1], plot_length), horizon_days)
+                # Oldest date first, as the independence test counts transitions forward in time
+                forecast = VaR[:, horizon_days:length][:, ::-1]
+                realized = loss[:length-horizon_days][::-1]
+                for level in range(len(VaR_probs)):
+                    rows.append((method, window, horizon_days, VaR_probs[level]))
+                    hits.append(realized > forecast[level])
+                    valid.append(np.isfinite(forecast[level]))
+    dates = max([len(row) for row in hits] + [0])
+    hits_matrix = np.zeros((len(rows), dates), dtype=bool)
+    valid_matrix = np.zeros((len(rows), dates), dtype=bool)
+    for i in range(len(rows)):
+        hits_matrix[i, :len(hits[i])] = hits[i]
+        valid_matrix[i, :len(valid[i])] = valid[i]
+    summary = pd.DataFrame(rows, columns=['Method', 'Window (years)', 'Horizon (days)', 'VaR probability'])
+    tests = coverage_tests(hits_matrix, valid_matrix, 1 - summary['VaR probability'].values)
+    for column in ['Observations', 'Exceedances', 'Expected', 'Exceedance rate', 'Kupiec LR', 'Kupiec p-value',
+                   'Christoffersen LR', 'Christoffersen p-value', 'Conditional coverage LR',
+                   'Conditional coverage p-value']:
+        summary[column] = tests[column]
+    return summary
 
 # Black Scholes method to calculate put option price
+# scipy.special.ndtr is the normal CDF without the argument checking of scipy.stats.norm.cdf, which dominates on large
+# arrays; ndtri and chdtrc stand in for norm.ppf and chi2.sf in the same way elsewhere
 def bs_put(stock, rf, sigma, strike, maturity):
     sigrt = 1/(sigma*np.sqrt(maturity))
     sig2 = sigma*sigma/2
@@ -186,58 +746,628 @@ def bs_put(stock, rf, sigma, strike, maturity):
     ert = np.exp(-rf*maturity)
     d1 = sigrt*(lsk+(rf+sig2)*maturity)
     d2 = sigrt*(lsk+(rf-sig2)*maturity)
-    pr = stat.norm.cdf(-d2)*strike*ert-stat.norm.cdf(-d1)*stock
+    pr = scipy.special.ndtr(-d2)*strike*ert-scipy.special.ndtr(-d1)*stock
     return pr
 
+# Black Scholes price of calls (where call is True) or puts; all arguments broadcast against each other
+def bs_price(stock, rf, sigma, strike, maturity, call=False):
+    sign = np.where(call, 1.0, -1.0)
+    sigrt = 1/(sigma*np.sqrt(maturity))
+    lsk = np.log(stock/strike)
+    d1 = sigrt*(lsk+(rf+sigma*sigma/2)*maturity)
+    d2 = d1 - sigma*np.sqrt(maturity)
+    return sign*(scipy.special.ndtr(sign*d1)*stock - scipy.special.ndtr(sign*d2)*strike*np.exp(-rf*maturity))
+
+# Black Scholes Greeks of one call (where call is True) or put: delta and gamma per share, vega and rho per unit of
+# volatility and rate, theta per year
+def bs_greeks(stock, rf, sigma, strike, maturity, call=False):
+    sign = np.where(call, 1.0, -1.0)
+    sqrt_t = np.sqrt(maturity)
+    d1 = (np.log(stock/strike)+(rf+sigma*sigma/2)*maturity)/(sigma*sqrt_t)
+    d2 = d1 - sigma*sqrt_t
+    pdf = np.exp(-d1*d1/2)/np.sqrt(2*np.pi)
+    ert = np.exp(-rf*maturity)
+    return {'Delta': sign*scipy.special.ndtr(sign*d1),
+            'Gamma': pdf/(stock*sigma*sqrt_t),
+            'Vega': stock*pdf*sqrt_t,
+            'Theta': -stock*pdf*sigma/(2*sqrt_t) - sign*rf*strike*ert*scipy.special.ndtr(sign*d2),
+            'Rho': sign*strike*maturity*ert*scipy.special.ndtr(sign*d2)}
+
 # MC method to calculate option portfolio VaR
 # Compute MC VaR for portfolio of a stock and a put option. % the stocks, assuming option implied vols are unchanged.
-def option_mc(s0, mu, sigma, rf, iv, strike, mat, nstocks, nputs, VaR_prob, horizon):
-    npaths = 1000000
-    tv = np.ones(shape =(npaths,1))*horizon
-    bm = np.sqrt(horizon) * np.random.randn(npaths,1)
-    st = s0 * np.exp(sigma * bm - (mu + sigma*sigma/2) * tv)
-    vtStock = st * nstocks
+# Paths are simulated chunk_size at a time and the VaR is the quantile of the losses of all paths pooled; every chunk
+# also gives its own VaR estimate, and the spread of those batch means is the standard error. With tol the run stops
+# as soon as the 95% confidence half-width is below tol * VaR. antithetic pairs every shock with its negative;
+# control_variate corrects the VaR by beta times the error of the stock-only VaR, whose exact value is known in closed
+# form, with beta fitted on min_chunks pilot chunks that are not part of the estimate so it does not bias it.
+# With Sobol or Latin hypercube sampling every chunk is an independent randomization, so the spread of the chunk
+# estimates is the randomized quasi-Monte Carlo error; Sobol chunks should be a power of two.
+def option_mc(s0, mu, sigma, rf, iv, strike, mat, nstocks, nputs, VaR_prob, horizon, npaths=1000000, chunk_size=50000,
+              antithetic=False, control_variate=False, tol=None, min_chunks=8, seed=None, sampling='pseudo'):
+    rng = np.random.Generator(np.random.PCG64(np.random.SeedSequence(seed)))
     v0Stock = s0 * nstocks
-    putt = bs_put(st, rf, iv, strike, mat-horizon)
-    vtPut = nputs * putt
     put0 = bs_put(s0, rf, iv, strike, mat)
     v0Put = nputs * put0
-    loss = v0Stock + v0Put - (vtStock + vtPut)
-    VaR = np.percentile(loss, 100*VaR_prob)
-    return VaR
+    # The stock-only loss decreases with the shock, so its VaR sits at the (1-VaR_prob) quantile of the shock
+    VaR_stock = v0Stock - v0Stock * np.exp(sigma * np.sqrt(horizon) * scipy.special.ndtri(1-VaR_prob) - (mu + sigma*sigma/2) * horizon)
+    # Losses of the portfolio and of the stock alone on one chunk of paths
+    def simulate(n):
+        if antithetic:
+            z = normal_samples(rng, max(n // 2, 1), sampling)
+            z = np.concatenate([z, -z])
+        else:
+            z = normal_samples(rng, n, sampling)
+        st = s0 * np.exp(sigma * np.sqrt(horizon) * z - (mu + sigma*sigma/2) * horizon)
+        return v0Stock + v0Put - (st * nstocks + nputs * bs_put(st, rf, iv, strike, mat-horizon)), v0Stock - st * nstocks
+    beta = 0.0
+    paths_used = 0
+    if control_variate:
+        pilot = [simulate(chunk_size) for _ in range(max(min_chunks, 2))]
+        beta = control_beta([np.percentile(loss, 100*VaR_prob) for loss, stock_loss in pilot],
+                            [np.percentile(stock_loss, 100*VaR_prob) - VaR_stock for loss, stock_loss in pilot])
+        paths_used += sum(len(loss) for loss, stock_loss in pilot)
+    losses = []
+    stock_losses = []
+    estimates = []
+    controls = []
+    npaths_est = 0
+    while npaths_est < npaths:
+        loss, stock_loss = simulate(min(chunk_size, npaths - npaths_est))
+        losses.append(loss)
+        estimates.append(np.percentile(loss, 100*VaR_prob))
+        if control_variate:
+            stock_losses.append(stock_loss)
+            controls.append(np.percentile(stock_loss, 100*VaR_prob) - VaR_stock)
+        npaths_est += len(loss)
+        mean, stderr = combine_chunk_estimates(estimates, controls, beta)
+        if tol is not None and len(estimates) >= min_chunks and 1.96 * stderr <= tol * abs(mean):
+            break
+    VaR = np.percentile(np.concatenate(losses), 100*VaR_prob)
+    if control_variate:
+        VaR -= beta * (np.percentile(np.concatenate(stock_losses), 100*VaR_prob) - VaR_stock)
+    return VaR, paths_used + npaths_est, stderr
 
-# Option portfolio calculations
-def options_cal(options, rf, mat, imp_vol, v0, liq_rate, VaR_prob, window, horizon):
-    rtn, mu, sigma, mubar, sigmabar = gbm_est(options, window*252)
-    mu = mu[0]
-    sigma = sigma[0]
+# Control variate coefficient of per-chunk estimates on per-chunk control errors, 0 when the controls do not vary
+def control_beta(estimates, controls):
+    controls = np.asarray(controls, dtype=np.float64)
+    if len(controls) < 2 or np.var(controls) == 0:
+        return 0.0
+    return np.cov(estimates, controls)[0, 1] / np.var(controls, ddof=1)
+
+# Mean and batch-means standard error of per-chunk estimates, corrected by beta times per-chunk control errors
+def combine_chunk_estimates(estimates, controls, beta=0.0):
+    estimates = np.asarray(estimates, dtype=np.float64)
+    if len(controls) == len(estimates):
+        estimates = estimates - beta * np.asarray(controls, dtype=np.float64)
+    if len(estimates) < 2:
+        return estimates.mean(), np.inf
+    return estimates.mean(), estimates.std(ddof=1) / np.sqrt(len(estimates))
+
+# Option portfolio risk: hedge liq_rate of the position with at-the-money puts and compare the VaR
+def options_risk(options, rf, mat, imp_vol, v0, liq_rate, VaR_prob, window, horizon, seed=None, sampling='pseudo'):
+    mu, sigma = latest_gbm_est(options, window*252)
     VaR_1, ES_1 = parametric(v0, mu, sigma, VaR_prob, 0.975, horizon)
-    s0 = options[0]
-    strike = options[0]
+    s0 = options.iloc[0]
+    strike = options.iloc[0]
     nstocks = v0 * (1-liq_rate) / s0
     put0 = bs_put(s0, rf, imp_vol, strike, mat)
     nputs = v0 * liq_rate / put0
-    VaR_2 = option_mc(s0, mu, sigma, rf, imp_vol, strike, mat, nstocks, nputs, VaR_prob, horizon)
+    with stage('kernel'):
+        VaR_2, npaths_2, stderr_2 = option_mc(s0, mu, sigma, rf, imp_vol, strike, mat, nstocks, nputs, VaR_prob, horizon,
+                                              chunk_size=10000 if sampling == 'pseudo' else 8192, antithetic=True,
+                                              control_variate=True, tol=0.001, seed=seed, sampling=sampling)
+    observe_size('paths', npaths_2)
     reduction = 100*(1-VaR_2/VaR_1)
+    return s0, nstocks, put0, nputs, VaR_1, VaR_2, reduction, npaths_2, stderr_2
+
+# Option portfolio calculations
+def options_cal(options, rf, mat, imp_vol, v0, liq_rate, VaR_prob, window, horizon, seed=None):
+    s0, nstocks, put0, nputs, VaR_1, VaR_2, reduction, npaths_2, stderr_2 = options_risk(options, rf, mat, imp_vol, v0,
+                                                                                        liq_rate, VaR_prob, window, horizon,
+                                                                                        seed)
     print_list = ["Stock price: %s" % s0,
                   "Stock shares: %s" % nstocks,
                   "Put price on one share: %s" % put0,
                   "Put shares: %s" % nputs,
                   "VaR without options: %s" % VaR_1,
                   "VaR with options: %s" % VaR_2,
-                  "VaR reduction (percentage): %s" % reduction]
-    output_file = 'outputs/options_%s_%s.csv' % (options.name, options.index[0].date())
-    pd.DataFrame(print_list).to_csv(output_file, header=False)
-    return s0, nstocks, put0, nputs, VaR_1, VaR_2, reduction, output_file
+                  "VaR reduction (percentage): %s" % reduction,
+                  "Monte Carlo paths used: %s" % npaths_2,
+                  "VaR with options standard error: %s" % stderr_2]
+    download = download_entry('options_%s_%s' % (options.name, options.index[0].date()), pd.DataFrame(print_list),
+                              header=False)
+    return s0, nstocks, put0, nputs, VaR_1, VaR_2, reduction, npaths_2, stderr_2, download
+
+##################  Options grid ##################
+
+# Stock prices after horizon on npaths shared paths, simulated like option_mc
+def terminal_prices(s0, mu, sigma, horizon, npaths=100000, seed=None):
+    z = np.random.Generator(np.random.PCG64(np.random.SeedSequence(seed))).standard_normal(npaths)
+    return s0 * np.exp(sigma * np.sqrt(horizon) * z - (mu + sigma*sigma/2) * horizon)
+
+# VaR reduction surface of hedging a stock position of v0 with puts, over every combination of strikes, maturities
+# (years) and implied_vols, and hedge_ratios (the part of v0 spent on puts, as liq_rate in options_risk), all valued
+# on the same paths st. Every put is repriced on the paths once; the loss of a hedge ratio h is then
+# (1-h) * stock loss + h * put loss, so the ratios cost one percentile each. Puts are repriced block_elements
+# path-values at a time to bound memory. VaR_1 is the VaR without options the reductions are relative to.
+# Returns one row per grid point with the put price and Greeks of one put and the delta of the hedged position.
+def options_grid(s0, st, rf, v0, strikes, maturities, implied_vols, hedge_ratios, VaR_prob, VaR_1, horizon,
+                 block_elements=2**22):
+    strike, mat, iv = [grid.ravel() for grid in np.meshgrid(strikes, maturities, implied_vols, indexing='ij')]
+    ratios = np.asarray(hedge_ratios, dtype=np.float64)[:, None, None]
+    put0 = bs_put(s0, rf, iv, strike, mat)
+    stock_loss = (v0 * (1 - st / s0))[None, :, None]
+    VaR = np.empty((len(ratios), len(strike)))
+    block = max(block_elements // (len(ratios) * len(st)), 1)
+    for start in range(0, len(strike), block):
+        stop = min(start + block, len(strike))
+        put_loss = v0 * (1 - bs_put(st[:, None], rf, iv[start:stop], strike[start:stop], mat[start:stop]-horizon)
+                         / put0[start:stop])
+        VaR[:, start:stop] = np.percentile((1 - ratios) * stock_loss + ratios * put_loss[None], 100*VaR_prob, axis=1)
+    greeks = bs_greeks(s0, rf, iv, strike, mat)
+    nputs = v0 * ratios[:, :, 0] / put0
+    nstocks = v0 * (1 - ratios[:, :, 0]) / s0
+    surface = pd.DataFrame({'Strike': np.tile(strike, len(ratios)), 'Maturity': np.tile(mat, len(ratios)),
+                            'Implied vol': np.tile(iv, len(ratios)), 'Hedge ratio': np.repeat(ratios.ravel(), len(strike)),
+                            'Put price': np.tile(put0, len(ratios)), 'Put shares': nputs.ravel(),
+                            'VaR with options': VaR.ravel(), 'VaR reduction (percentage)': 100*(1-VaR.ravel()/VaR_1)},
+                           columns=['Strike', 'Maturity', 'Implied vol', 'Hedge ratio', 'Put price', 'Put shares',
+                                    'VaR with options', 'VaR reduction (percentage)'])
+    for name in ['Delta', 'Gamma', 'Vega', 'Theta', 'Rho']:
+        surface[name] = np.tile(greeks[name], len(ratios))
+    surface['Position delta'] = (nstocks + nputs * greeks['Delta']).ravel()
+    return surface
+
+# VaR, ES and Greeks of nstocks shares plus option legs, valued on the paths st. Each leg is a dict with 'type'
+# ('put' or 'call'), 'strike', 'maturity' (years), 'implied_vol' and 'quantity' (negative for written options).
+def option_portfolio_risk(s0, st, rf, nstocks, legs, VaR_prob, ES_prob, horizon):
+    call = np.array([leg.get('type', 'put') == 'call' for leg in legs], dtype=bool)
+    strike, mat, iv, quantity = [np.array([float(leg[field]) for leg in legs], dtype=np.float64)
+                                 for field in ['strike', 'maturity', 'implied_vol', 'quantity']]
+    price0 = bs_price(s0, rf, iv, strike, mat, call)
+    value0 = nstocks * s0 + np.dot(quantity, price0)
+    loss = value0 - (nstocks * st + np.dot(bs_price(st[:, None], rf, iv, strike, mat-horizon, call), quantity))
+    VaR = np.percentile(loss, 100*VaR_prob)
+    ES = loss[loss >= np.percentile(loss, 100*ES_prob)].mean()
+    greeks = bs_greeks(s0, rf, iv, strike, mat, call)
+    result = {'value': float(value0), 'VaR': float(VaR), 'ES': float(ES), 'leg_prices': json_floats(price0)}
+    for name in ['Delta', 'Gamma', 'Vega', 'Theta', 'Rho']:
+        result[name.lower()] = float(np.dot(quantity, greeks[name]) + (nstocks if name == 'Delta' else 0))
+    return result
+
+# Options grid of the stock in options (most recent first) on its last date, for strikes given as multiples of the
+# stock price. With legs, also the risk of nstocks shares (v0 worth by default) and those legs on the same paths;
+# legs may give 'moneyness' instead of 'strike'.
+def options_grid_risk(options, rf, v0, moneyness, maturities, implied_vols, hedge_ratios, VaR_prob, window, horizon,
+                      legs=None, nstocks=None, ES_prob=0.975, npaths=100000, seed=None):
+    mu, sigma = latest_gbm_est(options, window*252)
+    VaR_1, ES_1 = parametric(v0, mu, sigma, VaR_prob, 0.975, horizon)
+    s0 = options.iloc[0]
+    with stage('kernel'):
+        st = terminal_prices(s0, mu, sigma, horizon, npaths, seed)
+        surface = options_grid(s0, st, rf, v0, s0 * np.asarray(moneyness, dtype=np.float64), maturities, implied_vols,
+                               hedge_ratios, VaR_prob, VaR_1, horizon)
+        portfolio = None
+        if legs:
+            legs = [dict(leg, strike=leg.get('strike', s0 * float(leg.get('moneyness', 1)))) for leg in legs]
+            portfolio = option_portfolio_risk(s0, st, rf, v0 / s0 if nstocks is None else nstocks, legs, VaR_prob,
+                                              ES_prob, horizon)
+    observe_size('paths', npaths * len(surface))
+    return s0, VaR_1, surface, portfolio
+
+# Default grid of the Hedge Grid button and /api/options; strikes are multiples of the stock price and the button adds
+# the form's own maturity and liquidation rate
+OPTIONS_MONEYNESS = [0.9, 0.95, 1.0, 1.05, 1.1]
+OPTIONS_MATURITIES = [0.25, 0.5, 1.0]
+OPTIONS_HEDGE_RATIOS = [0.005, 0.01, 0.02, 0.05, 0.1]
+
+# Method names accepted by the JSON API in addition to the names used by the html form
+RISK_METHODS = {'parametric': 'Parametric VaR/ES', 'historical': 'Historical VaR/ES',
+                'monte_carlo': 'Monte Carlo VaR/ES', 'quasi_monte_carlo': 'Quasi-Monte Carlo VaR/ES', 'covariance': 'Covariance VaR/ES', 'options': 'Options'}
+
+# Default grid of the Backtest button and /api/backtest; the button adds the form's own window, horizon and level
+BACKTEST_METHODS = ['Parametric VaR/ES', 'Historical VaR/ES', 'Monte Carlo VaR/ES']
+BACKTEST_WINDOWS = [1, 2, 5]
+BACKTEST_HORIZONS = [1, 5, 10]
+BACKTEST_PROBS = [0.95, 0.975, 0.99]
+
+# Floats for json, with NaN and infinities as null
+def json_floats(values):
+    return [float(x) if np.isfinite(x) else None for x in np.asarray(values, dtype=np.float64)]
+
+# JSON records of the rows of a data frame, keeping integers as integers
+def json_records(frame):
+    return [dict((column, value if isinstance(value, str) else int(value) if isinstance(value, (int, np.integer))
+                  else json_floats([value])[0]) for column, value in zip(frame.columns, row))
+            for row in frame.itertuples(index=False)]
+
+# Normalize one JSON API request; missing fields take the defaults of the html form
+def parse_risk_item(item):
+    method = RISK_METHODS.get(item.get('method', 'parametric'), item.get('method'))
+    tickers = item.get('tickers', 'AAPL')
+    tickers_list = tickers if isinstance(tickers, list) else tickers.replace(" ", "").split(",")
+    weights = item.get('weights')
+    if weights is not None and not isinstance(weights, list):
+        weights = [float(weight) for weight in str(weights).split(",")]
+    spec = {'method': method, 'tickers_list': tickers_list, 'weights': weights,
+            'position_date': datetime.datetime.strptime(item.get('position_date', '2000-12-01'), '%Y-%m-%d'),
+            'v0': float(item.get('v0', 1000000 if method == 'Options' else 10000)), 'window': int(item.get('window', 2)),
+            'horizon': float(item.get('horizon', 5))/252, 'var_prob': float(item.get('var_prob', 0.99)),
+            'es_prob': float(item.get('es_prob', 0.975)), 'seed': item.get('seed'), 'sampling': item.get('sampling'),
+            'incremental': bool(item.get('incremental', False)), 'check': bool(item.get('check', False)),
+            'candidates': item.get('candidates')}
+    if spec['candidates'] is not None and (method != 'Covariance VaR/ES' or
+                                           any(len(weights) != len(tickers_list) for weights in spec['candidates'])):
+        raise ValueError('candidates takes weight vectors of one weight per ticker, with the covariance method')
+    if method == 'Options':
+        spec.update({'end_date': spec['position_date'], 'rf': float(item.get('rf', 0.005)),
+                     'mat': float(item.get('mat', 0.5)), 'implied_vol': float(item.get('implied_vol', 0.21)),
+                     'liq_rate': float(item.get('liq_rate', 0.01))})
+    else:
+        spec['end_date'] = datetime.datetime.strptime(item.get('end_date', '2016-12-01'), '%Y-%m-%d')
+    if spec['incremental'] and method not in ('Parametric VaR/ES', 'Historical VaR/ES', 'Monte Carlo VaR/ES'):
+        raise ValueError('Incremental risk is not available for %s' % method)
+    spec['start_date'] = spec['position_date'] - dateutil.relativedelta.relativedelta(years = 10)
+    return spec
+
+# Result of one normalized JSON API request. prices holds at least the request's tickers and dates (most recent
+# first); estimates memoizes covariance estimates between requests of the same batch.
+def risk_item_result(spec, prices, estimates):
+    df = prices[spec['tickers_list']]
+    df = df[(df.index >= spec['start_date']) & (df.index <= spec['end_date'])].dropna(how='all')
+    if spec['method'] == 'Options':
+        options = df.iloc[:, 0].dropna()
+        s0, nstocks, put0, nputs, VaR_1, VaR_2, reduction, npaths, stderr = options_risk(
+            options, spec['rf'], spec['mat'], spec['implied_vol'], spec['v0'], spec['liq_rate'], spec['var_prob'],
+            spec['window'], spec['horizon'], spec['seed'], spec['sampling'] or 'pseudo')
+        return {'date': str(options.index[0].date()), 'stock_price': float(s0), 'stock_shares': float(nstocks),
+                'put_price': float(put0), 'put_shares': float(nputs), 'VaR_without_options': float(VaR_1),
+                'VaR_with_options': float(VaR_2), 'reduction': float(reduction), 'paths': int(npaths),
+                'stderr': json_floats([stderr])[0]}
+    plot_length = len(df[df.index >= spec['position_date']])
+    result = {}
+    if spec['method'] == 'Covariance VaR/ES':
+        weights = spec['weights'] or [1/len(spec['tickers_list'])] * len(spec['tickers_list'])
+        key = (tuple(spec['tickers_list']), tuple(weights), spec['start_date'], spec['end_date'], spec['window'])
+        if key not in estimates:
+            estimates[key] = portfolio_rolling_est(df, weights, spec['window']*252, plot_length)
+        rtn, mubar, cov_w, var_p = estimates[key]
+        with stage('kernel'):
+            VaR, ES = daily_parametric(spec['v0'], np.dot(mubar, weights), np.sqrt(np.maximum(var_p, 0)),
+                                       spec['var_prob'], spec['es_prob'], spec['horizon'])
+            VaR_c, marginal, component = component_var(spec['v0'], weights, mubar, cov_w, var_p, spec['var_prob'],
+                                                       spec['horizon'])
+        result['component'] = dict(zip(spec['tickers_list'], json_floats(component[0])))
+        result['marginal'] = dict(zip(spec['tickers_list'], json_floats(marginal[0])))
+        # Candidate weight vectors screened on the most recent date, parametric and with correlated Monte Carlo paths
+        if spec['candidates'] is not None and len(var_p):
+            candidates = np.asarray(spec['candidates'], dtype=np.float64)
+            key = (tuple(spec['tickers_list']), spec['start_date'], spec['end_date'], spec['window'])
+            if key not in estimates:
+                estimates[key] = multi_asset_est(df, spec['window']*252)
+            rtn, mubar_latest, cov_latest = estimates[key]
+            with stage('kernel'):
+                VaR_p, ES_p = portfolio_parametric(spec['v0'], candidates, mubar_latest, cov_latest, spec['var_prob'],
+                                                   spec['es_prob'], spec['horizon'])
+                VaR_mc, ES_mc = portfolio_monte_carlo(spec['v0'], candidates, mubar_latest, cov_latest,
+                                                      spec['var_prob'], spec['es_prob'], spec['horizon'],
+                                                      seed=spec['seed'])
+            result['candidates'] = {'VaR': json_floats(VaR_p), 'ES': json_floats(ES_p),
+                                    'VaR_monte_carlo': json_floats(VaR_mc), 'ES_monte_carlo': json_floats(ES_mc)}
+    else:
+        if spec['weights'] is not None:
+            price = portfolio_from_prices(df, spec['weights'], spec['v0'], spec['position_date'],
+                                          ",".join(spec['tickers_list'])).iloc[:, 0]
+        else:
+            price = df.iloc[:, 0]
+        if spec['incremental']:
+            return latest_risk_result(spec, price)
+        VaR, ES, VaR_stderr, ES_stderr = compute_risk(spec['v0'], price, spec['var_prob'], spec['es_prob'],
+                                                      spec['method'], spec['window'], spec['horizon'], spec['seed'],
+                                                      spec['sampling'], stderr=True)
+    length = min(len(VaR), len(ES), plot_length)
+    if spec['method'] in ('Monte Carlo VaR/ES', 'Quasi-Monte Carlo VaR/ES') and np.isfinite(VaR_stderr[:length]).any():
+        result.update({'VaR_stderr': json_floats(VaR_stderr[:length]), 'ES_stderr': json_floats(ES_stderr[:length])})
+    result.update({'dates': [str(date.date()) for date in df.index[:length]],
+                   'VaR': json_floats(VaR[:length]), 'ES': json_floats(ES[:length])})
+    return result
+
+# Result of an incremental JSON API request: the VaR and ES of the most recent date only. The rolling state of a
+# portfolio also depends on its weights, value and position date, which fix the number of shares held. With check,
+# the full recomputation is returned next to it and a state that disagrees with it is dropped.
+def latest_risk_result(spec, price):
+    name = [spec['tickers_list'], spec['weights']]
+    if spec['weights'] is not None:
+        name += [spec['v0'], str(spec['position_date'].date())]
+    args = (spec['v0'], price, spec['var_prob'], spec['es_prob'], spec['method'], spec['window'], spec['horizon'])
+    VaR, ES, appended = latest_risk(*args, name=name, seed=spec['seed'])
+    result = {'dates': [str(price.index[0].date())], 'VaR': json_floats([VaR]), 'ES': json_floats([ES]),
+              'appended': appended}
+    if spec['check']:
+        VaR_full, ES_full = full_latest_risk(*args, seed=spec['seed'])
+        agree = bool(np.allclose([VaR, ES], [VaR_full, ES_full], rtol=1e-8, atol=1e-8 * spec['v0']))
+        result['check'] = {'VaR': json_floats([VaR_full])[0], 'ES': json_floats([ES_full])[0], 'agree': agree}
+        if not agree:
+            incremental_store.drop(incremental_key(name, spec['window'], spec['horizon'], spec['var_prob'],
+                                                   spec['es_prob']))
+    return result
+
+# Run a batch of JSON API requests, yielding one result per request as soon as it is done. Prices of every ticker in
+# the batch are fetched together once; rolling GBM estimates are shared through rolling_cache and covariance
+# estimates through a per-batch memo.
+def run_risk_batch(items):
+    specs = []
+    for item in items:
+        try:
+            specs.append(parse_risk_item(item))
+        except Exception as e:
+            specs.append(e)
+    valid = [spec for spec in specs if not isinstance(spec, Exception)]
+    prices = None
+    if valid:
+        tickers_list = sorted(set(ticker for spec in valid for ticker in spec['tickers_list']))
+        try:
+            with stage('fetch'):
+                prices = get_prices(tickers_list, min(spec['start_date'] for spec in valid),
+                                    max(spec['end_date'] for spec in valid))
+        except Exception:
+            prices = None
+    estimates = {}
+    for index, (item, spec) in enumerate(zip(items, specs)):
+        result = {'index': index}
+        if 'id' in item:
+            result['id'] = item['id']
+        try:
+            if isinstance(spec, Exception):
+                raise spec
+            # If the shared fetch failed, fetch this request alone so the error is reported on the request at fault
+            item_prices = prices if prices is not None else get_prices(
+                spec['tickers_list'], spec['start_date'], spec['end_date'])
+            result.update(risk_item_result(spec, item_prices, estimates))
+        except Exception as e:
+            result['error'] = str(e)
+        yield result
+
+# Keep a download entry in result_cache under its id until it is downloaded; identical results share one entry
+def save_download(download):
+    with stage('cache'):
+        if not result_cache.contains(download['id'], 'downloads'):
+            result_cache.put(download['id'], download, 'downloads')
+    return download['id']
+
+# Result of compute() for the given normalized inputs, served from result_cache when it was computed before.
+# compute returns a dict whose 'download' entry has been saved and whose 'output_file' is the id of that entry; on a
+# hit the entry is saved again in case it was evicted. Results reaching today are not cached since today's prices
+# can still change.
+# With background, a miss is computed by a job running the same form submission (see run_form_job) when FORM_JOBS is
+# set; JobPending is raised if it is still running after FORM_JOB_WAIT seconds.
+def cached_result(name, inputs, end_date, compute, background=False):
+    key = result_cache.key(name, inputs)
+    if getattr(form_job, 'active', False):
+        # In a job: compute (or reuse) the result and leave it in result_cache for the request that submitted it
+        result = result_cache.get(key, kind=dict) if end_date.date() < datetime.date.today() else None
+        if result is None or 'download' not in result:
+            result = compute()
+            result_cache.put(key, result)
+        form_job.key = key
+        return result
+    if background and FORM_JOBS:
+        return background_result(key, end_date, compute)
+    if end_date.date() >= datetime.date.today():
+        return compute()
+    with stage('cache'):
+        result = result_cache.get(key, kind=dict)
+    cache_lookup('result', result is not None and 'download' in result)
+    if result is None or 'download' not in result:
+        result = compute()
+        with stage('cache'):
+            result_cache.put(key, result)
+    else:
+        save_download(result['download'])
+    return result
+
+# Raised by cached_result when the job computing a form result has not finished yet
+class JobPending(Exception):
+    def __init__(self, job_id):
+        Exception.__init__(self, job_id)
+        self.job_id = job_id
+
+# Per-thread flag (and result key) of a form submission run by run_form_job
+form_job = threading.local()
+
+# Result of the form submission of this request under key, computed by a background job. A resubmission from the
+# polling page names its finished job in the 'job' field, whose result is read back even for results reaching today.
+def background_result(key, end_date, compute):
+    job = job_queue.get(request.form['job']) if request.form.get('job') else None
+    if job is None or job['status'] != 'done' or job['result'].get('key') != key:
+        if end_date.date() < datetime.date.today():
+            with stage('cache'):
+                result = result_cache.get(key, kind=dict)
+            if result is not None and 'download' in result:
+                cache_lookup('result', True)
+                save_download(result['download'])
+                return result
+        cache_lookup('result', False)
+        form = dict((field, value) for field, value in request.form.items() if field != 'job')
+        job_id, status = job_queue.submit({'form': form})
+        with stage('job'):
+            job = job_queue.wait(job_id, FORM_JOB_WAIT)
+    if job['status'] == 'failed':
+        raise RuntimeError(job.get('error'))
+    if job['status'] != 'done':
+        raise JobPending(job['id'])
+    with stage('cache'):
+        result = result_cache.get(key, kind=dict)
+    if result is None or 'download' not in result:
+        # Evicted since the job finished
+        result = compute()
+        with stage('cache'):
+            result_cache.put(key, result)
+    else:
+        save_download(result['download'])
+    return result
+
+# Run a form submission of /index in this process, as the job submitted by background_result, and return the key of
+# the result it left in result_cache
+def run_form_job(form):
+    form_job.active, form_job.key = True, None
+    try:
+        with app.test_request_context('/index', method='POST', data=form):
+            index()
+    finally:
+        form_job.active = False
+    return {'key': form_job.key}
+
+# Rendered Bokeh components of a plot_* result, together with its download id and data
+def plot_result(div_name, plot, download, data):
+    from bokeh.embed import components
+    with stage('components'):
+        script, div = components({div_name: plot})
+    return {'script': script, 'div': div, 'output_file': save_download(download), 'download': download, 'data': data}
+
+# Streamed download of a result in one of FORMATS. download_id is the id of a saved download entry or, for the
+# defaults of the html form, the name of a csv file shipped in outputs/.
+def download_response(download_id, fmt):
+    if fmt not in FORMATS:
+        return Response(json.dumps({'error': 'Unknown format %s' % fmt}), status=400, mimetype='application/json')
+    if fmt in ('parquet', 'arrow') and not arrow_available():
+        return Response(json.dumps({'error': 'The %s format needs pyarrow' % fmt}), status=501,
+                        mimetype='application/json')
+    if re.match('^[0-9a-f]{64}$', download_id):
+        entry = result_cache.get(download_id, 'downloads', dict)
+    else:
+        entry = bundled_entry(download_id)
+    if entry is None:
+        return Response(json.dumps({'error': 'Unknown or expired result %s, please compute it again' % download_id}),
+                        status=404, mimetype='application/json')
+    mimetype, extension = FORMATS[fmt]
+    return Response(stream_download(entry, fmt), mimetype=mimetype,
+                    headers={'Content-Disposition': 'attachment; filename=%s%s' % (entry['name'], extension)})
 
 ################## Flask & html interaction ##################
 
 app = Flask(__name__)
 
+# Server-Timing headers, /metrics and the ?profile=1 sampling profiler
+metrics.init_app(app)
+
+# flask.render_template, timed as the 'render' stage of the request
+def render_template(*args, **kwargs):
+    with stage('render'):
+        return flask.render_template(*args, **kwargs)
+
+# Page polling the background job of a form submission, which submits the form again once the job is done
+@app.errorhandler(JobPending)
+def job_pending(e):
+    return render_template('job.html', job_id=e.job_id, form=request.form, wait=min(FORM_JOB_WAIT, JOB_WAIT_MAX)), 202
+
 @app.route('/', methods=['GET', 'POST'])
 def main():
     return redirect('/index')
 
+# JSON batch API: POST {"requests": [{...}, ...]} (or just the list) and get one JSON line back per request,
+# streamed in order as each one finishes. No plots are rendered and nothing is written to outputs/.
+@app.route('/api/risk', methods=['POST'])
+def api_risk():
+    body = request.get_json(force=True, silent=True)
+    items = body.get('requests') if isinstance(body, dict) else body
+    if not isinstance(items, list) or not all(isinstance(item, dict) for item in items):
+        return Response(json.dumps({'error': 'Expected a list of request objects'}), status=400,
+                        mimetype='application/json')
+    return Response(flask.stream_with_context(json.dumps(result) + '\n' for result in run_risk_batch(items)),
+                    mimetype='application/x-ndjson')
+
+# Background jobs: POST one request in the /api/risk format and get its job id back right away, then poll
+# GET /jobs/<id>, optionally with ?wait=<seconds> to long-poll until the job is done.
+@app.route('/jobs', methods=['POST'])
+def submit_job():
+    params = request.get_json(force=True, silent=True)
+    if not isinstance(params, dict):
+        return Response(json.dumps({'error': 'Expected a request object'}), status=400, mimetype='application/json')
+    job_id, status = job_queue.submit(params)
+    return Response(json.dumps({'id': job_id, 'status': status}), status=202, mimetype='application/json',
+                    headers={'Location': '/jobs/%s' % job_id})
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    try:
+        wait = float(request.args.get('wait', 0))
+    except ValueError:
+        return Response(json.dumps({'error': 'wait must be a number of seconds'}), status=400,
+                        mimetype='application/json')
+    wait = min(wait, JOB_WAIT_MAX) if wait == wait else 0
+    job = job_queue.wait(job_id, wait) if wait > 0 else job_queue.get(job_id)
+    if job is None:
+        return Response(json.dumps({'error': 'Unknown job %s' % job_id}), status=404, mimetype='application/json')
+    return Response(json.dumps(job), mimetype='application/json')
+
+# Points of a plotted series between start and end (milliseconds since 1970) for the zoom reload of plot_line,
+# decimated to at most points (up to 5000) and sent as base64 float64 arrays
+@app.route('/plot_data/<key>', methods=['GET'])
+def plot_data(key):
+    series = result_cache.get(key, 'series', tuple) if re.match('^[0-9a-f]{64}$', key) else None
+    if series is None:
+        return Response(json.dumps({'error': 'Unknown series %s' % key}), status=404, mimetype='application/json')
+    x, y = series
+    lo, hi = np.searchsorted(x, [float(request.args.get('start', x[0])), float(request.args.get('end', x[-1]))])
+    lo, hi = max(lo - 1, 0), min(hi + 1, len(x))
+    index = lo + lttb(x[lo:hi], y[lo:hi], min(int(request.args.get('points', 600)), 5000))
+    return Response(json.dumps({'x': encode_array(x[index]), 'y': encode_array(y[index])}), mimetype='application/json')
+
+# Backtest grid: POST one request in the /api/risk format, with optional lists "methods", "windows" (years),
+# "horizons" (days) and "var_probs" in place of single values, and get one JSON record per grid point back
+@app.route('/api/backtest', methods=['POST'])
+def api_backtest():
+    item = request.get_json(force=True, silent=True)
+    if not isinstance(item, dict):
+        return Response(json.dumps({'error': 'Expected a request object'}), status=400, mimetype='application/json')
+    try:
+        spec = parse_risk_item(item)
+        methods = [RISK_METHODS.get(method, method) for method in item.get('methods', BACKTEST_METHODS)]
+        df = get_prices(spec['tickers_list'], spec['start_date'], spec['end_date'])
+        if spec['weights'] is not None:
+            price = portfolio_from_prices(df, spec['weights'], spec['v0'], spec['position_date'],
+                                          ",".join(spec['tickers_list'])).iloc[:, 0]
+        else:
+            price = df.iloc[:, 0]
+        summary = backtest_grid(spec['v0'], price, methods, [int(w) for w in item.get('windows', BACKTEST_WINDOWS)],
+                                [int(h) for h in item.get('horizons', BACKTEST_HORIZONS)],
+                                [float(p) for p in item.get('var_probs', BACKTEST_PROBS)],
+                                len(df[df.index >= spec['position_date']]), seed=spec['seed'])
+    except Exception as e:
+        return Response(json.dumps({'error': str(e)}), status=400, mimetype='application/json')
+    return Response(json.dumps(json_records(summary)), mimetype='application/json')
+
+# Options grid: POST one options request in the /api/risk format, with optional lists "moneyness" (strikes as
+# multiples of the stock price), "maturities", "implied_vols" and "hedge_ratios", and optional "legs" of an option
+# portfolio (see option_portfolio_risk) held with "nstocks" shares; all of it is valued on "npaths" shared paths
+@app.route('/api/options', methods=['POST'])
+def api_options():
+    item = request.get_json(force=True, silent=True)
+    if not isinstance(item, dict):
+        return Response(json.dumps({'error': 'Expected a request object'}), status=400, mimetype='application/json')
+    try:
+        spec = parse_risk_item(dict(item, method='options'))
+        options = price_store.get_series(spec['tickers_list'][0], spec['start_date'],
+                                         spec['end_date']).sort_index(ascending = False)
+        s0, VaR_1, surface, portfolio = options_grid_risk(
+            options, spec['rf'], spec['v0'], [float(m) for m in item.get('moneyness', OPTIONS_MONEYNESS)],
+            [float(m) for m in item.get('maturities', [spec['mat']])],
+            [float(v) for v in item.get('implied_vols', [spec['implied_vol']])],
+            [float(h) for h in item.get('hedge_ratios', OPTIONS_HEDGE_RATIOS)], spec['var_prob'], spec['window'],
+            spec['horizon'], legs=item.get('legs'), nstocks=item.get('nstocks'), ES_prob=spec['es_prob'],
+            npaths=int(item.get('npaths', 100000)), seed=spec['seed'])
+    except Exception as e:
+        return Response(json.dumps({'error': str(e)}), status=400, mimetype='application/json')
+    return Response(json.dumps({'date': str(options.index[0].date()), 'stock_price': float(s0),
+                                'VaR_without_options': float(VaR_1), 'surface': json_records(surface),
+                                'portfolio': portfolio}), mimetype='application/json')
+
+# Download of a computed result: GET /download/<id>?format=csv|csv.gz|parquet|arrow
+@app.route('/download/<download_id>', methods=['GET'])
+def download(download_id):
+    return download_response(download_id, request.args.get('format', 'csv'))
+
 @app.route('/index', methods=['GET', 'POST'])
 def index():
     if request.method == 'GET':
@@ -265,10 +1395,10 @@ def index():
                 position_date_1_dt = datetime.datetime.strptime(position_date_1, '%Y-%m-%d')
                 end_date_1 = request.form["end_date_1"]
                 end_date_1_dt = datetime.datetime.strptime(end_date_1, '%Y-%m-%d')
-                df_1, plot_length_1 = create_df_from_tickers(tickers_string_1, position_date_1_dt, end_date_1_dt)
-                plot_1_1, output_file_1 = plot_price(df_1, plot_length_1)
-                plots = {'div_1_1': plot_1_1}
-                script, div = components(plots)
+                result = cached_result('plot_price', [tickers_string_1.replace(" ", ""), position_date_1, end_date_1],
+                                       end_date_1_dt, lambda: plot_result('div_1_1', *plot_price(
+                                           *create_df_from_tickers(tickers_string_1, position_date_1_dt, end_date_1_dt))))
+                script, div, output_file_1 = result['script'], result['div'], result['output_file']
                 return render_template('index.html', scroll='feature1', opt_table_style = 'display:none',
                                        script = script, div_1_1 = div['div_1_1'], output_file_1 = output_file_1,
                                        tickers_string_1_value = tickers_string_1, position_date_1_value = position_date_1,
@@ -290,10 +1420,10 @@ def index():
                 position_date_1_dt = datetime.datetime.strptime(position_date_1, '%Y-%m-%d')
                 end_date_1 = request.form["end_date_1"]
                 end_date_1_dt = datetime.datetime.strptime(end_date_1, '%Y-%m-%d')
-                df_1, plot_length_1 = create_df_from_tickers(tickers_string_1, position_date_1_dt, end_date_1_dt)            
-                plot_1_2, output_file_1 = plot_parameters(df_1.iloc[:,0])
-                plots = {'div_1_2': plot_1_2}
-                script, div = components(plots)
+                result = cached_result('plot_parameters', [tickers_string_1.replace(" ", ""), position_date_1, end_date_1],
+                                       end_date_1_dt, lambda: plot_result('div_1_2', *plot_parameters(
+                                           create_df_from_tickers(tickers_string_1, position_date_1_dt, end_date_1_dt)[0].iloc[:,0])))
+                script, div, output_file_1 = result['script'], result['div'], result['output_file']
                 return render_template('index.html', scroll='feature1', opt_table_style = 'display:none',
                                        script = script, div_1_2 = div['div_1_2'], output_file_1 = output_file_1,
                                        tickers_string_1_value = tickers_string_1, position_date_1_value = position_date_1,
@@ -322,11 +1452,17 @@ def index():
                 horizon_day_1 = request.form["horizon_day_1"]
                 horizon_year_1 = float(horizon_day_1)/252
                 var_es_method_1 = request.form["var_es_method_1"]
-                df_1, plot_length_1 = create_df_from_tickers(tickers_string_1, position_date_1_dt, end_date_1_dt)            
-                plot_1_2, output_file_1 = plot_risk(int(v0_1), df_1.iloc[:,0], float(var_prob_1), float(es_prob_1), 
-                                                    var_es_method_1, int(window_year_1), horizon_year_1, plot_length_1)
-                plots = {'div_1_2': plot_1_2}
-                script, div = components(plots)
+                def compute():
+                    df_1, plot_length_1 = create_df_from_tickers(tickers_string_1, position_date_1_dt, end_date_1_dt)
+                    return plot_result('div_1_2', *plot_risk(int(v0_1), df_1.iloc[:,0], float(var_prob_1), float(es_prob_1),
+                                                             var_es_method_1, int(window_year_1), horizon_year_1,
+                                                             plot_length_1, MC_SEED))
+                result = cached_result('plot_risk', [tickers_string_1.replace(" ", ""), position_date_1, end_date_1,
+                                                     int(v0_1), float(var_prob_1), float(es_prob_1), var_es_method_1,
+                                                     int(window_year_1), float(horizon_day_1), MC_SEED, QMC_SAMPLING,
+                                                     QMC_PATHS, QMC_REPLICATES],
+                                       end_date_1_dt, compute, background='Monte Carlo' in var_es_method_1)
+                script, div, output_file_1 = result['script'], result['div'], result['output_file']
                 return render_template('index.html', scroll='feature1', opt_table_style = 'display:none',
                                        script = script, div_1_2 = div['div_1_2'], output_file_1 = output_file_1,
                                        tickers_string_1_value = tickers_string_1, position_date_1_value = position_date_1,
@@ -343,12 +1479,51 @@ def index():
                                        rf_3_value = '0.005', var_prob_3_value = '0.99', mat_3_value = '0.5',
                                        v0_3_value = '1000000', liq_rate_3_value = '0.01', implied_vol_3_value = '0.21',
                                        output_file_3 = 'outputs/options_AAPL_2016-12-21.csv')
+            elif request.form['btn_1'] == 'Backtest':
+                tickers_string_1 = request.form["tickers_string_1"]
+                position_date_1 = request.form["position_date_1"]
+                position_date_1_dt = datetime.datetime.strptime(position_date_1, '%Y-%m-%d')
+                end_date_1 = request.form["end_date_1"]
+                end_date_1_dt = datetime.datetime.strptime(end_date_1, '%Y-%m-%d')
+                v0_1 = request.form["v0_1"]
+                var_prob_1 = request.form["var_prob_1"]
+                es_prob_1 = request.form["es_prob_1"]
+                window_year_1 = request.form["window_year_1"]
+                horizon_day_1 = request.form["horizon_day_1"]
+                def compute():
+                    df_1, plot_length_1 = create_df_from_tickers(tickers_string_1, position_date_1_dt, end_date_1_dt)
+                    summary = backtest_grid(int(v0_1), df_1.iloc[:,0], BACKTEST_METHODS,
+                                            sorted(set(BACKTEST_WINDOWS + [int(window_year_1)])),
+                                            sorted(set(BACKTEST_HORIZONS + [int(float(horizon_day_1))])),
+                                            sorted(set(BACKTEST_PROBS + [float(var_prob_1)])), plot_length_1, seed=MC_SEED)
+                    download = download_entry('Backtest_%s_%s_%s' % (df_1.columns[0], position_date_1, end_date_1), summary)
+                    return {'table': summary.to_html(index=False, classes='table table-condensed table-striped',
+                                                     float_format=lambda x: '%.4g' % x),
+                            'output_file': save_download(download), 'download': download}
+                result = cached_result('backtest_grid', [tickers_string_1.replace(" ", ""), position_date_1, end_date_1,
+                                                         int(v0_1), float(var_prob_1), int(window_year_1),
+                                                         float(horizon_day_1), MC_SEED],
+                                       end_date_1_dt, compute)
+                return render_template('index.html', scroll='feature1', opt_table_style = 'display:none',
+                                       backtest_table_1 = result['table'], output_file_1 = result['output_file'],
+                                       tickers_string_1_value = tickers_string_1, position_date_1_value = position_date_1,
+                                       end_date_1_value = end_date_1, v0_1_value = v0_1, var_prob_1_value = var_prob_1,
+                                       es_prob_1_value = es_prob_1, window_year_1_value = window_year_1, 
+                                       horizon_day_1_value = horizon_day_1,
+                                       tickers_string_2_value = 'AAPL,MSFT', position_date_2_value = '2000-12-01',
+                                       weights_string_2_value = '0.5,0.5', end_date_2_value = '2016-12-01',
+                                       v0_2_value = '10000', var_prob_2_value = '0.99', es_prob_2_value = '0.975',
+                                       window_year_2_value = '2', horizon_day_2_value = '5',
+                                       output_file_2 = 'outputs/price_Portfolio_AAPL_MSFT_2000-12-01_2016-12-01.csv',
+                                       tickers_string_3_value = 'AAPL', position_date_3_value = '2016-12-21',
+                                       window_year_3_value = '2', horizon_day_3_value = '5',
+                                       rf_3_value = '0.005', var_prob_3_value = '0.99', mat_3_value = '0.5',
+                                       v0_3_value = '1000000', liq_rate_3_value = '0.01', implied_vol_3_value = '0.21',
+                                       output_file_3 = 'outputs/options_AAPL_2016-12-21.csv')
             elif request.form['btn_1'] == 'Download Result Data':
-                output_file_1 = request.form["output_file_1"]
-                return send_file(output_file_1, mimetype='text/csv', 
-                                 attachment_filename=output_file_1.split('/')[1], as_attachment=True)
+                return download_response(request.form["output_file_1"], request.form.get("download_format_1", 'csv'))
             else:
-                print '1'
+                print('1')
         # Feature 2 - Portfolio
         elif 'btn_2' in request.form:
             if request.form['btn_2'] == 'Price Plot':
@@ -359,11 +1534,12 @@ def index():
                 end_date_2 = request.form["end_date_2"]
                 end_date_2_dt = datetime.datetime.strptime(end_date_2, '%Y-%m-%d')
                 v0_2 = request.form["v0_2"]
-                df_2, plot_length_2 = create_df_from_tickers_port(tickers_string_2, weights_string_2, int(v0_2),
-                                                                  position_date_2_dt, end_date_2_dt)
-                plot_2_1, output_file_2 = plot_price(df_2, plot_length_2) 
-                plots = {'div_2_1': plot_2_1}
-                script, div = components(plots)
+                result = cached_result('plot_price', [tickers_string_2.replace(" ", ""), weights_string_2.replace(" ", ""),
+                                                      int(v0_2), position_date_2, end_date_2],
+                                       end_date_2_dt, lambda: plot_result('div_2_1', *plot_price(
+                                           *create_df_from_tickers_port(tickers_string_2, weights_string_2, int(v0_2),
+                                                                        position_date_2_dt, end_date_2_dt))))
+                script, div, output_file_2 = result['script'], result['div'], result['output_file']
                 return render_template('index.html', scroll='feature2', opt_table_style = 'display:none',
                                        script = script, div_2_1 = div['div_2_1'], output_file_2 = output_file_2,
                                        tickers_string_1_value = 'AAPL', position_date_1_value = '2000-12-01',
@@ -387,11 +1563,12 @@ def index():
                 end_date_2 = request.form["end_date_2"]
                 end_date_2_dt = datetime.datetime.strptime(end_date_2, '%Y-%m-%d')
                 v0_2 = request.form["v0_2"]
-                df_2, plot_length_2 = create_df_from_tickers_port(tickers_string_2, weights_string_2, int(v0_2),
-                                                                  position_date_2_dt, end_date_2_dt)            
-                plot_2_2, output_file_2 = plot_parameters(df_2.iloc[:,0])
-                plots = {'div_2_2': plot_2_2}
-                script, div = components(plots)
+                result = cached_result('plot_parameters', [tickers_string_2.replace(" ", ""), weights_string_2.replace(" ", ""),
+                                                           int(v0_2), position_date_2, end_date_2],
+                                       end_date_2_dt, lambda: plot_result('div_2_2', *plot_parameters(
+                                           create_df_from_tickers_port(tickers_string_2, weights_string_2, int(v0_2),
+                                                                       position_date_2_dt, end_date_2_dt)[0].iloc[:,0])))
+                script, div, output_file_2 = result['script'], result['div'], result['output_file']
                 return render_template('index.html', scroll='feature2', opt_table_style = 'display:none',
                                        script = script, div_2_2 = div['div_2_2'], output_file_2 = output_file_2,
                                        tickers_string_1_value = 'AAPL', position_date_1_value = '2000-12-01',
@@ -421,12 +1598,25 @@ def index():
                 horizon_day_2 = request.form["horizon_day_2"]
                 horizon_year_2 = float(horizon_day_2)/252
                 var_es_method_2 = request.form["var_es_method_2"]
-                df_2, plot_length_2 = create_df_from_tickers_port(tickers_string_2, weights_string_2, int(v0_2),
-                                                                  position_date_2_dt, end_date_2_dt)            
-                plot_2_2, output_file_2 = plot_risk(int(v0_2), df_2.iloc[:,0], float(var_prob_2), float(es_prob_2), 
-                                                    var_es_method_2, int(window_year_2), horizon_year_2, plot_length_2)
-                plots = {'div_2_2': plot_2_2}
-                script, div = components(plots)
+                def compute():
+                    if var_es_method_2 == 'Covariance VaR/ES':
+                        df_2, plot_length_2 = create_df_from_tickers(tickers_string_2, position_date_2_dt, end_date_2_dt)
+                        weights_2 = [float(weight) for weight in weights_string_2.split(",")]
+                        return plot_result('div_2_2', *plot_risk_covariance(int(v0_2), df_2, weights_2, float(var_prob_2),
+                                                                             float(es_prob_2), int(window_year_2),
+                                                                             horizon_year_2, plot_length_2))
+                    df_2, plot_length_2 = create_df_from_tickers_port(tickers_string_2, weights_string_2, int(v0_2),
+                                                                      position_date_2_dt, end_date_2_dt)
+                    return plot_result('div_2_2', *plot_risk(int(v0_2), df_2.iloc[:,0], float(var_prob_2), float(es_prob_2),
+                                                             var_es_method_2, int(window_year_2), horizon_year_2,
+                                                             plot_length_2, MC_SEED))
+                result = cached_result('plot_risk', [tickers_string_2.replace(" ", ""), weights_string_2.replace(" ", ""),
+                                                     int(v0_2), position_date_2, end_date_2, float(var_prob_2),
+                                                     float(es_prob_2), var_es_method_2, int(window_year_2),
+                                                     float(horizon_day_2), MC_SEED, QMC_SAMPLING, QMC_PATHS,
+                                                     QMC_REPLICATES],
+                                       end_date_2_dt, compute, background='Monte Carlo' in var_es_method_2)
+                script, div, output_file_2 = result['script'], result['div'], result['output_file']
                 return render_template('index.html', scroll='feature2', opt_table_style = 'display:none',
                                        script = script, div_2_2 = div['div_2_2'], output_file_2 = output_file_2,
                                        tickers_string_1_value = 'AAPL', position_date_1_value = '2000-12-01',
@@ -443,11 +1633,9 @@ def index():
                                        v0_3_value = '1000000', liq_rate_3_value = '0.01', implied_vol_3_value = '0.21',
                                        output_file_3 = 'outputs/options_AAPL_2016-12-21.csv')
             elif request.form['btn_2'] == 'Download Result Data':
-                output_file_2 = request.form["output_file_2"]
-                return send_file(output_file_2, mimetype='text/csv', 
-                                 attachment_filename=output_file_2.split('/')[1], as_attachment=True)
+                return download_response(request.form["output_file_2"], request.form.get("download_format_2", 'csv'))
             else:
-                print '2'
+                print('2')
         # Feature 3 - Options
         elif 'btn_3' in request.form:
             if request.form['btn_3'] == 'Calculate':
@@ -464,8 +1652,17 @@ def index():
                 implied_vol_3 = request.form["implied_vol_3"]
                 horizon_year_3 = float(horizon_day_3)/252
                 start_date_opt = position_date_3_dt - dateutil.relativedelta.relativedelta(years = 10)
-                options = web.DataReader(tickers_string_3, 'yahoo', start_date_opt, position_date_3_dt)['Adj Close'].sort_index(ascending = False).rename(tickers_string_3)
-                s0, nstocks, put0, nputs, VaR_1, VaR_2, reduction, output_file_3 = options_cal(options, float(rf_3), float(mat_3), float(implied_vol_3), int(v0_3), float(liq_rate_3), float(var_prob_3), int(window_year_3), horizon_year_3)
+                def compute():
+                    with stage('fetch'):
+                        options = price_store.get_series(tickers_string_3, start_date_opt, position_date_3_dt).sort_index(ascending = False)
+                    values = options_cal(options, float(rf_3), float(mat_3), float(implied_vol_3), int(v0_3), float(liq_rate_3), float(var_prob_3), int(window_year_3), horizon_year_3, MC_SEED)
+                    return {'values': values[:-1], 'output_file': save_download(values[-1]), 'download': values[-1]}
+                result = cached_result('options_cal', [tickers_string_3.replace(" ", ""), position_date_3, float(rf_3),
+                                                       float(mat_3), float(implied_vol_3), int(v0_3), float(liq_rate_3),
+                                                       float(var_prob_3), int(window_year_3), float(horizon_day_3), MC_SEED],
+                                       position_date_3_dt, compute, background=True)
+                s0, nstocks, put0, nputs, VaR_1, VaR_2, reduction, npaths_3, stderr_3 = result['values']
+                output_file_3 = result['output_file']
                 return render_template('index.html', scroll='feature3', opt_table_style = 'display:block',
                                        tickers_string_1_value = 'AAPL', position_date_1_value = '2000-12-01',
                                        end_date_1_value = '2016-12-01', v0_1_value = '10000', var_prob_1_value = '0.99',
@@ -483,13 +1680,56 @@ def index():
                                        implied_vol_3_value = implied_vol_3, output_file_3 = output_file_3,
                                        table_title = tickers_string_3 + "_" + position_date_3, s0_value = s0,
                                        nstocks_value = nstocks, put0_value = put0, nputs_value = nputs,
-                                       VaR_1_value = VaR_1, VaR_2_value = VaR_2, reduction_value = reduction) 
+                                       VaR_1_value = VaR_1, VaR_2_value = VaR_2, reduction_value = reduction,
+                                       npaths_value = npaths_3, stderr_value = stderr_3)
+            elif request.form['btn_3'] == 'Hedge Grid':
+                tickers_string_3 = request.form["tickers_string_3"]
+                position_date_3 = request.form["position_date_3"]
+                position_date_3_dt = datetime.datetime.strptime(position_date_3, '%Y-%m-%d')
+                window_year_3 = request.form["window_year_3"]
+                horizon_day_3 = request.form["horizon_day_3"]
+                rf_3 = request.form["rf_3"]
+                var_prob_3 = request.form["var_prob_3"]
+                mat_3 = request.form["mat_3"]
+                v0_3 = request.form["v0_3"]
+                liq_rate_3 = request.form["liq_rate_3"]
+                implied_vol_3 = request.form["implied_vol_3"]
+                start_date_opt = position_date_3_dt - dateutil.relativedelta.relativedelta(years = 10)
+                def compute():
+                    with stage('fetch'):
+                        options = price_store.get_series(tickers_string_3, start_date_opt, position_date_3_dt).sort_index(ascending = False)
+                    s0, VaR_1, surface, portfolio = options_grid_risk(
+                        options, float(rf_3), int(v0_3), OPTIONS_MONEYNESS, sorted(set(OPTIONS_MATURITIES + [float(mat_3)])),
+                        [float(implied_vol_3)], sorted(set(OPTIONS_HEDGE_RATIOS + [float(liq_rate_3)])), float(var_prob_3),
+                        int(window_year_3), float(horizon_day_3)/252, seed=MC_SEED)
+                    download = download_entry('options_grid_%s_%s' % (options.name, options.index[0].date()), surface)
+                    return {'table': surface.to_html(index=False, classes='table table-condensed table-striped',
+                                                     float_format=lambda x: '%.4g' % x),
+                            'output_file': save_download(download), 'download': download}
+                result = cached_result('options_grid', [tickers_string_3.replace(" ", ""), position_date_3, float(rf_3),
+                                                        float(mat_3), float(implied_vol_3), int(v0_3), float(liq_rate_3),
+                                                        float(var_prob_3), int(window_year_3), float(horizon_day_3), MC_SEED],
+                                       position_date_3_dt, compute)
+                return render_template('index.html', scroll='feature3', opt_table_style = 'display:none',
+                                       options_table_3 = result['table'], output_file_3 = result['output_file'],
+                                       tickers_string_1_value = 'AAPL', position_date_1_value = '2000-12-01',
+                                       end_date_1_value = '2016-12-01', v0_1_value = '10000', var_prob_1_value = '0.99',
+                                       es_prob_1_value = '0.975', window_year_1_value = '2', horizon_day_1_value = '5',
+                                       output_file_1 = 'outputs/price_AAPL_2000-12-01_2016-12-01.csv',
+                                       tickers_string_2_value = 'AAPL,MSFT', position_date_2_value = '2000-12-01',
+                                       weights_string_2_value = '0.5,0.5', end_date_2_value = '2016-12-01',
+                                       v0_2_value = '10000', var_prob_2_value = '0.99', es_prob_2_value = '0.975',
+                                       window_year_2_value = '2', horizon_day_2_value = '5',
+                                       output_file_2 = 'outputs/price_Portfolio_AAPL_MSFT_2000-12-01_2016-12-01.csv',
+                                       tickers_string_3_value = tickers_string_3, position_date_3_value = position_date_3,
+                                       window_year_3_value = window_year_3, horizon_day_3_value = horizon_day_3,
+                                       rf_3_value = rf_3, var_prob_3_value = var_prob_3,
+                                       mat_3_value = mat_3, v0_3_value = v0_3, liq_rate_3_value = liq_rate_3, 
+                                       implied_vol_3_value = implied_vol_3)
             elif request.form['btn_3'] == 'Download Result Data':
-                output_file_3 = request.form["output_file_3"]
-                return send_file(output_file_3, mimetype='text/csv', 
-                                 attachment_filename=output_file_3.split('/')[1], as_attachment=True)
+                return download_response(request.form["output_file_3"], request.form.get("download_format_3", 'csv'))
             else:
-                print '3'
+                print('3')
         else:
             return render_template('index.html', opt_table_style = 'display:none',
                                    tickers_string_1_value = 'AAPL', position_date_1_value = '2000-12-01',
@@ -508,6 +1748,69 @@ def index():
                                    output_file_3 = 'outputs/options_AAPL_2016-12-21.csv')
 
 
+##################  Warm-up ##################
+
+# Every risk kernel on a few years of the fixture prices: the first calls of numpy and scipy routines and of the
+# Monte Carlo and options paths load their code and, for Quasi-Monte Carlo, scipy.stats
+def warm_up_kernels(price):
+    v0, VaR_prob, ES_prob, horizon = 10000, 0.99, 0.975, 5/252
+    price = price[:4*252]
+    for method in ['Parametric VaR/ES', 'Historical VaR/ES', 'Monte Carlo VaR/ES', 'Quasi-Monte Carlo VaR/ES']:
+        compute_risk(v0, price, VaR_prob, ES_prob, method, 2, horizon, seed=0, stderr=True)
+    backtest_grid(v0, price, BACKTEST_METHODS[:2], [1], [5], [VaR_prob], seed=0)
+    prices = pd.DataFrame({'A': price.values, 'B': price.values[::-1]}, index = price.index)
+    rtn, mubar, cov_w, var_p = portfolio_rolling_est(prices, [0.5, 0.5], 252)
+    component_var(v0, [0.5, 0.5], mubar, cov_w, var_p, VaR_prob, horizon)
+    rtn, mubar, cov = multi_asset_est(prices, 252)
+    portfolio_parametric(v0, [[0.5, 0.5], [0.3, 0.7]], mubar, cov, VaR_prob, ES_prob, horizon)
+    options_risk(price, 0.005, 0.5, 0.21, 1000000, 0.01, VaR_prob, 2, horizon, seed=0)
+    options_grid_risk(price, 0.005, 1000000, OPTIONS_MONEYNESS, OPTIONS_MATURITIES, [0.21], OPTIONS_HEDGE_RATIOS,
+                      VaR_prob, 2, horizon, npaths=10000, seed=0)
+
+# Bokeh figures and their first components() serialization
+def warm_up_plots(price):
+    from bokeh.embed import components
+    plot, download, data = plot_price(price.to_frame(), 252)
+    components({'warmup': plot})
+    plots, download, VaR_ES = plot_risk(10000, price[:4*252], 0.99, 0.975, 'Parametric VaR/ES', 2, 5/252, 252)
+    components({'warmup': plots})
+
+# Compile the page template by rendering the form
+def warm_up_templates(price):
+    with app.test_request_context('/index'):
+        index()
+
+# Run the warm-up steps, each timed as a startup phase; rolling estimates of the fixture are dropped afterwards.
+# A failing step is logged and skipped: the warm-up only saves time, and a preloaded master that raised here would
+# never fork its workers.
+def warm_up(steps):
+    if not steps:
+        return
+    try:
+        price = pd.read_csv(WARMUP_PRICES, index_col=0, parse_dates=True).iloc[:, 0].sort_index(ascending = False)
+    except Exception:
+        print('Warm-up skipped, cannot read %s' % WARMUP_PRICES)
+        traceback.print_exc()
+        return
+    for step in steps:
+        if step not in WARMUP_STEPS:
+            print('Unknown warm-up step %s skipped, expected some of %s' % (step, ', '.join(WARMUP_STEPS)))
+            continue
+        start = timeit.default_timer()
+        try:
+            globals()['warm_up_%s' % step](price)
+        except Exception:
+            print('Warm-up step %s failed' % step)
+            traceback.print_exc()
+            continue
+        metrics.startup_phase('warmup_%s' % step, timeit.default_timer() - start)
+    with rolling_cache_lock:
+        rolling_cache.clear()
+
+metrics.startup_phase('import', timeit.default_timer() - IMPORT_START)
+warm_up(WARMUP)
+
+
 if __name__ == '__main__':
     port = int(os.environ.get("PORT", 5000))
     app.run(host='0.0.0.0', port=port)
\ No newline at end of file
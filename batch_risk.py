@@ -0,0 +1,192 @@
+################## Imports ##################
+# Command-line batch runner: VaR and ES of a whole book of positions from a positions file, without the web app.
+# Positions sharing a ticker are computed together on a process pool; results are written as one csv, gzip csv,
+# Parquet or Arrow IPC file (by extension) next to a json run summary with per-stage timings.
+#
+#   python batch_risk.py positions.csv                                   results in batch_results.parquet
+#   python batch_risk.py positions.csv -o risk.csv --date 2016-12-01 --provider csv --workers 4
+#
+# Prices come from the price store (PRICE_STORE_DIR or --prices-dir); --provider csv serves the csv files in tests/
+# and outputs/ for tickers the store does not hold yet.
+from __future__ import division, print_function
+
+import os
+import sys
+import json
+import zlib
+import argparse
+import datetime
+import timeit
+import multiprocessing
+
+import numpy as np
+import pandas as pd
+import dateutil.relativedelta
+
+# Columns of the positions file besides ticker and notional (or weight), with their defaults
+POSITION_DEFAULTS = {'method': 'parametric', 'window': 2, 'horizon': 5, 'var_prob': 0.99, 'es_prob': 0.975}
+
+# Positions with equal values in these columns share one computation
+RISK_KEY = ['ticker', 'date', 'method', 'window', 'horizon', 'var_prob', 'es_prob']
+
+
+##################  Positions ##################
+
+# Positions file (csv or parquet) with one row per position: ticker, notional (or weight, a share of book_value) and
+# optionally method (as in /api/risk), window (years), horizon (days), var_prob, es_prob, date and id
+def read_positions(path, book_value=None, date=None):
+    positions = pd.read_parquet(path) if path.endswith('.parquet') else pd.read_csv(path)
+    positions.columns = [str(column).strip().lower() for column in positions.columns]
+    if 'ticker' not in positions:
+        raise ValueError('The positions file needs a ticker column')
+    if 'weight' in positions and book_value is not None:
+        weighted = positions['weight'] * book_value
+        positions['notional'] = positions['notional'].fillna(weighted) if 'notional' in positions else weighted
+    if 'notional' not in positions:
+        raise ValueError('The positions file needs a notional column, or a weight column and --book-value')
+    for column, value in POSITION_DEFAULTS.items():
+        positions[column] = positions[column].fillna(value) if column in positions else value
+    positions['date'] = pd.to_datetime(positions['date']).fillna(date) if 'date' in positions else date
+    if 'id' not in positions:
+        positions['id'] = np.arange(len(positions))
+    positions['ticker'] = positions['ticker'].astype(str).str.strip()
+    positions['window'] = positions['window'].astype(int)
+    positions['horizon'] = positions['horizon'].astype(float)
+    return positions
+
+
+##################  Workers ##################
+
+# VaR and ES per unit of value for every distinct risk key of one ticker, with the stage timings of the work.
+# Every method is linear in the position value, so one computation serves all positions sharing a key. Only the
+# last window of prices up to each date is passed to compute_risk, which then yields the VaR/ES of that date alone;
+# keys with the same date and window share their rolling estimates through rolling_cache.
+def ticker_risk(task):
+    import app
+    import metrics
+    ticker, keys, seed = task
+    before = metrics.stage_totals()
+    rows = []
+    try:
+        start = min(key['date'] - dateutil.relativedelta.relativedelta(years=key['window'] + 1) for key in keys)
+        with metrics.stage('fetch'):
+            prices = app.price_store.get_series(ticker, start, max(key['date'] for key in keys)).sort_index(ascending = False)
+    except Exception as e:
+        prices, error = None, str(e)
+    for key in keys:
+        row = dict(key)
+        try:
+            if prices is None:
+                raise ValueError(error)
+            window_days = int(key['window']*252)
+            price = prices[prices.index <= key['date']].iloc[:window_days + 1]
+            if len(price) <= window_days:
+                raise ValueError('Need %d prices of %s up to %s, got %d' % (window_days + 1, ticker,
+                                                                             key['date'].date(), len(price)))
+            VaR, ES, VaR_stderr, ES_stderr = app.compute_risk(
+                1.0, price, key['var_prob'], key['es_prob'], app.RISK_METHODS.get(key['method'], key['method']),
+                key['window'], key['horizon']/252, seed=[seed, zlib.crc32(ticker.encode('utf-8')) & 0xffffffff],
+                stderr=True)
+            row.update({'price_date': price.index[0], 'VaR': VaR[0], 'ES': ES[0], 'VaR_stderr': VaR_stderr[0],
+                        'ES_stderr': ES_stderr[0]})
+        except Exception as e:
+            row['error'] = str(e)
+        rows.append(row)
+    after = metrics.stage_totals()
+    return rows, dict((name, after[name] - before.get(name, 0.0)) for name in after)
+
+# Risk of every position, with the seconds each stage took summed over the worker processes. Tickers are handed out
+# largest first so one big ticker does not finish last.
+def run_batch(positions, workers, seed):
+    keys = positions[RISK_KEY].drop_duplicates()
+    tasks = [(ticker, group.to_dict('records'), seed) for ticker, group in keys.groupby('ticker')]
+    tasks.sort(key=lambda task: -len(task[1]))
+    if workers > 1 and len(tasks) > 1:
+        pool = multiprocessing.Pool(min(workers, len(tasks)))
+        try:
+            results = list(pool.imap_unordered(ticker_risk, tasks))
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [ticker_risk(task) for task in tasks]
+    stages = {}
+    for rows, timings in results:
+        for name, seconds in timings.items():
+            stages[name] = stages.get(name, 0.0) + seconds
+    risk = pd.DataFrame([row for rows, timings in results for row in rows],
+                        columns=RISK_KEY + ['price_date', 'VaR', 'ES', 'VaR_stderr', 'ES_stderr', 'error'])
+    risk['date'] = pd.to_datetime(risk['date'])
+    book = positions.merge(risk, on=RISK_KEY, how='left')
+    for column in ['VaR', 'ES', 'VaR_stderr', 'ES_stderr']:
+        book[column] = book[column].astype(float) * book['notional']
+    return book.set_index('id'), stages, len(keys)
+
+
+##################  Main ##################
+
+def main():
+    parser = argparse.ArgumentParser(description='VaR and ES of every position of a positions file.')
+    parser.add_argument('positions', help='csv or parquet file with one position per row')
+    parser.add_argument('-o', '--output', default='batch_results.parquet',
+                        help='results file; .csv, .csv.gz, .parquet or .arrow')
+    parser.add_argument('--summary', help='json run summary (default: the output name with _summary.json)')
+    parser.add_argument('--date', help='risk date of positions without one (default: yesterday)')
+    parser.add_argument('--book-value', type=float, help='value that the weight column is a share of')
+    parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count(),
+                        help='worker processes, at most the number of cores')
+    parser.add_argument('--seed', type=int, help='Monte Carlo seed (default: MC_SEED)')
+    parser.add_argument('--prices-dir', help='price store directory (default: PRICE_STORE_DIR or data/prices)')
+    parser.add_argument('--provider', choices=['yahoo', 'csv'], help='price provider for prices not in the store')
+    args = parser.parse_args()
+
+    if args.prices_dir:
+        os.environ['PRICE_STORE_DIR'] = args.prices_dir
+    if args.provider:
+        os.environ['PRICE_PROVIDER'] = args.provider
+    # The pool already runs one position group per core
+    os.environ['MC_WORKERS'] = '1'
+    start = timeit.default_timer()
+    # Imported once here so that forked workers share it
+    import app
+    from downloads import FORMATS, download_entry, stream_download, arrow_available
+
+    fmt = [name for name in sorted(FORMATS, key=len, reverse=True) if args.output.endswith(FORMATS[name][1])]
+    if not fmt:
+        parser.error('Unknown output format: %s' % args.output)
+    if fmt[0] in ('parquet', 'arrow') and not arrow_available():
+        parser.error('The %s format needs pyarrow' % fmt[0])
+    summary_path = args.summary or args.output[:-len(FORMATS[fmt[0]][1])] + '_summary.json'
+    date = pd.Timestamp(args.date) if args.date else pd.Timestamp(datetime.date.today() - datetime.timedelta(days=1))
+    workers = max(min(args.workers, multiprocessing.cpu_count()), 1)
+    seed = app.MC_SEED if args.seed is None else args.seed
+
+    # Stages of the workers come back from run_batch (serial runs included); this process adds its own read and write
+    own = {}
+    start_read = timeit.default_timer()
+    positions = read_positions(args.positions, args.book_value, date)
+    own['read'] = timeit.default_timer() - start_read
+    book, stages, computations = run_batch(positions, workers, seed)
+    start_write = timeit.default_timer()
+    with open(args.output, 'wb') as f:
+        for chunk in stream_download(download_entry('batch', book), fmt[0]):
+            f.write(chunk.encode('utf-8') if not isinstance(chunk, bytes) else chunk)
+    own['write'] = timeit.default_timer() - start_write
+    for name, seconds in own.items():
+        stages[name] = stages.get(name, 0.0) + seconds
+
+    seconds = timeit.default_timer() - start
+    errors = int(book['error'].notnull().sum())
+    summary = {'positions': len(book), 'tickers': int(positions['ticker'].nunique()), 'computations': computations,
+               'errors': errors, 'workers': workers, 'seconds': seconds,
+               'positions_per_second': len(book) / seconds if seconds > 0 else None,
+               'stage_seconds': dict((name, round(value, 6)) for name, value in sorted(stages.items())),
+               'output': args.output}
+    with open(summary_path, 'w') as f:
+        json.dump(summary, f, indent=2)
+    print('%d positions (%d tickers, %d computations) in %.2f s with %d workers, %d errors; results in %s, summary in %s'
+          % (len(book), summary['tickers'], computations, seconds, workers, errors, args.output, summary_path))
+    return 1 if errors == len(book) and len(book) else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
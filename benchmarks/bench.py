@@ -0,0 +1,317 @@
+################## Imports ##################
+# Benchmarks for the risk kernels and request paths of app.py. Runs offline: prices come from the fixture csv files
+# in tests/ and from synthetic GBM series, through a stub provider plugged into the price store.
+#
+#   python benchmarks/bench.py            run and compare against benchmarks/baseline.json; exit 1 on regressions
+#   python benchmarks/bench.py --strict   also exit 1 when a case has no baseline entry (it is warned about otherwise)
+#   python benchmarks/bench.py --save     run and store the timings as the new baseline
+#   python benchmarks/bench.py --quick    smaller sizes and a single repeat
+#
+# Baselines are only comparable on the machine that recorded them.
+from __future__ import division, print_function
+
+import os
+import sys
+import json
+import shutil
+import zlib
+import argparse
+import tempfile
+import subprocess
+import timeit
+import warnings
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+WORK_DIR = tempfile.mkdtemp(prefix='risk-bench-')
+os.environ.setdefault('PRICE_STORE_DIR', os.path.join(WORK_DIR, 'prices'))
+os.environ.setdefault('RESULT_CACHE_DIR', os.path.join(WORK_DIR, 'results'))
+os.environ.setdefault('JOBS_DB', os.path.join(WORK_DIR, 'jobs.sqlite'))
+os.environ.setdefault('INCREMENTAL_DIR', os.path.join(WORK_DIR, 'incremental'))
+os.environ.setdefault('UNIVERSE_DIR', os.path.join(WORK_DIR, 'universe'))
+os.environ.setdefault('FORM_JOBS', '0')
+sys.path.insert(0, ROOT)
+
+import numpy as np
+import pandas as pd
+
+import app
+from price_store import CSVProvider
+from incremental import build_state
+from panel import build_panel
+
+
+##################  Offline data ##################
+
+# Fixture tickers from the csv files in tests/, any other ticker is a synthetic GBM path seeded by its name
+class BenchProvider(object):
+    def __init__(self):
+        self.csv = CSVProvider([os.path.join(ROOT, 'tests')])
+        self.paths = {}
+
+    def synthetic(self, ticker):
+        if ticker not in self.paths:
+            dates = pd.bdate_range('1950-01-02', '2030-12-31')
+            rng = np.random.RandomState(zlib.crc32(ticker.encode('utf-8')) & 0xffffffff)
+            mu, sigma = rng.uniform(0.02, 0.15), rng.uniform(0.15, 0.45)
+            steps = (mu - sigma*sigma/2)/252 + sigma/np.sqrt(252) * rng.randn(len(dates))
+            self.paths[ticker] = pd.Series(100 * np.exp(np.cumsum(steps)), index=dates, name=ticker)
+        return self.paths[ticker]
+
+    def __call__(self, ticker, start_date, end_date):
+        series = self.csv(ticker, start_date, end_date) if ticker in self.csv.files else self.synthetic(ticker)
+        return series[(series.index >= start_date) & (series.index <= end_date)]
+
+provider = BenchProvider()
+app.price_store.provider = provider
+
+def fixture_price():
+    price = pd.read_csv(os.path.join(ROOT, 'tests', 'price_AAPL_2000-12-01_2016-12-01.csv'), index_col=0,
+                        parse_dates=True).iloc[:, 0]
+    return price.rename('AAPL')
+
+# Synthetic daily prices over the given number of years, most recent first like create_df_from_tickers
+def synthetic_price(years, ticker='SYN'):
+    series = provider.synthetic(ticker)
+    return series[series.index <= '2016-12-01'][-int(years*252):].sort_index(ascending=False)
+
+
+##################  Measurement ##################
+
+def clear_caches():
+    app.rolling_cache.clear()
+    shutil.rmtree(os.environ['RESULT_CACHE_DIR'], ignore_errors=True)
+
+# Peak traced memory of a first run, which also warms the price store, then the best wall time over repeat runs
+# and work units per second
+def measure(fn, units, repeat):
+    peak_mb = None
+    clear_caches()
+    if tracemalloc is not None:
+        tracemalloc.start()
+        fn()
+        peak_mb = tracemalloc.get_traced_memory()[1] / 2**20
+        tracemalloc.stop()
+    else:
+        fn()
+    times = []
+    for _ in range(repeat):
+        clear_caches()
+        start = timeit.default_timer()
+        fn()
+        times.append(timeit.default_timer() - start)
+    seconds = min(times)
+    return {'seconds': seconds, 'peak_mb': peak_mb, 'units': units[1],
+            'throughput': units[0] / seconds if seconds > 0 else None}
+
+
+##################  Cases ##################
+
+# Yield (name, function, (work units, unit label)) for every benchmark
+def cases(years_list, tickers_list):
+    v0, VaR_prob, ES_prob, horizon = 10000, 0.99, 0.975, 5/252
+    series = [('fixture', fixture_price())] + [('%dy' % years, synthetic_price(years)) for years in years_list]
+    for label, price in series:
+        window_days = min(504, len(price) // 2)
+        ntrials = len(price) - window_days
+        rtn, mu, sigma, mubar, sigmabar = app.gbm_est(price, window_days)
+        yield ('gbm_est/%s' % label, lambda price=price, w=window_days: app.gbm_est(price, w), (len(price), 'prices'))
+        yield ('parametric/%s' % label, lambda mu=mu, sigma=sigma: app.parametric(v0, mu, sigma, VaR_prob, ES_prob, horizon),
+               (ntrials, 'dates'))
+        yield ('historical/%s' % label, lambda price=price, w=window_days: app.historical(v0, price, VaR_prob, ES_prob, w, 5),
+               (ntrials, 'dates'))
+        yield ('monte_carlo/%s' % label, lambda price=price, w=window_days, mu=mu, sigma=sigma: app.monte_carlo(
+            v0, price, mu, sigma, VaR_prob, ES_prob, w, horizon, seed=0), (ntrials * 5000, 'paths'))
+        yield ('quasi_monte_carlo/%s' % label, lambda price=price, w=window_days, mu=mu, sigma=sigma: app.monte_carlo(
+            v0, price, mu, sigma, VaR_prob, ES_prob, w, horizon, npaths=app.QMC_PATHS, seed=0, sampling=app.QMC_SAMPLING,
+            replicates=app.QMC_REPLICATES), (ntrials * app.QMC_PATHS * app.QMC_REPLICATES, 'paths'))
+        yield ('incremental/%s' % label, lambda price=price, w=window_days: append_days(price, w, 252), (252, 'dates'))
+    stocks = 117.06 * np.exp(0.05 * np.random.RandomState(0).randn(1000000))
+    yield ('bs_put/1M', lambda: app.bs_put(stocks, 0.005, 0.21, 117.06, 0.5), (len(stocks), 'prices'))
+    option_args = (117.06, 0.25, 0.25, 0.005, 0.21, 117.06, 0.5, 8457.2, 1476.1, 0.99, horizon)
+    yield ('option_mc/1M-plain', lambda: app.option_mc(*option_args, seed=0), (1000000, 'paths'))
+    yield ('option_mc/adaptive', lambda: app.option_mc(*option_args, chunk_size=10000, antithetic=True,
+                                                        control_variate=True, tol=0.001, seed=0), (1, 'runs'))
+    st = app.terminal_prices(117.06, 0.25, 0.25, horizon, 100000, seed=0)
+    grid_points = len(app.OPTIONS_MONEYNESS) * len(app.OPTIONS_MATURITIES) * len(app.OPTIONS_HEDGE_RATIOS)
+    yield ('options_grid/%d-points' % grid_points, lambda: app.options_grid(
+        117.06, st, 0.005, 1000000, 117.06 * np.array(app.OPTIONS_MONEYNESS), app.OPTIONS_MATURITIES, [0.21],
+        app.OPTIONS_HEDGE_RATIOS, 0.99, 30000, horizon), (grid_points, 'grid points'))
+    for ntickers in tickers_list:
+        names = ['SYN%d' % i for i in range(ntickers)]
+        prices = pd.concat([synthetic_price(10, name) for name in names], axis=1, keys=names)
+        weights = np.random.RandomState(ntickers).dirichlet(np.ones(ntickers), 1000)
+        end = pd.Timestamp('2016-12-01')
+        yield ('price_store/%d-tickers' % ntickers,
+               lambda names=names: app.price_store.get_prices(names, end - pd.DateOffset(years=10), end),
+               (ntickers, 'tickers'))
+        # The same fetch and an equal-weight portfolio sliced from a panel of these tickers
+        app.price_store.get_prices(names, end - pd.DateOffset(years=10), end)
+        universe = build_panel(os.environ['PRICE_STORE_DIR'], os.path.join(WORK_DIR, 'universe-%d' % ntickers), names)
+        yield ('universe/%d-tickers' % ntickers,
+               lambda names=names, u=universe: u.frame(names, end - pd.DateOffset(years=10), end), (ntickers, 'tickers'))
+        yield ('universe_portfolio/%d-tickers' % ntickers, lambda names=names, u=universe: u.portfolio(
+            names, [1/ntickers] * ntickers, v0, end - pd.DateOffset(years=1), end - pd.DateOffset(years=10), end, 'P'),
+               (ntickers, 'tickers'))
+        yield ('portfolio_rolling_est/%d-tickers' % ntickers, lambda prices=prices, w=weights[0]:
+               app.portfolio_rolling_est(prices, w, 504), (ntickers, 'tickers'))
+        rtn, mubar, cov = app.multi_asset_est(prices, 504)
+        yield ('multi_asset_est/%d-tickers' % ntickers, lambda prices=prices: app.multi_asset_est(prices, 504),
+               (ntickers, 'tickers'))
+        yield ('portfolio_parametric/%d-tickers' % ntickers, lambda w=weights, m=mubar, c=cov: app.portfolio_parametric(
+            v0, w, m, c, VaR_prob, ES_prob, horizon), (len(weights), 'portfolios'))
+        yield ('portfolio_monte_carlo/%d-tickers' % ntickers, lambda w=weights, m=mubar, c=cov: app.portfolio_monte_carlo(
+            v0, w, m, c, VaR_prob, ES_prob, horizon, seed=0), (len(weights), 'portfolios'))
+    price = fixture_price()
+    for method in ['Parametric VaR/ES', 'Historical VaR/ES', 'Monte Carlo VaR/ES']:
+        yield ('plot_risk/%s' % method.split()[0].lower(), lambda method=method: app.plot_risk(
+            v0, price, VaR_prob, ES_prob, method, 2, horizon, 1000, seed=0), (1, 'plots'))
+    yield ('backtest_grid/fixture', lambda: app.backtest_grid(v0, price, app.BACKTEST_METHODS, app.BACKTEST_WINDOWS,
+                                                              app.BACKTEST_HORIZONS, app.BACKTEST_PROBS, seed=0),
+           (len(app.BACKTEST_METHODS) * len(app.BACKTEST_WINDOWS) * len(app.BACKTEST_HORIZONS) * len(app.BACKTEST_PROBS),
+            'grid points'))
+    for name, form in index_forms():
+        yield ('index/%s' % name, lambda form=form: post_index(form), (1, 'requests'))
+    forms = dict(index_forms())
+    yield ('startup/import', lambda: start_app(), (1, 'starts'))
+    yield ('startup/warmup-all', lambda: start_app(warmup='all'), (1, 'starts'))
+    yield ('startup/first-response', lambda: start_app(form=forms['risk-plot-parametric']), (1, 'starts'))
+
+# Append days closes to a rolling state built on the oldest window_days + 1 prices, with the VaR and ES of each day;
+# the closes after those are replayed in a loop, so every run appends days new dates
+def append_days(price, window_days, days, states={}):
+    key = (price.name, len(price), window_days)
+    if key not in states:
+        ascending = price.sort_index()
+        states[key] = (build_state(ascending.iloc[:window_days + 1], window_days, 5, 0.99, 0.975),
+                       ascending.values[window_days + 1:].tolist(), [0])
+    state, closes, position = states[key]
+    for i in range(days):
+        state.append(None, closes[(position[0] + i) % len(closes)])
+        state.historical(10000)
+        state.estimates()
+    position[0] += days
+
+def index_forms():
+    single = dict(tickers_string_1='AAPL', position_date_1='2010-12-01', end_date_1='2016-12-01', v0_1='10000',
+                  var_prob_1='0.99', es_prob_1='0.975', window_year_1='2', horizon_day_1='5')
+    portfolio = dict(tickers_string_2='SYN0,SYN1', weights_string_2='0.5,0.5', position_date_2='2010-12-01',
+                     end_date_2='2016-12-01', v0_2='10000', var_prob_2='0.99', es_prob_2='0.975', window_year_2='2',
+                     horizon_day_2='5')
+    options = dict(tickers_string_3='AAPL', position_date_3='2016-11-21', window_year_3='2', horizon_day_3='5',
+                   rf_3='0.005', var_prob_3='0.99', mat_3='0.5', v0_3='1000000', liq_rate_3='0.01',
+                   implied_vol_3='0.21', btn_3='Calculate')
+    yield 'price-plot', dict(single, btn_1='Price Plot')
+    yield 'parameter-plot', dict(single, btn_1='Parameter Plot')
+    for method in ['Parametric', 'Historical', 'Monte Carlo', 'Quasi-Monte Carlo']:
+        yield 'risk-plot-%s' % method.replace(' ', '-').lower(), dict(single, btn_1='Risk Plot',
+                                                                      var_es_method_1='%s VaR/ES' % method)
+    yield 'backtest', dict(single, btn_1='Backtest')
+    yield 'portfolio-risk-plot', dict(portfolio, btn_2='Risk Plot', var_es_method_2='Parametric VaR/ES')
+    yield 'portfolio-covariance-plot', dict(portfolio, btn_2='Risk Plot', var_es_method_2='Covariance VaR/ES')
+    yield 'options-calculate', options
+    yield 'options-hedge-grid', dict(options, btn_3='Hedge Grid')
+
+client = app.app.test_client()
+
+# A new interpreter that imports app, with the warm-up steps given, and answers one POST /index when a form is given;
+# with the form this is the time a cold worker takes to its first response
+START_SCRIPT = '''
+import sys
+sys.path.insert(0, %r)
+import app
+from price_store import CSVProvider
+app.price_store.provider = CSVProvider([%r])
+form = %r
+if form and app.app.test_client().post('/index', data=form).status_code != 200:
+    sys.exit(1)
+'''
+
+def start_app(warmup='', form=None):
+    env = dict(os.environ, WARMUP=warmup, PYTHONWARNINGS='ignore')
+    with open(os.devnull, 'w') as devnull:
+        subprocess.check_call([sys.executable, '-c', START_SCRIPT % (ROOT, os.path.join(ROOT, 'tests'), form)],
+                              env=env, stderr=devnull)
+
+def post_index(form):
+    response = client.post('/index', data=form)
+    if response.status_code != 200:
+        raise RuntimeError('POST /index returned %s' % response.status_code)
+
+
+##################  Main ##################
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the risk kernels and request paths.')
+    parser.add_argument('--baseline', default=os.path.join(ROOT, 'benchmarks', 'baseline.json'))
+    parser.add_argument('--save', action='store_true', help='store this run as the baseline')
+    parser.add_argument('--quick', action='store_true', help='smaller sizes and a single repeat')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--threshold', type=float, default=1.5,
+                        help='fail when a case is this many times slower than its baseline')
+    parser.add_argument('--min-seconds', type=float, default=0.005,
+                        help='ignore slowdowns smaller than this many seconds')
+    parser.add_argument('--strict', action='store_true', help='fail when a case has no baseline entry')
+    parser.add_argument('--filter', default='', help='only run cases whose name contains this text')
+    parser.add_argument('--output', help='also write the results as json to this file')
+    args = parser.parse_args()
+
+    years_list = [1, 10] if args.quick else [1, 5, 10, 25, 50]
+    tickers_list = [1, 10] if args.quick else [1, 10, 100, 500]
+    repeat = 1 if args.quick else args.repeat
+    os.chdir(WORK_DIR)
+    os.mkdir('outputs')
+    # app imports Bokeh on the first plot, and Bokeh adds its own warning filters when imported
+    import bokeh.plotting
+    warnings.simplefilter('ignore')
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    results = {}
+    regressions = []
+    missing = []
+    print('%-40s %10s %10s %14s %10s' % ('case', 'seconds', 'peak MB', 'throughput', 'baseline'))
+    try:
+        for name, fn, units in cases(years_list, tickers_list):
+            if args.filter not in name:
+                continue
+            result = results[name] = measure(fn, units, repeat)
+            base = baseline.get(name, {}).get('seconds')
+            print('%-40s %10.4f %10s %14s %10s' % (
+                name, result['seconds'], '-' if result['peak_mb'] is None else '%.1f' % result['peak_mb'],
+                '-' if result['throughput'] is None else '%.3g %s/s' % (result['throughput'], result['units']),
+                '-' if base is None else '%.4f' % base))
+            if base is None:
+                missing.append(name)
+            if base is not None and result['seconds'] > base * args.threshold and \
+                    result['seconds'] - base > args.min_seconds:
+                regressions.append(name)
+    finally:
+        os.chdir(ROOT)
+        shutil.rmtree(WORK_DIR, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.save:
+        baseline.update(results)
+        with open(args.baseline, 'w') as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+        print('Saved %d cases to %s' % (len(results), args.baseline))
+        return 0
+    if missing:
+        print('%s: no baseline for %d cases, run with --save to record them: %s' % (
+            'Error' if args.strict else 'Warning', len(missing), ', '.join(missing)))
+    if regressions:
+        print('Regressions beyond %.2fx baseline: %s' % (args.threshold, ', '.join(regressions)))
+    return 1 if regressions or (args.strict and missing) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
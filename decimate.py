@@ -0,0 +1,55 @@
+################## Imports ##################
+# Series decimation for the Bokeh plots of app.py: Largest-Triangle-Three-Buckets (LTTB) keeps the visual shape of
+# a line, spikes included, with a fixed number of points, and arrays travel to the browser as base64 float64.
+from __future__ import division
+
+import base64
+
+import numpy as np
+
+
+# Indices of n_out points of (x, y) chosen by LTTB; x must be ascending and y finite. The first and last points are kept
+# and every bucket in between contributes the point forming the largest triangle with its neighbours.
+def lttb(x, y, n_out):
+    n = len(x)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+    x = np.asarray(x, dtype=np.float64) - x[0]
+    y = np.asarray(y, dtype=np.float64)
+    bounds = np.floor(np.arange(n_out - 1) * ((n - 2) / (n_out - 2))).astype(np.int64) + 1
+    bounds[-1] = n - 1
+    csum_x = np.concatenate([[0.0], np.cumsum(x)])
+    csum_y = np.concatenate([[0.0], np.cumsum(y)])
+    sizes = bounds[1:] - bounds[:-1]
+    mean_x = (csum_x[bounds[1:]] - csum_x[bounds[:-1]]) / sizes
+    mean_y = (csum_y[bounds[1:]] - csum_y[bounds[:-1]]) / sizes
+    # Buckets hold a handful of points, so plain floats beat one numpy call per bucket
+    xs, ys, bounds = x.tolist(), y.tolist(), bounds.tolist()
+    next_x, next_y = mean_x.tolist()[1:] + [xs[-1]], mean_y.tolist()[1:] + [ys[-1]]
+    index = [0] * n_out
+    index[-1] = n - 1
+    a = 0
+    for i in range(n_out - 2):
+        ax, ay = xs[a], ys[a]
+        dx, dy = ax - next_x[i], next_y[i] - ay
+        best = -1.0
+        for j in range(bounds[i], bounds[i + 1]):
+            area = abs(dx * (ys[j] - ay) - (ax - xs[j]) * dy)
+            if area > best:
+                best, a = area, j
+        index[i + 1] = a
+    return np.array(index, dtype=np.int64)
+
+# Dates as float64 milliseconds since 1970 (the unit of Bokeh datetime axes) and values as float64, ascending by
+# date and without missing values
+def series_arrays(dates, values):
+    x = np.asarray(dates, dtype='datetime64[ms]').astype(np.int64).astype(np.float64)
+    y = np.asarray(values, dtype=np.float64).ravel()
+    order = np.argsort(x, kind='mergesort')
+    x, y = x[order], y[order]
+    finite = np.isfinite(y)
+    return x[finite], y[finite]
+
+# base64 text of a float64 array in little-endian byte order, decoded in the browser into a Float64Array
+def encode_array(values):
+    return base64.b64encode(np.ascontiguousarray(values, dtype='<f8').tobytes()).decode('ascii')
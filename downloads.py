@@ -0,0 +1,114 @@
+################## Imports ##################
+# Result downloads for app.py, generated on demand from a stored data frame instead of csv files written on every
+# computation. A download entry is {'id', 'name', 'data', 'header'}; its id is a hash of the name and contents, so
+# identical results from concurrent requests share one entry. Entries stream as csv, gzip-compressed csv, Parquet or
+# Arrow IPC, a chunk of rows at a time; the columnar formats need pyarrow.
+from __future__ import division
+
+import os
+import zlib
+import hashlib
+
+import pandas as pd
+
+CHUNK_ROWS = 5000
+
+# Download format: (mimetype, file extension)
+FORMATS = {'csv': ('text/csv', '.csv'), 'csv.gz': ('application/gzip', '.csv.gz'),
+           'parquet': ('application/vnd.apache.parquet', '.parquet'),
+           'arrow': ('application/vnd.apache.arrow.file', '.arrow')}
+
+
+##################  Entries ##################
+
+def download_entry(name, data, header=True):
+    digest = hashlib.sha256(name.encode('utf-8'))
+    digest.update(repr([str(column) for column in data.columns]).encode('utf-8'))
+    digest.update(pd.util.hash_pandas_object(data).values.tobytes())
+    return {'id': digest.hexdigest(), 'name': name, 'data': data, 'header': header}
+
+# Entry for one of the csv files shipped in directory (the defaults of the html form), looked up by file name only so
+# that a form value can never point outside directory. Options files are written without a header row.
+def bundled_entry(value, directory='outputs'):
+    name = os.path.basename(value)
+    path = os.path.join(directory, name)
+    if value not in (name, '%s/%s' % (directory, name)) or not name.endswith('.csv') or not os.path.isfile(path):
+        return None
+    header = not name.startswith('options_')
+    data = pd.read_csv(path, index_col=0, header=0 if header else None)
+    return {'id': name, 'name': name[:-len('.csv')], 'data': data, 'header': header}
+
+def arrow_available():
+    try:
+        import pyarrow
+    except ImportError:
+        return False
+    return True
+
+
+##################  Streaming ##################
+
+def csv_chunks(entry):
+    data = entry['data']
+    for start in range(0, max(len(data), 1), CHUNK_ROWS):
+        yield data.iloc[start:start + CHUNK_ROWS].to_csv(header=entry['header'] and start == 0)
+
+def gzip_chunks(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk.encode('utf-8'))
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+# File-like object handed to the pyarrow writers; drain() returns what was written since the last call
+class _Sink(object):
+    closed = False
+
+    def __init__(self):
+        self.parts = []
+        self.position = 0
+
+    def write(self, data):
+        self.parts.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self.parts)
+        self.parts = []
+        return data
+
+# Parquet (one row group per chunk) or Arrow IPC file (one record batch per chunk); the index becomes the first column
+def arrow_chunks(entry, fmt):
+    import pyarrow as pa
+    data = entry['data']
+    frame = data.rename_axis(data.index.name or ('Date' if isinstance(data.index, pd.DatetimeIndex) else 'index'))
+    frame = frame.reset_index()
+    frame.columns = [str(column) for column in frame.columns]
+    schema = pa.Schema.from_pandas(frame, preserve_index=False)
+    sink = _Sink()
+    if fmt == 'parquet':
+        import pyarrow.parquet as pq
+        writer = pq.ParquetWriter(sink, schema)
+    else:
+        writer = pa.ipc.new_file(sink, schema)
+    for start in range(0, len(frame), CHUNK_ROWS):
+        writer.write_table(pa.Table.from_pandas(frame.iloc[start:start + CHUNK_ROWS], schema=schema,
+                                                preserve_index=False))
+        yield sink.drain()
+    writer.close()
+    yield sink.drain()
+
+def stream_download(entry, fmt):
+    if fmt == 'csv':
+        return csv_chunks(entry)
+    if fmt == 'csv.gz':
+        return gzip_chunks(csv_chunks(entry))
+    return arrow_chunks(entry, fmt)
@@ -0,0 +1,204 @@
+################## Imports ##################
+# Incremental daily VaR/ES for app.py: the rolling state behind the most recent VaR/ES point of a price series, kept on
+# disk so an end-of-day run only appends the new closes instead of recomputing the whole history.
+# A state holds the running sums of the last window_days daily log returns (mu and sigma of the parametric and Monte
+# Carlo methods) and the last window_days - horizon_days horizon log returns in sorted order (the historical scenarios).
+from __future__ import division
+
+import os
+import math
+import bisect
+import pickle
+from collections import deque
+
+import numpy as np
+
+
+##################  Rolling windows ##################
+
+# Mean and standard deviation (ddof=0) of the last size values, from running sums of the values minus a shift.
+# The sums are recomputed exactly every size pushes, so rounding errors cannot build up.
+class RollingMoments(object):
+    def __init__(self, size):
+        self.size = size
+        self.values = deque()
+        self.shift = None
+        self.sum = 0.0
+        self.sumsq = 0.0
+        self.pushes = 0
+
+    def push(self, x):
+        if self.shift is None:
+            self.shift = x
+        self.values.append(x)
+        self.sum += x - self.shift
+        self.sumsq += (x - self.shift) * (x - self.shift)
+        if len(self.values) > self.size:
+            old = self.values.popleft() - self.shift
+            self.sum -= old
+            self.sumsq -= old * old
+        self.pushes += 1
+        if self.pushes % self.size == 0:
+            self.refresh()
+
+    def refresh(self):
+        self.shift = math.fsum(self.values) / len(self.values)
+        self.sum = math.fsum(x - self.shift for x in self.values)
+        self.sumsq = math.fsum((x - self.shift) * (x - self.shift) for x in self.values)
+
+    def mean(self):
+        return self.sum / len(self.values) + self.shift
+
+    def std(self):
+        mean = self.sum / len(self.values)
+        return math.sqrt(max(self.sumsq / len(self.values) - mean * mean, 0.0))
+
+# The last size values in sorted order, with the sum of exp() of the tail_count smallest ones kept up to date on every
+# push. A push is a binary search plus one list insert and one list delete (memory moves of at most size pointers),
+# instead of the O(size log size) sort of a full recomputation.
+class SortedWindow(object):
+    def __init__(self, size, tail_count):
+        self.size = size
+        self.tail_count = tail_count
+        self.values = deque()
+        self.sorted = []
+        self.tail = 0.0
+        self.pushes = 0
+
+    def push(self, x):
+        self.values.append(x)
+        k = self.tail_count
+        position = bisect.bisect_right(self.sorted, x)
+        self.sorted.insert(position, x)
+        if position < k:
+            self.tail += math.exp(x)
+            if len(self.sorted) > k:
+                self.tail -= math.exp(self.sorted[k])
+        if len(self.values) > self.size:
+            old = self.values.popleft()
+            position = bisect.bisect_left(self.sorted, old)
+            del self.sorted[position]
+            if position < k:
+                self.tail -= math.exp(old)
+                if len(self.sorted) >= k:
+                    self.tail += math.exp(self.sorted[k - 1])
+        self.pushes += 1
+        if self.pushes % self.size == 0:
+            self.refresh()
+
+    def refresh(self):
+        self.tail = math.fsum(math.exp(x) for x in self.sorted[:self.tail_count])
+
+    # index-th smallest value
+    def order_statistic(self, index):
+        return self.sorted[index]
+
+    # Mean of exp() of the tail_count smallest values
+    def tail_mean_exp(self):
+        return self.tail / self.tail_count
+
+
+##################  Rolling risk state ##################
+
+# State of one price series for a window and horizon (in days) and the VaR and ES probabilities of the historical
+# method; ready() once it holds window_days + 1 prices, the history one VaR/ES point of every method needs.
+class RollingRisk(object):
+    def __init__(self, window_days, horizon_days, VaR_prob, ES_prob):
+        self.window_days = window_days
+        self.horizon_days = horizon_days
+        npaths = window_days - horizon_days
+        self.var_index = int(np.ceil((1-VaR_prob)*npaths)) - 1
+        self.moments = RollingMoments(window_days)
+        self.scenarios = SortedWindow(npaths, int(np.ceil((1-ES_prob)*npaths)))
+        self.log_prices = deque(maxlen=horizon_days + 1)
+        self.count = 0
+        self.last_date = None
+        self.last_price = None
+
+    # Append the close of a date later than last_date
+    def append(self, date, price):
+        log_price = math.log(price)
+        if self.log_prices:
+            self.moments.push(log_price - self.log_prices[-1])
+        self.log_prices.append(log_price)
+        if len(self.log_prices) > self.horizon_days:
+            self.scenarios.push(log_price - self.log_prices[0])
+        self.count += 1
+        self.last_date = date
+        self.last_price = price
+
+    def ready(self):
+        return self.count > self.window_days
+
+    # Mean and standard deviation of the daily log returns of the last window_days days (mubar, sigmabar of gbm_est)
+    def estimates(self):
+        return self.moments.mean(), self.moments.std()
+
+    # VaR and ES of the historical method for a position of v0
+    def historical(self, v0):
+        VaR = v0 - v0 * math.exp(self.scenarios.order_statistic(self.var_index))
+        ES = v0 - v0 * self.scenarios.tail_mean_exp()
+        return VaR, ES
+
+# State of prices (a pandas Series in ascending date order) built from its last window_days + 1 prices only
+def build_state(prices, window_days, horizon_days, VaR_prob, ES_prob):
+    if len(prices) <= window_days:
+        raise ValueError('Need more than %d prices for a %d day window, got %d' % (window_days, window_days, len(prices)))
+    state = RollingRisk(window_days, horizon_days, VaR_prob, ES_prob)
+    tail = prices.iloc[-(window_days + 1):]
+    for date, price in zip(tail.index, tail.values):
+        state.append(date, float(price))
+    return state
+
+
+##################  State store ##################
+
+# Rolling states on disk under root/<key>.pkl, written through a temporary file and a rename like the result cache
+class StateStore(object):
+    def __init__(self, root):
+        self.root = root
+
+    def _path(self, key):
+        return os.path.join(self.root, key + '.pkl')
+
+    def get(self, key):
+        try:
+            with open(self._path(key), 'rb') as f:
+                return pickle.load(f)
+        except (IOError, OSError, EOFError, pickle.UnpicklingError):
+            return None
+
+    def put(self, key, state):
+        if not os.path.isdir(self.root):
+            try:
+                os.makedirs(self.root)
+            except OSError:
+                pass
+        tmp = '%s.%d.tmp' % (self._path(key), os.getpid())
+        with open(tmp, 'wb') as f:
+            pickle.dump(state, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp, self._path(key))
+
+    def drop(self, key):
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+    # State of key brought up to the last date of prices (ascending), appending only the dates after the stored state.
+    # The state is rebuilt from prices when there is none, when prices end before it or when its last close was revised.
+    # Returns the state and the number of dates appended (None after a rebuild).
+    def update(self, key, prices, window_days, horizon_days, VaR_prob, ES_prob):
+        state = self.get(key)
+        appended = None
+        if state is not None and state.last_date in prices.index and prices.index[-1] >= state.last_date \
+                and np.isclose(prices[state.last_date], state.last_price, rtol=1e-12, atol=0):
+            new = prices[prices.index > state.last_date]
+            for date, price in zip(new.index, new.values):
+                state.append(date, float(price))
+            appended = len(new)
+        else:
+            state = build_state(prices, window_days, horizon_days, VaR_prob, ES_prob)
+        if appended != 0:
+            self.put(key, state)
+        return state, appended
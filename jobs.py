@@ -0,0 +1,221 @@
+################## Imports ##################
+# Background job queue for long-running risk computations, used by the /jobs routes in app.py.
+# Jobs live in a SQLite file so every gunicorn worker sees the same queue; each worker process that touches the
+# queue runs a dispatcher thread that claims pending jobs and runs them on a local process pool. No broker needed.
+# A claimed job holds a lease that its dispatcher renews while the job runs; a job whose lease ran out (its web
+# worker died) goes back to pending, and fails after max_attempts claims.
+from __future__ import division
+
+import os
+import json
+import time
+import uuid
+import sqlite3
+import hashlib
+import threading
+import multiprocessing
+
+
+##################  Job execution ##################
+
+# Run one job in a pool process. params is one request of the /api/risk format, or {"form": {...}} for an html form
+# submission whose result app.py keeps in its result cache; returns (status, result or error)
+def execute_job(params):
+    try:
+        import app
+        if 'form' in params:
+            return 'done', json.dumps(app.run_form_job(params['form']))
+        result = next(app.run_risk_batch([params]))
+    except Exception as e:
+        return 'failed', str(e)
+    if 'error' in result:
+        return 'failed', result['error']
+    return 'done', json.dumps(result)
+
+
+##################  Job queue ##################
+
+class JobQueue(object):
+    def __init__(self, path, workers=None, poll_interval=0.2, lease=30, timeout=900, max_attempts=3):
+        self.path = path
+        self.workers = workers or multiprocessing.cpu_count()
+        self.poll_interval = poll_interval
+        self.lease = lease
+        self.timeout = timeout
+        self.max_attempts = max_attempts
+        self._lock = threading.Lock()
+        self._pid = None
+        self._pool = None
+        # Claim time of each job running on the current pool
+        self._inflight = {}
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                pass
+        conn = self._connect()
+        try:
+            conn.execute('CREATE TABLE IF NOT EXISTS jobs (id TEXT PRIMARY KEY, key TEXT, params TEXT, status TEXT, '
+                         'result TEXT, error TEXT, created REAL, started REAL, finished REAL)')
+            conn.execute('CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created)')
+            conn.execute('CREATE INDEX IF NOT EXISTS jobs_key ON jobs (key, status)')
+            columns = [row[1] for row in conn.execute('PRAGMA table_info(jobs)')]
+            for column, kind in [('lease', 'REAL'), ('attempts', 'INTEGER DEFAULT 0')]:
+                if column not in columns:
+                    conn.execute('ALTER TABLE jobs ADD COLUMN %s %s' % (column, kind))
+        finally:
+            conn.close()
+
+    # One connection per call: sqlite3 connections cannot be shared between threads
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30, isolation_level=None)
+
+    # Queue a job and return (job id, status); an identical job that is still pending or running is reused
+    def submit(self, params):
+        key = hashlib.sha256(json.dumps(params, sort_keys=True).encode('utf-8')).hexdigest()
+        conn = self._connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            row = conn.execute("SELECT id, status FROM jobs WHERE key = ? AND status IN ('pending', 'running')",
+                               (key,)).fetchone()
+            if row is None:
+                row = (uuid.uuid4().hex, 'pending')
+                conn.execute("INSERT INTO jobs (id, key, params, status, created) VALUES (?, ?, ?, ?, ?)",
+                             (row[0], key, json.dumps(params), row[1], time.time()))
+            conn.execute('COMMIT')
+        finally:
+            conn.close()
+        self.start()
+        return row[0], row[1]
+
+    # Status of a job as a dict, or None for an unknown id
+    def get(self, job_id):
+        conn = self._connect()
+        try:
+            row = conn.execute('SELECT status, result, error, created, started, finished FROM jobs WHERE id = ?',
+                               (job_id,)).fetchone()
+        finally:
+            conn.close()
+        if row is None:
+            return None
+        job = {'id': job_id, 'status': row[0], 'created': row[3], 'started': row[4], 'finished': row[5]}
+        if row[1] is not None:
+            job['result'] = json.loads(row[1])
+        if row[2] is not None:
+            job['error'] = row[2]
+        return job
+
+    # Long poll: wait up to timeout seconds for the job to finish and return its status
+    def wait(self, job_id, timeout):
+        deadline = time.time() + timeout
+        job = self.get(job_id)
+        while job is not None and job['status'] in ('pending', 'running') and time.time() < deadline:
+            time.sleep(self.poll_interval)
+            job = self.get(job_id)
+        return job
+
+    # Start the dispatcher thread of this process (again after a fork, where threads do not survive)
+    def start(self):
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._pool = None
+            self._inflight = {}
+        thread = threading.Thread(target=self._dispatch)
+        thread.daemon = True
+        thread.start()
+
+    def _dispatch(self):
+        self._pool = multiprocessing.Pool(self.workers)
+        renewed = time.time()
+        while True:
+            if time.time() - renewed > self.lease / 3:
+                try:
+                    self._renew()
+                    renewed = time.time()
+                except sqlite3.Error:
+                    pass
+            claimed = None
+            if len(self._inflight) < self.workers:
+                try:
+                    claimed = self._claim()
+                except sqlite3.Error:
+                    claimed = None
+            if claimed is None:
+                time.sleep(self.poll_interval)
+                continue
+            job_id, params = claimed
+            pool = self._pool
+            with self._lock:
+                self._inflight[job_id] = time.time()
+            pool.apply_async(execute_job, (json.loads(params),),
+                             callback=lambda outcome, job_id=job_id: self._finish(job_id, outcome, pool),
+                             error_callback=lambda e, job_id=job_id: self._finish(job_id, ('failed', repr(e)), pool))
+
+    # Extend the lease of the jobs of this process. A pool cannot cancel one task, and loses the task of a worker
+    # process that dies, so once a job has run for longer than timeout the pool is terminated and replaced: that job
+    # fails, or is retried while it has attempts left, and the other jobs of the pool go back to pending.
+    def _renew(self):
+        now = time.time()
+        with self._lock:
+            job_ids = list(self._inflight)
+            stuck = [job_id for job_id in job_ids if now - self._inflight[job_id] > self.timeout]
+        if not job_ids:
+            return
+        if stuck:
+            self._pool.terminate()
+            with self._lock:
+                self._pool = multiprocessing.Pool(self.workers)
+                self._inflight = {}
+        conn = self._connect()
+        try:
+            if stuck:
+                conn.execute("UPDATE jobs SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, "
+                             "error = CASE WHEN attempts >= ? THEN 'Timed out after %d seconds' END, "
+                             "finished = CASE WHEN attempts >= ? THEN ? END, started = NULL "
+                             "WHERE status = 'running' AND id IN (%s)" % (self.timeout, ','.join('?' * len(stuck))),
+                             [self.max_attempts, self.max_attempts, self.max_attempts, now] + stuck)
+                conn.execute("UPDATE jobs SET status = 'pending', started = NULL WHERE status = 'running' AND id IN (%s)"
+                             % ','.join('?' * len(job_ids)), job_ids)
+            else:
+                conn.execute("UPDATE jobs SET lease = ? WHERE status = 'running' AND id IN (%s)"
+                             % ','.join('?' * len(job_ids)), [now + self.lease] + job_ids)
+        finally:
+            conn.close()
+
+    # Atomically requeue running jobs whose lease ran out (failing those out of attempts), then move the oldest
+    # pending job to running; the immediate transaction keeps other processes out
+    def _claim(self):
+        now = time.time()
+        conn = self._connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            conn.execute("UPDATE jobs SET status = 'failed', error = 'Gave up after %d attempts', finished = ? "
+                         "WHERE status = 'running' AND lease < ? AND attempts >= ?" % self.max_attempts,
+                         (now, now, self.max_attempts))
+            conn.execute("UPDATE jobs SET status = 'pending', started = NULL WHERE status = 'running' AND lease < ?",
+                         (now,))
+            row = conn.execute("SELECT id, params FROM jobs WHERE status = 'pending' ORDER BY created LIMIT 1").fetchone()
+            if row is not None:
+                conn.execute("UPDATE jobs SET status = 'running', started = ?, lease = ?, "
+                             "attempts = COALESCE(attempts, 0) + 1 WHERE id = ?", (now, now + self.lease, row[0]))
+            conn.execute('COMMIT')
+        finally:
+            conn.close()
+        return row
+
+    # Record the outcome of a job run on pool; results of a pool replaced in the meantime are dropped
+    def _finish(self, job_id, outcome, pool):
+        if pool is not self._pool:
+            return
+        status, payload = outcome
+        conn = self._connect()
+        try:
+            conn.execute("UPDATE jobs SET status = ?, %s = ?, finished = ? WHERE id = ? AND status = 'running'"
+                         % ('result' if status == 'done' else 'error'), (status, payload, time.time(), job_id))
+        finally:
+            conn.close()
+        with self._lock:
+            self._inflight.pop(job_id, None)
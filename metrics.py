@@ -0,0 +1,260 @@
+################## Imports ##################
+# Request instrumentation for app.py: per-stage timings returned in a Server-Timing header, histograms and counters
+# served in the Prometheus text format on /metrics, and an opt-in sampling profiler.
+# Set METRICS_ENABLED=0 to turn it off; stage() then hands out one shared no-op context manager.
+# Every gunicorn worker keeps its own registry, so /metrics describes the worker that answers the scrape.
+from __future__ import division
+
+import os
+import sys
+import timeit
+import bisect
+import threading
+from collections import defaultdict
+
+from flask import Response, g, has_request_context, request
+
+ENABLED = os.environ.get('METRICS_ENABLED', '1') != '0'
+
+# ?profile=1 is only honoured when PROFILE_REQUESTS=1, so the profiler cannot be switched on by any visitor
+PROFILE_REQUESTS = os.environ.get('PROFILE_REQUESTS', '0') == '1'
+PROFILE_INTERVAL = float(os.environ.get('PROFILE_INTERVAL', 0.005))
+
+LATENCY_BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]
+SIZE_BUCKETS = [4**i for i in range(13)]
+
+
+##################  Registry ##################
+
+class Histogram(object):
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+# Metric families by name; each holds one histogram or counter per label set
+class Registry(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._families = {}
+
+    def describe(self, name, kind, help_text, buckets=None):
+        self._families[name] = (kind, help_text, buckets, {})
+
+    def observe(self, name, value, **labels):
+        kind, help_text, buckets, series = self._families[name]
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            if key not in series:
+                series[key] = Histogram(buckets)
+            series[key].observe(value)
+
+    def inc(self, name, value=1, **labels):
+        kind, help_text, buckets, series = self._families[name]
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series[key] = series.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        kind, help_text, buckets, series = self._families[name]
+        with self._lock:
+            series[tuple(sorted(labels.items()))] = value
+
+    # Sum of every histogram of family name by the value of one of its labels
+    def totals(self, name, label):
+        kind, help_text, buckets, series = self._families[name]
+        totals = defaultdict(float)
+        with self._lock:
+            for key, histogram in series.items():
+                totals[dict(key).get(label)] += histogram.sum
+        return dict(totals)
+
+    # Prometheus text exposition format, version 0.0.4
+    def render(self):
+        lines = []
+        with self._lock:
+            for name in sorted(self._families):
+                kind, help_text, buckets, series = self._families[name]
+                lines.append('# HELP %s %s' % (name, help_text))
+                lines.append('# TYPE %s %s' % (name, kind))
+                for key in sorted(series):
+                    if kind in ('counter', 'gauge'):
+                        lines.append('%s%s %s' % (name, format_labels(key), series[key]))
+                        continue
+                    histogram = series[key]
+                    cumulative = 0
+                    for bound, count in zip(buckets + ['+Inf'], histogram.counts):
+                        cumulative += count
+                        lines.append('%s_bucket%s %d' % (name, format_labels(key + (('le', str(bound)),)), cumulative))
+                    lines.append('%s_sum%s %r' % (name, format_labels(key), histogram.sum))
+                    lines.append('%s_count%s %d' % (name, format_labels(key), cumulative))
+        return '\n'.join(lines) + '\n'
+
+def format_labels(key):
+    if not key:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in key)
+
+registry = Registry()
+registry.describe('risk_request_seconds', 'histogram', 'Request latency by endpoint.', LATENCY_BUCKETS)
+registry.describe('risk_stage_seconds', 'histogram', 'Time spent in each stage of a request.', LATENCY_BUCKETS)
+registry.describe('risk_array_size', 'histogram', 'Number of elements in the main arrays of a computation.',
+                  SIZE_BUCKETS)
+registry.describe('risk_cache_requests_total', 'counter', 'Cache lookups by cache and result (hit or miss).')
+registry.describe('risk_startup_seconds', 'gauge', 'Seconds taken by each startup phase of this process: import of '
+                  'the app, each warm-up step, the first request and the time from the start of the import to the '
+                  'end of the first response.')
+
+
+##################  Stages ##################
+
+class _NullStage(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+_NULL_STAGE = _NullStage()
+
+class _Stage(object):
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = timeit.default_timer()
+        return self
+
+    def __exit__(self, *exc_info):
+        elapsed = timeit.default_timer() - self.start
+        registry.observe('risk_stage_seconds', elapsed, stage=self.name)
+        if has_request_context():
+            timings = getattr(g, 'stage_timings', None)
+            if timings is not None:
+                timings[self.name] += elapsed
+        return False
+
+# Time the body of a with statement as the named stage of the current request
+def stage(name):
+    return _Stage(name) if ENABLED else _NULL_STAGE
+
+# Seconds spent in each stage by this process so far, e.g. to report the stages of a batch run outside requests
+def stage_totals():
+    return registry.totals('risk_stage_seconds', 'stage')
+
+def observe_size(name, size):
+    if ENABLED:
+        registry.observe('risk_array_size', size, array=name)
+
+def cache_lookup(cache, hit):
+    if ENABLED:
+        registry.inc('risk_cache_requests_total', cache=cache, result='hit' if hit else 'miss')
+
+
+##################  Startup ##################
+
+# Start of the app import, set by app.py; processes forked from a preloaded app share it, so the first response of
+# each worker is timed from the import in the master process
+startup = {'import_start': None, 'first_response': False}
+
+# Record the seconds one startup phase took, and print it so it shows in the server log
+def startup_phase(phase, seconds):
+    if ENABLED:
+        registry.set('risk_startup_seconds', seconds, phase=phase)
+    sys.stderr.write('[%d] startup %s: %.3f s\n' % (os.getpid(), phase, seconds))
+
+
+##################  Sampling profiler ##################
+
+# Samples the stack of one thread every interval seconds from a background thread; collapsed() gives the
+# "frame;frame;frame count" lines read by flame graph tools
+class Sampler(object):
+    def __init__(self, thread_id, interval=PROFILE_INTERVAL):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.counts = defaultdict(int)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append('%s:%s' % (os.path.basename(code.co_filename), code.co_name))
+                frame = frame.f_back
+            if stack:
+                self.counts[';'.join(reversed(stack))] += 1
+
+    def collapsed(self):
+        return ''.join('%s %d\n' % (stack, count) for stack, count in
+                       sorted(self.counts.items(), key=lambda item: -item[1]))
+
+
+##################  Flask hooks ##################
+
+def before_request():
+    if not ENABLED:
+        return
+    g.request_start = timeit.default_timer()
+    g.stage_timings = defaultdict(float)
+    if PROFILE_REQUESTS and request.args.get('profile') == '1':
+        g.sampler = Sampler(threading.current_thread().ident).start()
+
+# Record the latency of the request (and the startup phases on the first response of the process)
+def _record(start, endpoint):
+    end = timeit.default_timer()
+    total = end - start
+    registry.observe('risk_request_seconds', total, endpoint=endpoint or 'unknown')
+    if not startup['first_response']:
+        startup['first_response'] = True
+        startup_phase('first_request', total)
+        if startup['import_start'] is not None:
+            startup_phase('first_response', end - startup['import_start'])
+    return total
+
+# A streamed response (see stream_with_context) still runs its stages after this hook, so it gets no Server-Timing
+# header, whose values would stop at the first byte; its latency is recorded when the stream is closed. With
+# ?profile=1 the stream is run to its end first so the profile covers it.
+def after_request(response):
+    if not ENABLED or getattr(g, 'request_start', None) is None:
+        return response
+    sampler = getattr(g, 'sampler', None)
+    if response.is_streamed and sampler is None:
+        response.call_on_close(lambda start=g.request_start, endpoint=request.endpoint: _record(start, endpoint))
+        return response
+    if sampler is not None and response.is_streamed:
+        response.get_data()
+    total = _record(g.request_start, request.endpoint)
+    entries = ['%s;dur=%.2f' % (name, seconds * 1000) for name, seconds in g.stage_timings.items()]
+    entries.append('total;dur=%.2f' % (total * 1000))
+    response.headers['Server-Timing'] = ', '.join(entries)
+    if sampler is not None:
+        sampler.stop()
+        response.set_data(sampler.collapsed())
+        response.mimetype = 'text/plain'
+        response.direct_passthrough = False
+    return response
+
+# Register the hooks and the /metrics route on a Flask app
+def init_app(app):
+    app.before_request(before_request)
+    app.after_request(after_request)
+
+    @app.route('/metrics', methods=['GET'])
+    def metrics():
+        return Response(registry.render(), mimetype='text/plain; version=0.0.4')
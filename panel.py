@@ -0,0 +1,173 @@
+################## Imports ##################
+# Universe panel: the prices of every ticker of the price store on one common calendar, as float64 matrices in .npy
+# files that app.py memory-maps read-only. Loaded when app.py is imported (before gunicorn
+# forks with --preload, or from the page cache otherwise), so all workers share the same pages, and requests slice
+# it without building frames of their own.
+#
+#   python panel.py                      rebuild data/universe from the price store in data/prices
+#   python panel.py --prices DIR --out DIR
+#
+# Layout under root: index.json names the current generation directory, which holds
+#   days.npy     int64 (ndates,), days since 1970-01-01, most recent first like the frames of app.py
+#   prices.npy   float64 (ntickers, ndates); row i is ticker i, so the series of one ticker is contiguous
+#   own.npy      bool (ntickers, ndates); own[i, t] is True where ticker i has a price of its own on date t
+# A ticker's prices are NaN on the dates it does not have (e.g. exchange holidays of other tickers), so frames and
+# portfolios follow the same rule as PriceStore.get_prices and portfolio_from_prices in app.py.
+from __future__ import division, print_function
+
+import os
+import sys
+import glob
+import json
+import time
+import shutil
+import argparse
+
+import numpy as np
+import pandas as pd
+
+from price_store import to_day, from_days
+
+
+##################  Panel ##################
+
+class UniversePanel(object):
+    def __init__(self, days, tickers, ranges, coverage, prices, own):
+        self.days = days
+        self.tickers = tickers
+        self.rows = dict((ticker, i) for i, ticker in enumerate(tickers))
+        # Columns [first, last) of each ticker holding prices, and the date range (in days) covered for all tickers
+        self.ranges = ranges
+        self.coverage = coverage
+        self.prices = prices
+        self.own = own
+        self.dates = from_days(days)
+        self._neg_days = -days
+
+    # Memory-mapped panel under root, or None when there is none
+    @classmethod
+    def load(cls, root):
+        try:
+            with open(os.path.join(root, 'index.json')) as f:
+                index = json.load(f)
+            directory = os.path.join(root, index['generation'])
+            days = np.load(os.path.join(directory, 'days.npy'))
+            prices = np.load(os.path.join(directory, 'prices.npy'), mmap_mode='r')
+            own = np.load(os.path.join(directory, 'own.npy'), mmap_mode='r')
+        except (IOError, OSError, ValueError, KeyError):
+            return None
+        return cls(days, index['tickers'], [tuple(r) for r in index['ranges']], tuple(index['coverage']), prices, own)
+
+    # Whether every ticker is in the panel and the panel holds all of their prices between the two dates
+    def covers(self, tickers_list, start_date, end_date):
+        return (all(ticker in self.rows for ticker in tickers_list) and
+                self.coverage[0] <= to_day(start_date) and to_day(end_date) <= self.coverage[1])
+
+    # Columns [lo, hi) between the two dates where all the tickers (any of them with union) have prices
+    def _columns(self, tickers_list, start_date, end_date, union=False):
+        lo = np.searchsorted(self._neg_days, -to_day(end_date), side='left')
+        hi = np.searchsorted(self._neg_days, -to_day(start_date), side='right')
+        ranges = [self.ranges[self.rows[ticker]] for ticker in tickers_list]
+        if union:
+            lo, hi = max(lo, min(r[0] for r in ranges)), min(hi, max(r[1] for r in ranges))
+        else:
+            lo, hi = max([lo] + [r[0] for r in ranges]), min([hi] + [r[1] for r in ranges])
+        return int(lo), int(max(hi, lo))
+
+    # Prices of the tickers between the two dates, most recent first, as a frame with one column per ticker and NaN
+    # where a ticker has no price of its own (as PriceStore.get_prices): the dates are those where any of the tickers
+    # has a price. The frame of one ticker is a view of the memory map when it has all the dates in between; several
+    # tickers take one copy of their rows.
+    def frame(self, tickers_list, start_date, end_date):
+        lo, hi = self._columns(tickers_list, start_date, end_date, union=True)
+        rows = [self.rows[ticker] for ticker in tickers_list]
+        dates = self.dates[lo:hi]
+        if len(rows) == 1:
+            values, own = self.prices[rows[0]:rows[0] + 1, lo:hi], self.own[rows[0], lo:hi]
+            if not own.all():
+                values, dates = values[:, own], dates[own]
+        else:
+            values = self.prices[rows, lo:hi]
+            keep = self.own[rows, lo:hi].any(axis=0)
+            if not keep.all():
+                values, dates = values[:, keep], dates[keep]
+        return pd.DataFrame(values.T, index=dates, columns=tickers_list, copy=False)
+
+    # Value of a portfolio buying v0 * weight worth of each ticker at position_date and holding the shares, summed row
+    # by row from slices of the memory map. As portfolio_from_prices in app.py on the frame of the tickers, the value
+    # is NaN on the dates where one of the tickers has no price of its own.
+    def portfolio(self, tickers_list, weights_list, v0, position_date, start_date, end_date, name):
+        lo, hi = self._columns(tickers_list, start_date, end_date, union=True)
+        column = lo + int(np.searchsorted(self._neg_days[lo:hi], -to_day(position_date)))
+        rows = [self.rows[ticker] for ticker in tickers_list]
+        keep = self.own[rows, lo:hi].any(axis=0)
+        if column >= hi or self.days[column] != to_day(position_date) or not keep[column - lo]:
+            raise KeyError(pd.Timestamp(position_date))
+        shares = np.round(np.divide(v0 * np.array(weights_list), self.prices[rows, column]))
+        values = np.zeros(hi - lo)
+        for row, share in zip(rows, shares):
+            values += share * self.prices[row, lo:hi]
+        return pd.DataFrame({name: values[keep]}, index=self.dates[lo:hi][keep])
+
+
+##################  Build ##################
+
+# Build the panel of the tickers in a price store directory (all of them by default) under root, writing a new
+# generation and switching index.json to it once complete; readers that mapped an older generation keep their pages.
+def build_panel(store_root, root, tickers_list=None):
+    if tickers_list is None:
+        tickers_list = sorted(os.path.basename(path)[:-len('.json')]
+                              for path in glob.glob(os.path.join(store_root, '*.json')))
+    series = []
+    coverage = None
+    for ticker in tickers_list:
+        with open(os.path.join(store_root, '%s.json' % ticker.replace('/', '_'))) as f:
+            meta = json.load(f)
+        data = np.load(os.path.join(store_root, '%s.npy' % ticker.replace('/', '_')))
+        series.append(data)
+        coverage = (meta['first_day'], meta['last_day']) if coverage is None else (
+            max(coverage[0], meta['first_day']), min(coverage[1], meta['last_day']))
+    days = np.unique(np.concatenate([data[0] for data in series] + [np.empty(0)])).astype(np.int64)[::-1]
+    prices = np.full((len(tickers_list), len(days)), np.nan)
+    own = np.zeros(prices.shape, dtype=bool)
+    ranges = []
+    for i, data in enumerate(series):
+        columns = len(days) - 1 - np.searchsorted(days[::-1], data[0].astype(np.int64))
+        prices[i, columns] = data[1]
+        own[i, columns] = True
+        first, last = (int(columns.min()), int(columns.max()) + 1) if len(columns) else (0, 0)
+        ranges.append((first, last))
+    generation = '%d.%d' % (int(time.time() * 1000), os.getpid())
+    directory = os.path.join(root, generation)
+    os.makedirs(directory)
+    for name, values in [('days', days), ('prices', prices), ('own', own)]:
+        np.save(os.path.join(directory, '%s.npy' % name), values)
+    tmp = os.path.join(root, 'index.json.%d.tmp' % os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump({'generation': generation, 'tickers': list(tickers_list), 'ranges': ranges,
+                   'coverage': list(coverage) if coverage is not None else [0, -1]}, f)
+    os.rename(tmp, os.path.join(root, 'index.json'))
+    # Mapped files stay readable after they are removed, so older generations can go
+    for path in glob.glob(os.path.join(root, '*')):
+        if os.path.isdir(path) and os.path.basename(path) != generation:
+            shutil.rmtree(path, ignore_errors=True)
+    return UniversePanel.load(root)
+
+
+##################  Main ##################
+
+def main():
+    parser = argparse.ArgumentParser(description='Rebuild the universe panel from the price store.')
+    parser.add_argument('--prices', default=os.environ.get('PRICE_STORE_DIR', 'data/prices'),
+                        help='price store directory')
+    parser.add_argument('--out', default=os.environ.get('UNIVERSE_DIR', 'data/universe'), help='panel directory')
+    parser.add_argument('--tickers', help='comma-separated tickers (default: every ticker of the price store)')
+    args = parser.parse_args()
+    panel = build_panel(args.prices, args.out, args.tickers.replace(' ', '').split(',') if args.tickers else None)
+    print('%d tickers x %d dates in %s, covering %s to %s' % (len(panel.tickers), len(panel.days), args.out,
+                                                              from_days([panel.coverage[0]])[0].date(),
+                                                              from_days([panel.coverage[1]])[0].date()))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,195 @@
+################## Imports ##################
+# On-disk price store used by app.py so that repeated plots do not re-download the same history.
+from __future__ import division
+
+import os
+import glob
+import json
+import datetime
+import threading
+from multiprocessing.pool import ThreadPool
+
+import pandas as pd
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+##################  Providers ##################
+# A provider is any callable provider(ticker, start_date, end_date) returning a pandas Series of
+# adjusted close prices indexed by date, inclusive of both ends.
+
+# Default provider: adjusted close prices from Yahoo through pandas_datareader
+def yahoo_provider(ticker, start_date, end_date):
+    import pandas_datareader.data as web
+    return web.DataReader(ticker, 'yahoo', start_date, end_date)['Adj Close']
+
+# Offline provider serving the price csv files written by plot_price, e.g. tests/price_AAPL_2000-12-01_2016-12-01.csv
+class CSVProvider(object):
+    def __init__(self, directories=('tests', 'outputs')):
+        self.files = {}
+        for directory in directories:
+            for path in sorted(glob.glob(os.path.join(directory, 'price_*.csv'))):
+                ticker = os.path.basename(path)[len('price_'):-len('.csv')].rsplit('_', 2)[0]
+                self.files.setdefault(ticker, path)
+        self._series = {}
+
+    def __call__(self, ticker, start_date, end_date):
+        if ticker not in self.files:
+            raise ValueError('No price file for ticker %s' % ticker)
+        if ticker not in self._series:
+            self._series[ticker] = pd.read_csv(self.files[ticker], index_col=0, parse_dates=True).iloc[:, 0]
+        series = self._series[ticker]
+        return series[(series.index >= start_date) & (series.index <= end_date)]
+
+# Pick the provider from the PRICE_PROVIDER environment variable ('yahoo' or 'csv')
+def provider_from_env():
+    if os.environ.get('PRICE_PROVIDER', 'yahoo') == 'csv':
+        return CSVProvider()
+    return yahoo_provider
+
+
+##################  Price store ##################
+
+EPOCH = pd.Timestamp('1970-01-01')
+
+def to_day(date):
+    return (pd.Timestamp(date).normalize() - EPOCH).days
+
+def from_days(days):
+    return pd.to_datetime(np.asarray(days, dtype=np.int64), unit='D')
+
+# Shared result of one fetch; later callers asking for the same fetch wait on it instead of downloading again
+class _InFlight(object):
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+# Per-ticker store under root:
+#   <ticker>.npy  - float64 array of shape (2, n): row 0 is days since 1970-01-01, row 1 is the adjusted close.
+#                   Rows are contiguous so each column of data can be memory-mapped on its own.
+#   <ticker>.json - the date range already requested from the provider, so weekends and holidays are not re-fetched.
+# Writers replace the .npy before the .json and readers read the .json first, so a reader never sees a
+# covered range that the data file does not hold yet.
+class PriceStore(object):
+    def __init__(self, root, provider=None, max_workers=8):
+        self.root = root
+        self.provider = provider if provider is not None else yahoo_provider
+        self.max_workers = max_workers
+        self._lock = threading.Lock()
+        self._inflight = {}
+
+    def _path(self, ticker, ext):
+        return os.path.join(self.root, '%s.%s' % (ticker.replace('/', '_'), ext))
+
+    def _load(self, ticker):
+        try:
+            with open(self._path(ticker, 'json')) as f:
+                meta = json.load(f)
+            data = np.load(self._path(ticker, 'npy'), mmap_mode='r')
+        except (IOError, OSError, ValueError):
+            return None, None
+        return data, (meta['first_day'], meta['last_day'])
+
+    def _save(self, ticker, data, coverage):
+        for ext, write in [('npy', lambda f: np.save(f, data)),
+                           ('json', lambda f: json.dump({'first_day': coverage[0], 'last_day': coverage[1]}, f))]:
+            tmp = self._path(ticker, '%s.%d.tmp' % (ext, os.getpid()))
+            with open(tmp, 'wb' if ext == 'npy' else 'w') as f:
+                write(f)
+            os.rename(tmp, self._path(ticker, ext))
+
+    # Date ranges (in days) of [first_day, last_day] not yet covered by the store
+    @staticmethod
+    def _gaps(coverage, first_day, last_day):
+        if coverage is None:
+            return [(first_day, last_day)]
+        gaps = []
+        # Gaps always reach the covered range so that the covered range stays contiguous
+        if first_day < coverage[0]:
+            gaps.append((first_day, coverage[0] - 1))
+        if last_day > coverage[1]:
+            gaps.append((coverage[1] + 1, last_day))
+        return gaps
+
+    # Fetch the missing head/tail ranges and merge them into the store, under a per-ticker file lock
+    def _fill(self, ticker, first_day, last_day):
+        if not os.path.isdir(self.root):
+            try:
+                os.makedirs(self.root)
+            except OSError:
+                pass
+        with open(self._path(ticker, 'lock'), 'w') as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            data, coverage = self._load(ticker)
+            gaps = self._gaps(coverage, first_day, last_day)
+            if not gaps:
+                return data, coverage
+            pieces = [] if data is None else [np.array(data)]
+            for gap_first, gap_last in gaps:
+                fetched = self.provider(ticker, from_days([gap_first])[0], from_days([gap_last])[0]).dropna()
+                days = np.array([to_day(date) for date in fetched.index], dtype=np.float64)
+                pieces.append(np.vstack([days, np.asarray(fetched, dtype=np.float64)]))
+            merged = np.hstack(pieces)
+            _, first = np.unique(merged[0], return_index=True)
+            data = merged[:, first]
+            # Today's close may still change, so only ranges up to yesterday count as covered
+            last_final = to_day(datetime.datetime.now()) - 1
+            covered_first = first_day if coverage is None else min(first_day, coverage[0])
+            covered_last = min(last_day if coverage is None else max(last_day, coverage[1]), last_final)
+            coverage = (covered_first, max(covered_last, covered_first - 1))
+            self._save(ticker, data, coverage)
+            return data, coverage
+
+    # Coalesce identical concurrent fills so only one of them reaches the provider
+    def _fill_once(self, ticker, first_day, last_day):
+        key = (ticker, first_day, last_day)
+        with self._lock:
+            call = self._inflight.get(key)
+            owner = call is None
+            if owner:
+                call = self._inflight[key] = _InFlight()
+        if not owner:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = self._fill(ticker, first_day, last_day)
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._inflight[key]
+            call.event.set()
+        return call.result
+
+    # Adjusted close prices of one ticker between start_date and end_date, ascending by date
+    def get_series(self, ticker, start_date, end_date):
+        first_day, last_day = to_day(start_date), to_day(end_date)
+        data, coverage = self._load(ticker)
+        if self._gaps(coverage, first_day, last_day):
+            data, coverage = self._fill_once(ticker, first_day, last_day)
+        if data is None:
+            return pd.Series([], index=pd.DatetimeIndex([]), name=ticker, dtype=np.float64)
+        lo, hi = np.searchsorted(data[0], [first_day, last_day + 1])
+        return pd.Series(np.asarray(data[1, lo:hi]), index=from_days(data[0, lo:hi]), name=ticker)
+
+    # DataFrame of adjusted close prices with one column per ticker, fetching tickers concurrently
+    def get_prices(self, tickers_list, start_date, end_date):
+        fetch = lambda ticker: self.get_series(ticker, start_date, end_date)
+        if len(tickers_list) > 1 and self.max_workers > 1:
+            pool = ThreadPool(min(len(tickers_list), self.max_workers))
+            try:
+                series_list = pool.map(fetch, tickers_list)
+            finally:
+                pool.close()
+        else:
+            series_list = [fetch(ticker) for ticker in tickers_list]
+        return pd.concat(series_list, axis=1, keys=tickers_list)
@@ -0,0 +1,103 @@
+################## Imports ##################
+# Content-addressed result cache shared by all gunicorn workers through the file system.
+# Entries are pickled under root/<namespace>/<first two hex digits>/<sha256 of the normalized inputs>, so the ids of
+# one kind of entry (results, downloads, plotted series) never find an entry of another; a hit touches the file, so
+# file modification times order the entries for least-recently-used eviction once max_bytes is exceeded.
+# Each process adds the size of what it writes to the total of its last scan of the tree, and only scans it again
+# (seeing the entries of other workers) when that total goes over max_bytes or the scan is rescan seconds old.
+from __future__ import division
+
+import os
+import json
+import time
+import hashlib
+import pickle
+
+
+class ResultCache(object):
+    def __init__(self, root, max_bytes=512*1024*1024, rescan=60):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.rescan = rescan
+        self._total = None
+        self._scanned = 0
+
+    # Key of a result: sha256 of its name and normalized inputs (json with sorted keys)
+    @staticmethod
+    def key(name, inputs):
+        text = json.dumps([name, inputs], sort_keys=True, default=str)
+        return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+    def _path(self, key, namespace):
+        return os.path.join(self.root, namespace, key[:2], key + '.pkl')
+
+    def contains(self, key, namespace='results'):
+        return os.path.exists(self._path(key, namespace))
+
+    # Cached value for key in namespace, or None; also None when the value is not an instance of kind
+    def get(self, key, namespace='results', kind=None):
+        path = self._path(key, namespace)
+        try:
+            with open(path, 'rb') as f:
+                value = pickle.load(f)
+        except (IOError, OSError, EOFError, pickle.UnpicklingError):
+            return None
+        if kind is not None and not isinstance(value, kind):
+            return None
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        return value
+
+    # Store value under key; the file is renamed into place so readers in other workers never see half an entry
+    def put(self, key, value, namespace='results'):
+        path = self._path(key, namespace)
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                pass
+        try:
+            replaced = os.path.getsize(path)
+        except OSError:
+            replaced = 0
+        tmp = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp, 'wb') as f:
+            pickle.dump(value, f, pickle.HIGHEST_PROTOCOL)
+            size = f.tell()
+        os.rename(tmp, path)
+        if self._total is None or time.time() - self._scanned > self.rescan:
+            self.evict()
+            return
+        self._total += size - replaced
+        if self._total > self.max_bytes:
+            self.evict()
+
+    # Scan the tree and delete the least recently used entries until the cache is below max_bytes again
+    def evict(self):
+        entries = []
+        total = 0
+        for directory, _, files in os.walk(self.root):
+            for name in files:
+                if not name.endswith('.pkl'):
+                    continue
+                path = os.path.join(directory, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+                total += stat.st_size
+        self._scanned = time.time()
+        if total > self.max_bytes:
+            for mtime, size, path in sorted(entries):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                total -= size
+                if total <= self.max_bytes:
+                    break
+        self._total = total
@@ -0,0 +1,38 @@
+################## Imports ##################
+# Shared setup of the tests: app.py is imported offline, with the price csv files in tests/ as its provider and its
+# stores in a temporary directory.
+#
+#   python -m pytest tests
+from __future__ import division
+
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+WORK_DIR = tempfile.mkdtemp(prefix='risk-tests-')
+os.environ['PRICE_PROVIDER'] = 'csv'
+os.environ.setdefault('PRICE_STORE_DIR', os.path.join(WORK_DIR, 'prices'))
+os.environ.setdefault('RESULT_CACHE_DIR', os.path.join(WORK_DIR, 'results'))
+os.environ.setdefault('JOBS_DB', os.path.join(WORK_DIR, 'jobs.sqlite'))
+os.environ.setdefault('INCREMENTAL_DIR', os.path.join(WORK_DIR, 'incremental'))
+os.environ.setdefault('UNIVERSE_DIR', os.path.join(WORK_DIR, 'universe'))
+os.environ.setdefault('FORM_JOBS', '0')
+# The csv provider reads tests/ and outputs/ relative to the working directory, as the app does
+os.chdir(ROOT)
+sys.path.insert(0, ROOT)
+
+import pandas as pd
+import pytest
+
+
+##################  Fixtures ##################
+
+# A csv file of tests/, e.g. the price history or the expected results of one ticker
+def read_fixture(name):
+    return pd.read_csv(os.path.join(ROOT, 'tests', name), index_col=0, parse_dates=True)
+
+# Prices of the fixture tickers, most recent first
+@pytest.fixture(scope='session', params=['AAPL', 'Portfolio_AAPL_MSFT'])
+def price(request):
+    return read_fixture('price_%s_2000-12-01_2016-12-01.csv' % request.param).iloc[:, 0].rename(request.param)
@@ -0,0 +1,35 @@
+################## Imports ##################
+# Tests of the VaR backtesting grid of app.py
+from __future__ import division
+
+import numpy as np
+
+import app
+
+
+##################  Backtesting ##################
+
+# The parametric VaR of backtest_var starts with the window ending on the most recent date, like the losses it is
+# compared with
+def test_backtest_var_starts_with_latest_window(price):
+    rtn = -np.diff(np.log(price.values))
+    VaR = app.backtest_var(10000, price, 'Parametric VaR/ES', 2, 5, [0.99], None)
+    sigma = np.std(rtn[:2*252]) * np.sqrt(252)
+    mu = np.mean(rtn[:2*252])*252 + sigma*sigma/2
+    assert np.isclose(VaR[0, 0], app.parametric(10000, mu, sigma, 0.99, 0.975, 5/252)[0])
+
+# Every method has one VaR per level and date, from the most recent back to the first full window
+def test_backtest_var_shapes(price):
+    shocks = np.sort(np.random.RandomState(0).standard_normal(5000))
+    for method in app.BACKTEST_METHODS:
+        VaR = app.backtest_var(10000, price, method, 1, 5, [0.95, 0.99], shocks)
+        assert VaR.shape == (2, len(price) - 252)
+        assert np.all(VaR[1] >= VaR[0])
+
+def test_backtest_grid_rows(price):
+    summary = app.backtest_grid(10000, price, app.BACKTEST_METHODS, [1, 2], [1, 5], [0.95, 0.99], plot_length=1000,
+                                seed=0)
+    assert len(summary) == len(app.BACKTEST_METHODS) * 2 * 2 * 2
+    assert (summary['Observations'] > 0).all()
+    assert (summary['Exceedances'] <= summary['Observations']).all()
+    assert np.allclose(summary['Expected'], (1 - summary['VaR probability']) * summary['Observations'])
@@ -0,0 +1,44 @@
+################## Imports ##################
+# Tests of the rolling GBM estimates of app.py against the results in tests/
+from __future__ import division
+
+import numpy as np
+
+import app
+from conftest import read_fixture
+
+
+##################  Rolling estimates ##################
+
+# The fixtures hold mu and sigma of the 2, 5 and 10 year windows, most recent date first, from a longer history than
+# the price files; every window the price files cover must match
+def test_gbm_est_matches_fixture(price):
+    expected = read_fixture('mu_sigma_%s_2000-11-21_2016-12-01.csv' % price.name)
+    for years in [2, 5, 10]:
+        rtn, mu, sigma, mubar, sigmabar = app.gbm_est(price, years*252)
+        assert len(mu) == len(price) - years*252
+        assert np.allclose(mu, expected['Mu_%d' % years].values[:len(mu)], rtol=1e-9, atol=1e-10)
+        assert np.allclose(sigma, expected['Sigma_%d' % years].values[:len(sigma)], rtol=1e-9, atol=1e-10)
+
+# Element 0 is the window of the window_days most recent returns
+def test_gbm_est_latest_window(price):
+    rtn, mu, sigma, mubar, sigmabar = app.gbm_est(price, 252)
+    assert np.isclose(mubar[0], np.mean(rtn[:252]))
+    assert np.isclose(sigmabar[0], np.std(rtn[:252]))
+
+# Windows computed together, or served from rolling_cache, are the same as windows computed alone
+def test_rolling_estimates_shared(price):
+    rtn, estimates = app.rolling_estimates(price, [252, 2*252])
+    with app.rolling_cache_lock:
+        app.rolling_cache.clear()
+    for i in range(2):
+        rtn, mu, sigma, mubar, sigmabar = app.gbm_est(price, 2*252)
+        assert np.array_equal(estimates[2*252][0], mubar)
+        assert np.array_equal(estimates[2*252][1], sigmabar)
+
+def test_parametric_matches_fixture(price):
+    expected = read_fixture('Parametric_%s_2000-12-01_2016-12-01.csv' % price.name)
+    rtn, mu, sigma, mubar, sigmabar = app.gbm_est(price, 2*252)
+    VaR, ES = app.parametric(10000, mu, sigma, 0.99, 0.975, 5/252)
+    assert np.allclose(VaR, expected['VaR'].values[:len(VaR)], rtol=1e-8)
+    assert np.allclose(ES, expected['ES'].values[:len(ES)], rtol=1e-8)
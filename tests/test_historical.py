@@ -0,0 +1,28 @@
+################## Imports ##################
+# Tests of the historical VaR/ES of app.py against the results in tests/
+from __future__ import division
+
+import numpy as np
+
+import app
+from conftest import read_fixture
+
+
+##################  Historical VaR/ES ##################
+
+# The fixtures hold the 2 year window, 5 day horizon VaR and ES of 10000 held in each series, most recent date first,
+# from a longer history than the price files; every date the price files cover must match
+def test_historical_matches_fixture(price):
+    expected = read_fixture('Historical_%s_2000-12-01_2016-12-01.csv' % price.name)
+    VaR, ES = app.historical(10000, price, 0.99, 0.975, 2*252, 5)
+    assert len(VaR) == len(price) - 2*252
+    assert (expected.index[:len(VaR)] == price.index[:len(VaR)]).all()
+    assert np.allclose(VaR, expected['VaR'].values[:len(VaR)], rtol=1e-9)
+    assert np.allclose(ES, expected['ES'].values[:len(ES)], rtol=1e-9)
+
+# Partial sorts by block give the same order statistics whatever the block size
+def test_historical_block_size(price):
+    VaR, ES = app.historical(10000, price, 0.99, 0.975, 252, 10)
+    VaR_1, ES_1 = app.historical(10000, price, 0.99, 0.975, 252, 10, block_size=7)
+    assert np.array_equal(VaR, VaR_1)
+    assert np.allclose(ES, ES_1, rtol=1e-12)
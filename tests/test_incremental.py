@@ -0,0 +1,41 @@
+################## Imports ##################
+# Tests of the incremental daily VaR/ES of incremental.py against full recomputations in app.py
+from __future__ import division
+
+import numpy as np
+
+import app
+from incremental import StateStore
+
+
+##################  Incremental updates ##################
+
+# Closes appended one day at a time through StateStore.update give the VaR and ES of a full recomputation on every
+# day, for every method with a rolling state
+def test_appended_days_match_full_recomputation(price):
+    for method in ['Parametric VaR/ES', 'Historical VaR/ES', 'Monte Carlo VaR/ES']:
+        name = ['test', price.name, method]
+        for days in range(60, -1, -1):
+            args = (10000, price[days:], 0.99, 0.975, method, 2, 5/252)
+            VaR, ES, appended = app.latest_risk(*args, name=name, seed=0)
+            assert appended == (None if days == 60 else 1)
+            VaR_full, ES_full = app.full_latest_risk(*args, seed=0)
+            assert np.isclose(VaR, VaR_full, rtol=1e-9)
+            assert np.isclose(ES, ES_full, rtol=1e-9)
+
+# A state is rebuilt when the prices end before it or when its last close was revised, and kept when nothing is new
+def test_state_store_rebuilds(tmp_path, price):
+    store = StateStore(str(tmp_path))
+    prices = price.sort_index()
+    state, appended = store.update('key', prices[:-10], 504, 5, 0.99, 0.975)
+    assert appended is None
+    state, appended = store.update('key', prices, 504, 5, 0.99, 0.975)
+    assert appended == 10 and state.last_date == prices.index[-1]
+    state, appended = store.update('key', prices, 504, 5, 0.99, 0.975)
+    assert appended == 0
+    state, appended = store.update('key', prices[:-1], 504, 5, 0.99, 0.975)
+    assert appended is None and state.last_date == prices.index[-2]
+    revised = prices[:-1].copy()
+    revised.iloc[-1] *= 1.01
+    state, appended = store.update('key', revised, 504, 5, 0.99, 0.975)
+    assert appended is None and state.last_price == revised.iloc[-1]
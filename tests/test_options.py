@@ -0,0 +1,40 @@
+################## Imports ##################
+# Tests of the Monte Carlo VaR of stock and put portfolios of app.py
+from __future__ import division
+
+import numpy as np
+import scipy.special
+
+import app
+
+
+##################  Monte Carlo ##################
+
+OPTION_ARGS = (117.06, 0.25, 0.25, 0.005, 0.21, 117.06, 0.5)
+
+def stock_var(s0, mu, sigma, nstocks, VaR_prob, horizon):
+    return s0 * nstocks * (1 - np.exp(sigma * np.sqrt(horizon) * scipy.special.ndtri(1 - VaR_prob)
+                                      - (mu + sigma*sigma/2) * horizon))
+
+# Without puts the loss is its own control, so the pilot beta is 1 and the control variate gives the exact VaR
+def test_option_mc_control_variate_exact_without_puts():
+    VaR, npaths, stderr = app.option_mc(*OPTION_ARGS + (8457.2, 0, 0.99, 5/252), npaths=80000, chunk_size=10000,
+                                        control_variate=True, seed=0)
+    assert np.isclose(VaR, stock_var(117.06, 0.25, 0.25, 8457.2, 0.99, 5/252))
+    assert npaths == 160000 and stderr < 1e-6
+
+# The pooled quantile of plain paths agrees with the exact stock VaR within its batch-means standard error
+def test_option_mc_pooled_quantile_within_stderr():
+    VaR, npaths, stderr = app.option_mc(*OPTION_ARGS + (8457.2, 0, 0.99, 5/252), npaths=400000, chunk_size=20000,
+                                        seed=1)
+    assert npaths == 400000
+    assert abs(VaR - stock_var(117.06, 0.25, 0.25, 8457.2, 0.99, 5/252)) < 4 * stderr
+
+# The adaptive run with a hedge stops at the tolerance, and its estimate agrees with a long plain run
+def test_option_mc_adaptive_matches_plain():
+    args = OPTION_ARGS + (8457.2, 1476.1, 0.99, 5/252)
+    VaR, npaths, stderr = app.option_mc(*args, chunk_size=10000, antithetic=True, control_variate=True, tol=0.001,
+                                        seed=0)
+    assert 1.96 * stderr <= 0.001 * VaR
+    VaR_plain, npaths_plain, stderr_plain = app.option_mc(*args, npaths=2000000, seed=2)
+    assert abs(VaR - VaR_plain) < 4 * np.hypot(stderr, stderr_plain)
@@ -0,0 +1,49 @@
+################## Imports ##################
+# Tests of the universe panel of panel.py against the price store frames and portfolio_from_prices of app.py
+from __future__ import division
+
+import numpy as np
+import pandas as pd
+
+import app
+from panel import build_panel
+from price_store import PriceStore
+
+
+##################  Fixtures ##################
+
+DATES = pd.bdate_range('2015-01-01', '2016-12-01')
+
+# Two tickers on business days, each missing some dates the other has (as with exchange holidays)
+def gappy_provider(ticker, start_date, end_date):
+    rng = np.random.RandomState(len(ticker))
+    dates = DATES[np.arange(len(DATES)) % (7 if ticker == 'AAA' else 11) != 3]
+    series = pd.Series(100 * np.exp(np.cumsum(0.01 * rng.standard_normal(len(dates)))), index=dates, name=ticker)
+    return series[(series.index >= start_date) & (series.index <= end_date)]
+
+def store_and_panel(tmpdir):
+    store = PriceStore(str(tmpdir.join('prices')), gappy_provider, max_workers=1)
+    for ticker in ['AAA', 'BB']:
+        store.get_series(ticker, DATES[0], DATES[-1])
+    return store, build_panel(str(tmpdir.join('prices')), str(tmpdir.join('universe')))
+
+
+##################  Panel ##################
+
+# Frames have the dates of the price store and NaN where a ticker has no price of its own
+def test_frame_matches_price_store(tmpdir):
+    store, universe = store_and_panel(tmpdir)
+    start, end = pd.Timestamp('2015-06-01'), pd.Timestamp('2016-06-01')
+    for tickers_list in [['AAA'], ['AAA', 'BB']]:
+        expected = store.get_prices(tickers_list, start, end).sort_index(ascending=False)
+        pd.testing.assert_frame_equal(universe.frame(tickers_list, start, end), expected, check_freq=False)
+
+# Portfolios follow portfolio_from_prices on the same frame: NaN on the dates where one of the tickers has no price
+def test_portfolio_matches_portfolio_from_prices(tmpdir):
+    store, universe = store_and_panel(tmpdir)
+    start, end, position_date = pd.Timestamp('2015-06-01'), pd.Timestamp('2016-06-01'), pd.Timestamp('2016-01-04')
+    df = store.get_prices(['AAA', 'BB'], start, end).sort_index(ascending=False)
+    expected = app.portfolio_from_prices(df, [0.4, 0.6], 10000, position_date, 'AAA,BB')
+    portfolio = universe.portfolio(['AAA', 'BB'], [0.4, 0.6], 10000, position_date, start, end, 'Portfolio_AAA_BB')
+    assert portfolio[expected.columns[0]].isnull().any()
+    pd.testing.assert_frame_equal(portfolio, expected, check_freq=False)